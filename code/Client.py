@@ -10,13 +10,31 @@ from config.Logger import *
 from config.Receiver import *
 from config.Sender import *
 from config.util import *
+from config.Package import *
+from config.Congestion import congestion_algorithms
+from config.Delta import delta_block_size, make_delta
+from config.Merkle import MerkleTree, received_tree, send_tree
+from config.Compress import codecs, compress_file, compressible, parse_codec
+from config.Bundle import list_tree, make_bundle
+from config.Ticket import codec_mask, decode_ticket
+from config.Pmtu import dont_fragment, probe_path
+from config.Transport import size_buffers
 from random import randint
+from queue import Queue, Empty
+import math
 import numpy as np
 import matplotlib.pyplot as plt
 
 # 服务端ip:port
 Serveraddr = ("127.0.0.1", 22222)
 
+# 服务端签发的会话票据：服务端ip:port -> (票据, 报文版本, 压缩算法列表)
+tickets = {}
+
+# 路径MTU探测确定的MSS：服务端ip:port -> (MSS, 过期时间)，并发的客户端等待同一次探测的结果
+paths = {}
+path_lock = Lock()
+
 
 class Client(object):
     """客户端类
@@ -26,11 +44,21 @@ class Client(object):
     握手完毕后创建Sender类或者Receiver类发送或接受文件。
     """
 
-    def __init__(self, index, identify, file):
+    def __init__(self, index, identify, file, congestion=congestion_control, stripes=stripes, stripe=None, delta=delta, signature=None, patch=None, fec=fec, pacing=pacing, compression=compression, bundle=None):
         """初始化函数
         - index 客户端进程编号，用于并发时区分不同进程
         - identify 标识自身身份是Sender还是Receiver
         - file 该客户端处理的相对路径文件名
+        - congestion 本次传输使用的阻塞控制算法，作为接收方时在请求中告诉服务端
+        - stripes 发送大文件时并行发送的分段数量
+        - stripe 分段发送中的一段：(区间起点, 区间终点, 整个文件的信息, 分段编号)，由分段发送的主客户端创建
+        - delta 服务端已有旧版本的文件时是否只发送增量数据
+        - signature 增量发送时取回服务端文件签名的分块大小，由增量发送的主客户端创建
+        - patch 增量发送时要发送的增量数据：(增量数据文件, 整个文件的信息, 增量数据的信息)，由增量发送的主客户端创建
+        - fec 作为发送方时是否发送前向纠错的校验报文
+        - pacing 作为发送方时是否按令牌桶控制发送节奏
+        - compression 压缩传输使用的"算法:级别"，None表示不压缩，服务端不支持或数据不可压缩时也不压缩
+        - bundle 打包发送文件夹时要打包的文件相对file的路径列表，此时file为文件夹
         """
 
         self.log = Logger(f"Client {index} {identify}")
@@ -53,12 +81,50 @@ class Client(object):
             self.udpsocket.bind(("", self.hostport))
         self.destaddr = Serveraddr
         self.udpsocket.settimeout(5)
+        dont_fragment(self.udpsocket)
         self.identify = identify
         self.file = file
+        self.index = index
+        self.congestion = congestion
+        self.stripes = stripes
+        self.stripe = stripe
+        self.delta = delta
+        self.signature = signature
+        self.patch = patch
+        self.fec = fec
+        self.pacing = pacing
+        self.compression = compression
+        # 获取端口时服务端回复的双方都支持的压缩算法
+        self.codecs = []
+        # 本次握手使用的会话票据，服务端不接受票据时rejected为True
+        self.ticket = None
+        self.rejected = False
+        # 本次握手是否没有票据、把端口请求合并到握手请求中（hello）
+        self.hello = False
+        # 一次往返握手时服务端在回复中签发的地址验证令牌，附在之后发往服务端的确认和ACK前
+        self.token = None
+        # 压缩发送时的(压缩数据文件, 压缩算法, 压缩数据大小)
+        self.spool = None
+        # 压缩接收时服务端确定的压缩算法和压缩数据大小
+        self.codec = None
+        self.stream = None
+        self.bundle = bundle
+        # 打包发送时的(打包数据文件, 打包数据的信息)
+        self.packed = None
+        # 分段发送时本段数据的md5码，服务端收完本段即检查，最后不需要重新读整个文件
+        self.digest = None
+        # 握手结束（无论成功与否）时置位，分段发送的主客户端等第一段握手取得会话票据后再启动其余分段
+        self.shaken = Event()
+        # 本地读写的文件，取回签名时为签名的临时文件，打包发送时为打包数据文件，其他情况即为file
+        self.local = file
+        # 逐块检查的Merkle树，作为发送方时由自己计算，作为接收方时由服务端公布
+        self.tree = None
         self.rwnd = default_rwnd
         self.num = startnum
         self.MSS = MSS
-        self.package = Struct(f"!HHI{MSS}s")
+        # 报文版本在获取端口时与服务端协商，协商前按version 1处理
+        self.version = 1
+        self.package = Package(MSS, self.version)
         self.MSS_size = self.package.size
 
     def Shakehand(self):
@@ -76,36 +142,73 @@ class Client(object):
         cnt = 0
         # 记录当前握手状态
         status = 0
-        info = get_fileinfo(self.file)
-        time.sleep(0.5)
+        # 分段发送时文件信息由主客户端计算一次，打包发送时为打包时计算的打包数据的信息
+        if self.stripe is not None:
+            info = self.stripe[2]
+        elif self.packed is not None:
+            info = self.packed[1]
+        else:
+            info = get_fileinfo(self.file)
+        # 等待服务端创建处理请求的进程，使用票据或hello时请求直接发往hostport，不需要等待
+        if self.ticket is None and not self.hello:
+            time.sleep(0.5)
         if self.identify == "Send":
             # 若自身文件不存在，退出
             if not os.path.exists(self.file):
                 self.log.err(f"File not found: {self.file}, aborted.")
                 return False
+            self.uncompress()
+            if self.patch is not None:
+                # 发送增量数据
+                request = [delta_command, self.file, *self.patch[1], *self.patch[2]]
+                self.filesize = int(self.patch[2][0])
+            elif self.packed is not None:
+                # 发送打包数据，压缩时附上压缩算法和压缩数据大小
+                request = [bundle_command, self.file, *info]
+                self.filesize = int(info[0])
+                if self.spool is not None:
+                    request += [self.spool[1], str(self.spool[2])]
+                    self.filesize = self.spool[2]
+            elif self.spool is not None:
+                # 发送压缩数据，附上压缩算法和压缩数据大小
+                request = [compress_command, self.file, *info, self.spool[1], str(self.spool[2])]
+                self.filesize = self.spool[2]
+            elif self.stripe is None:
+                request = [send_command, self.file, *info]
+                self.filesize = int(info[0])
+                # 附上Merkle树的[分块大小, 分块数量, 根]，服务端逐块检查，一般已在获取端口前计算好
+                if merkle:
+                    if self.tree is None or self.tree.chunk % self.package.MSS:
+                        self.tree = MerkleTree.build(self.file, self.package.MSS)
+                    request += self.tree.info()
+            else:
+                # 只发送文件的[起点, 终点)区间，附上这段数据的md5码
+                request = [stripe_command, self.file, *info, str(self.stripe[0]), str(self.stripe[1]), self.digest]
+                self.filesize = self.stripe[1]
             pkg = self.package.pack(
                 self.sign,
                 self.rwnd,
                 self.num,
-                spliter.join([send_command, self.file, *info]).encode(),
+                spliter.join(request).encode(),
             )
-            self.filesize = int(info[0])
+            ans = ""
             while True:
 
                 try:
                     self.log.info(
                         f"sending the {'first' if status == 0 else 'second'} handshake package {self.num}"
                     )
-                    self.udpsocket.sendto(pkg, self.destaddr)
+                    self.udpsocket.sendto(self.opening(pkg) if status == 0 else pkg, self.destaddr)
                 except Exception as e:
                     self.log.err(
                         f"Error occured while handling sending in Shakehand: {e}, aborted."
                     )
                     return False
 
-                ans = ""
                 try:
                     raw, destaddr = self.udpsocket.recvfrom(self.MSS_size)
+                    if self.refused(destaddr):
+                        return False
                     self.destaddr = destaddr
                     try:
                         sign, self.rwnd, num, data = self.package.unpack(raw)
@@ -126,8 +229,10 @@ class Client(object):
                         break
 
                     self.num += 1
-                    Server_fileinfo = data.split(spliter)
-                    file = check_fileinfo(self.file, Server_fileinfo)
+                    Server_fileinfo = self.greeted(data.split(spliter))
+                    # 分段发送、增量发送、压缩发送和打包发送不支持续传，不需要比对服务端的文件
+                    resumable = self.stripe is None and self.patch is None and self.spool is None and self.packed is None
+                    file = check_fileinfo(self.file, Server_fileinfo) if resumable else resend
                     self.log.info(
                         f"got the respond, {'file exist' if file == cosend else ''}"
                     )
@@ -146,14 +251,23 @@ class Client(object):
                         self.offset = 0
                     elif ans == cosend:
                         self.offset = int(Server_fileinfo[0])
+                    if self.stripe is not None:
+                        self.offset = self.stripe[0]
+                    # 一次往返握手：从头发送时不需要确认，服务端收到下一个序号的数据即开始接收
+                    if self.fast() and ans == resend:
+                        self.num += 1
+                        break
                     pkg = self.package.pack(
-                        self.sign, self.rwnd, self.num, ans.encode()
+                        self.sign, self.rwnd, self.num, self.proof() + ans.encode()
                     )
                     status = 1
                     cnt = 0
 
                 except timeout:
                     cnt += 1
+                    # 票据或hello没有回复，可能是重启过的服务端或者不支持的旧服务端，重新获取端口
+                    if status == 0 and cnt == 2 and self.refused():
+                        return False
                     # 超时5次，握手失败，退出
                     if cnt == 5:
                         self.log.err(
@@ -169,23 +283,46 @@ class Client(object):
                     self.log.err(f"Error occure while shanking: {e}, aborted.")
                     return False
 
+            # 开始发送前把Merkle树的叶子发给服务端
+            if self.tree is not None:
+                send_tree(self.tree, self.udpsocket, self.package, self.sign, self.destaddr, self.log)
             return True
 
         elif self.identify == "Receive":
-            # 发送自身文件信息，如果不存在，info=['0', '0']
+            # 发送自身文件信息，如果不存在，info=['0', '0']，最后附上服务端发送时使用的阻塞控制算法，以及是否逐块检查
+            request = [receive_command, self.file, *info, self.congestion, "1" if merkle else "0"]
+            # 请求服务端压缩发送，服务端不支持时不请求，服务端需要先压缩，等待的时间更长
+            limit = 5
+            if self.compression is not None and parse_codec(self.compression)[0] in self.codecs:
+                request.append(self.compression)
+                limit = verify_retry
+            # 取回签名时服务端需要先计算签名，等待的时间更长
+            if self.signature is not None:
+                request = [signature_command, self.file, str(self.signature), self.congestion]
+                self.local = f"{self.file}.{self.sign}.sig"
+                limit = verify_retry
             pkg = self.package.pack(
                 self.sign,
                 self.rwnd,
                 self.num,
-                f"{spliter.join([receive_command, self.file, *info])}".encode(),
+                f"{spliter.join(request)}".encode(),
             )
             cnt = 0
             status = 0
+            # 收到Merkle树的分页后不重发握手报文
+            quiet = False
+            # 一次往返握手不需要续传时不发送确认，等待服务端直接发来的数据
+            silent = False
             while True:
 
                 try:
-                    self.log.info(f"sending the first handshake package")
-                    self.udpsocket.sendto(pkg, self.destaddr)
+                    # 不发送确认时发一个附上令牌的ACK，服务端收到后客户端的地址得到验证，不再限制发送的数据量
+                    if not quiet and silent:
+                        self.udpsocket.sendto(self.package.pack(self.sign, self.rwnd, self.num - 1, self.proof()), self.destaddr)
+                    elif not quiet:
+                        self.log.info(f"sending the first handshake package")
+                        self.udpsocket.sendto(self.opening(pkg) if status == 0 else pkg, self.destaddr)
+                    quiet = False
                 except Exception as e:
                     self.log.err(
                         f"Error occured while handling sending in Shakehand: {e}, aborted."
@@ -194,6 +331,8 @@ class Client(object):
 
                 try:
                     raw, destaddr = self.udpsocket.recvfrom(self.MSS_size)
+                    if self.refused(destaddr):
+                        return False
                     self.destaddr = destaddr
                     self.log.info(f"got the respond")
                     try:
@@ -203,6 +342,16 @@ class Client(object):
                             f"Unable to unpack received package due to the error : {e}, droped."
                         )
                         continue
+                    # 服务端在开始发送前发来Merkle树的叶子分页，序号为页号，回复后继续等待数据
+                    if status == 1 and sign == self.sign and rwnd == TREE_PAGE and self.tree is not None:
+                        self.tree.accept(num, data, self.package.MSS)
+                        self.udpsocket.sendto(self.package.pack(self.sign, TREE_PAGE, num, b""), self.destaddr)
+                        quiet = True
+                        continue
+                    # 一次往返握手时握手回复丢失，服务端已直接开始发送，等待服务端重发回复
+                    if status == 0 and self.fast() and sign == self.sign and (num > self.num or rwnd == TREE_PAGE):
+                        quiet = True
+                        continue
                     if sign != self.sign or num != self.num:
                         self.log.warning(
                             f"got an uncorrect message, Expected sign num : {self.sign} {self.num}, but got {sign} {num}, droped and resending."
@@ -212,11 +361,19 @@ class Client(object):
                         self.log.info(f"got the data, starting receiving......")
                         self.data = raw
                         break
-                    ans, self.filesize, self.filemd5 = data.decode().strip(b"\x00".decode()).split(spliter)
+                    ans, *fileinfo = self.greeted(data.decode().strip(b"\x00".decode()).split(spliter))
                     # 如果服务器回复的是File not found,结束进程
                     if ans == FILENOTFOUND:
                         self.log.warning(f"File not exise, aborted.")
                         return False
+                    self.filesize, self.filemd5, *extra = fileinfo
+                    # 服务端附上了Merkle树的[分块大小, 分块数量, 根]
+                    if len(extra) == 3:
+                        self.tree = MerkleTree.from_info(extra)
+                    # 服务端压缩发送，附上了[压缩算法, 压缩数据大小]
+                    elif len(extra) == 2:
+                        self.codec, self.stream = extra
+                        self.log.info(f"Server sends {self.file} with {self.codec} compression: {self.stream}/{self.filesize} bytes")
                     # 如果文件数据一致，可以续传
                     if ans == cosend:
                         while True:
@@ -240,14 +397,19 @@ class Client(object):
                         self.log.warning(f"Unknown respond: {data}, droping......")
                         continue
                     pkg = self.package.pack(
-                        self.sign, self.rwnd, self.num, ans.encode()
+                        self.sign, self.rwnd, self.num, self.proof() + ans.encode()
                     )
                     self.num += 1
                     status = 1
+                    # 服务端逐块检查时等待确认后再发送
+                    silent = self.fast() and ans == resend and self.tree is None
 
                 except timeout:
                     cnt += 1
-                    if cnt == 5:
+                    # 服务端需要先压缩或者计算签名时回复较慢，票据请求不因超时重新获取端口
+                    if status == 0 and cnt == 2 and (self.hello or limit == 5) and self.refused():
+                        return False
+                    if cnt == limit:
                         # 超时五次退出
                         self.log.err(
                             f"Timeout after resending {cnt} time{'s' if cnt > 1 else ''}, aborted."
@@ -268,24 +430,124 @@ class Client(object):
         else:
             self.log.err(f"Unreachable error while handling Shakehand, aborted.")
 
-    def Getport(self):
+    def fast(self):
+        """握手请求是否直接发往hostport，此时握手只需一次往返"""
+
+        return self.ticket is not None or self.hello
+
+    def opening(self, pkg):
+        """握手请求直接发往hostport时，第一个报文前附上会话票据或hello的参数，长度与端口请求不同
+        - 请求补零到比端口请求长一个字节，服务端验证客户端的地址前最多发送请求长度的若干倍，见config.amplification_limit
+        - 不补到一个数据报文的长度，探测路径MTU后的大请求会超出hostport的接收缓冲区
+        """
+
+        if self.ticket is not None:
+            prefix = opening_kind.pack(opening_ticket) + self.ticket
+        elif self.hello:
+            prefix = opening_kind.pack(opening_hello) + hello_body.pack(self.MSS, self.version, codec_mask(self.codecs))
+        else:
+            return pkg
+        return (prefix + pkg).ljust(reMSS_size + 1, b"\x00")
+
+    def refused(self, destaddr=None):
+        """握手请求直接发往hostport时收到hostport的回复（票据过期或不支持客户端的报文版本），
+        或者超时没有回复（服务端重启后无法认证之前的票据，或者不支持hello的旧服务端），之后重新获取端口
+        - destaddr 收到回复的地址，None时为超时
+        """
+
+        if not (self.fast() and destaddr in (None, Serveraddr)):
+            return False
+        self.log.warning(f"Direct request rejected by server, getting a port again......")
+        tickets.pop(Serveraddr, None)
+        self.rejected = True
+        return True
+
+    def greeted(self, fields):
+        """一次往返握手时记录服务端在回复前附上的地址验证令牌，hello握手时还有双方都支持的压缩算法和签发的会话票据，返回其余部分"""
+
+        if not self.fast() or len(fields) < (4 if self.hello else 2):
+            return fields
+        token, *fields = fields
+        self.token = decode_ticket(token)
+        if not self.hello:
+            return fields
+        common, ticket, *fields = fields
+        self.codecs = common.split(",") if common else []
+        if session_ticket:
+            tickets[Serveraddr] = (decode_ticket(ticket), self.version, self.codecs)
+        return fields
+
+    def proof(self):
+        """附在确认和ACK前的地址验证令牌，证明客户端收到了服务端的回复，没有令牌时为空"""
+
+        return self.token if self.token is not None else b""
+
+    def discover(self):
+        """确定本次会话的MSS
+        - 到服务端路径的MSS在有效期内时直接使用，否则先探测路径MTU，见config.Pmtu.probe_path
+        - 探测结果与之前不同时丢弃会话票据，票据中记录的是之前的MSS
+        - 系统限制了socket接收缓冲区的上限时，MSS不超过缓冲区能容纳rcvbuf_min_window个报文的大小
+        """
+
+        if pmtu_discovery:
+            with path_lock:
+                cached = paths.get(Serveraddr)
+                if cached is None or cached[1] < time.time():
+                    MSS = probe_path(Serveraddr, self.log)
+                    if cached is None or cached[0] != MSS:
+                        tickets.pop(Serveraddr, None)
+                    cached = paths[Serveraddr] = (MSS, time.time() + pmtu_lifetime)
+            self.MSS = cached[0]
+        granted = size_buffers(self.udpsocket, (self.MSS + pmtu_header) * default_rwnd)
+        self.MSS = min(self.MSS, granted // rcvbuf_min_window - pmtu_header)
+
+    def Getport(self, resume=False):
         """获取端口函数
         - 向服务端发送文件传输请求，获取服务端处理该请求相应端口，这是由于NAT技术所致
+        - resume 是否使用会话票据，有票据时不需要获取端口，握手请求附上票据直接发往hostport
+        - 之前先确定本次会话的MSS，在请求中告诉服务端
         """
 
+        self.discover()
         self.sign = randint(1, 60000)
-        # 请求端口报文，并附上自己的MSS
-        pkg = repackage.pack(
-            self.sign,
-            self.rwnd,
-            self.num,
-            spliter.join([REQUESTPORT, str(MSS)]).encode(),
-        )
+        self.num = startnum
+        self.destaddr = Serveraddr
+        self.ticket = None
+        self.hello = False
+        self.token = None
+        if resume and session_ticket and Serveraddr in tickets:
+            self.ticket, self.version, self.codecs = tickets[Serveraddr]
+            self.package = Package(self.MSS, self.version)
+            self.MSS_size = self.package.size
+            # 与获取端口后的报文序号一致
+            self.num += 1
+            self.log.info(f"Resume session with ticket, package version {self.version}")
+            return True
+        # 没有票据时把端口请求合并到握手请求中，仍然先获取端口的情况：
+        # 压缩发送需要先知道服务端支持的压缩算法；压缩接收时服务端先压缩，回复较慢，会被当作不支持hello的旧服务端
+        if resume and direct_request and self.spool is None and not (self.identify == "Receive" and self.compression is not None):
+            self.hello = True
+            self.version = wire_version
+            self.codecs = list(codecs)
+            self.package = Package(self.MSS, self.version)
+            self.MSS_size = self.package.size
+            self.num += 1
+            self.log.info(f"Send request with hello, package version {self.version}")
+            return True
+        # 请求端口报文，并附上自己的MSS、支持的最高报文版本和支持的压缩算法
+        request = spliter.join([REQUESTPORT, str(self.MSS), str(wire_version), ",".join(codecs)]).encode()
+        # 旧服务端只能解析REQUESTPORT, MSS两个字段，收到多出字段的请求时不会回复
+        legacy = spliter.join([REQUESTPORT, str(self.MSS)]).encode()
+        pkg = repackage.pack(self.sign, self.rwnd, self.num, request)
+        fallback = False
         self.log.info(f"Try to get a port from Server")
         cnt = 0
         while True:
             try:
                 self.udpsocket.sendto(pkg, self.destaddr)
+                # 超时过一次后紧接着再发一个旧格式的请求，新服务端已处理第一个请求，会忽略签名重复的第二个
+                if fallback:
+                    self.udpsocket.sendto(repackage.pack(self.sign, self.rwnd, self.num, legacy), self.destaddr)
             except Exception as e:
                 self.log.err(f"Error occured while handling Getport: {e}, aborted.")
                 return False
@@ -311,21 +573,26 @@ class Client(object):
                 if data == RESET:
                     self.log.warning(f"sign duplicated, regening...")
                     self.sign = randint(1, 60000)
-                    pkg = repackage.pack(
-                        self.sign,
-                        self.rwnd,
-                        self.num,
-                        spliter.join([REQUESTPORT, str(MSS)]).encode(),
-                    )
+                    pkg = repackage.pack(self.sign, self.rwnd, self.num, request)
                     continue
 
                 self.num += 1
-                self.log.info(f"got the port : {data}")
-                self.destaddr = (self.destaddr[0], int(data))
+                # 回复为端口号，支持新版本的服务端还会附上协商的报文版本和双方都支持的压缩算法
+                port, *version = data.split(spliter)
+                self.version = int(version[0]) if version else 1
+                self.codecs = version[1].split(",") if len(version) > 1 and version[1] else []
+                # 记录服务端签发的会话票据，之后的传输使用
+                if len(version) > 2:
+                    tickets[Serveraddr] = (decode_ticket(version[2]), self.version, self.codecs)
+                self.package = Package(self.MSS, self.version)
+                self.MSS_size = self.package.size
+                self.log.info(f"got the port : {port}, package version {self.version}")
+                self.destaddr = (self.destaddr[0], int(port))
                 break
 
             except timeout:
                 cnt += 1
+                fallback = True
                 if cnt == 5:
                     # 超时五次退出
                     self.log.err(
@@ -345,31 +612,118 @@ class Client(object):
 
     def start(self):
         """启动函数
+        - 大文件分段发送，有旧版本时增量发送，由子客户端完成各个会话
+        - 否则占用一个服务端的会话名额，完成一个会话，见session
+        - 返回是否完成，作为接收方时为接收到的文件是否完整
+        """
+
+        if (
+            self.identify == "Send"
+            and self.delta
+            and self.stripe is None
+            and self.patch is None
+            and os.path.isfile(self.file)
+            and os.path.getsize(self.file) >= delta_min_size
+        ):
+            return self.start_delta()
+        if (
+            self.identify == "Send"
+            and self.stripe is None
+            and self.stripes > 1
+            and os.path.isfile(self.file)
+            and os.path.getsize(self.file) >= stripe_min_size
+        ):
+            return self.start_striped()
+        # 每个会话占用一个服务端的会话名额，分段发送和增量发送的子客户端各自占用
+        with session_slot():
+            return self.session()
+
+    def session(self):
+        """一个会话
         - 获取端口 & 握手
         - 均成功后开始发送/接收文件
+        - 返回是否完成，作为接收方时为接收到的文件是否完整
         """
 
-        if self.Getport() == False or self.Shakehand() == False:
-            return
+        if self.stripe is not None:
+            # 获取端口前计算这段数据的md5码，不占用握手的时间
+            self.digest = md5_file(self.file, self.stripe[1] - self.stripe[0], start=self.stripe[0]).hexdigest()
+        # 打包和压缩需要较长时间，在获取端口前完成，服务端的会话不需要等待
+        if self.identify == "Send" and self.bundle is not None and not self.pack():
+            return False
+        if (
+            self.identify == "Send"
+            and self.compression is not None
+            and self.stripe is None
+            and self.patch is None
+            and os.path.isfile(self.local)
+        ):
+            self.compress()
+        if (
+            self.identify == "Send"
+            and merkle
+            and self.stripe is None
+            and self.patch is None
+            and self.packed is None
+            and self.spool is None
+            and os.path.isfile(self.file)
+        ):
+            # 获取端口前计算Merkle树，同时计算的整个文件的md5码写入缓存，握手时不需要再读文件
+            self.discover()
+            self.tree = MerkleTree.build(self.file, self.MSS)
+        if self.Getport(resume=True) == False:
+            self.discard_spool()
+            return False
+        if self.Shakehand() == False:
+            # 服务端不接受会话票据时重新获取端口，再握手一次
+            if not self.rejected or self.Getport() == False or self.Shakehand() == False:
+                self.discard_spool()
+                return False
+        self.shaken.set()
         self.log.info(f"Finish shakehand! Start {self.identify} {self.file}.....")
+        correct = True
         if self.identify == "Send":
-            Sender(
+            # 增量发送时发送增量数据，压缩发送时发送压缩数据，打包发送时发送打包数据
+            source = self.local
+            if self.patch is not None:
+                source = self.patch[0]
+            elif self.spool is not None:
+                source = self.spool[0]
+            sender = Sender(
                 self.destaddr,
                 self.sign,
-                self.file,
+                source,
                 self.rwnd,
                 self.offset,
                 self.udpsocket,
                 self.num,
                 self.log,
                 self.MSS,
-                self.filesize
-            ).start()
+                self.filesize,
+                self.version,
+                self.congestion,
+                pacing=self.pacing,
+                fec=self.fec
+            )
+            # 分段发送时每段的数据分别保存，画图使用第一段的数据
+            if self.stripe is not None and self.stripe[3] > 0:
+                sender.datalog = f"{self.file}.{self.stripe[3]}_data.log"
+            # 增量发送、压缩发送和打包发送时画图使用实际数据的发送过程
+            if self.patch is not None or self.spool is not None or self.packed is not None:
+                sender.datalog = f"{self.file}_data.log"
+            sender.start()
+            self.discard_spool()
+            # 打包发送时请求服务端解开打包数据，服务端解开失败时传输失败
+            if self.packed is not None:
+                sign = self.sign
+                correct = self.Getport(resume=True) != False and self.Verify(self.packed[1], unpack_command, [str(sign)])
+                if not correct:
+                    self.log.err(f"Unable to unpack {self.file} on server.")
         elif self.identify == "Receive":
-            Receiver(
+            receiver = Receiver(
                 self.destaddr,
                 self.sign,
-                self.file,
+                self.local,
                 self.offset,
                 self.udpsocket,
                 self.num,
@@ -377,12 +731,209 @@ class Client(object):
                 self.log,
                 self.MSS,
                 self.filesize,
-                self.filemd5
-            ).start()
+                self.filemd5,
+                self.version,
+                None,
+                received_tree(self.tree, self.log),
+                self.codec,
+                self.stream
+            )
+            receiver.token = self.token
+            receiver.start()
+            correct = receiver.correct
         else:
             self.log.err(f"Unreachable error while starting send/receice job")
-            return
+            return False
         self.log.info(f"{self.identify} {self.file} Finished!")
+        return correct
+
+    def compress(self):
+        """压缩发送前把文件压缩到临时文件
+        - 在获取端口前压缩，此时还不知道服务端是否支持，握手时服务端不支持再丢弃压缩数据，见uncompress
+        - 取样判断数据不可压缩（图片、压缩包等）时不压缩
+        - 按compress_block分块压缩，发送完毕后删除临时文件，临时文件以监听的端口区分
+        """
+
+        name, level = parse_codec(self.compression)
+        if name not in codecs:
+            return
+        if not compressible(self.local, name, level):
+            self.log.info(f"{self.file} is incompressible, send without compression")
+            return
+        spool = f"{self.file}.{self.hostport}.z"
+        size = compress_file(self.local, spool, name, level)
+        self.log.info(f"Compress {self.file} with {name} level {level}: {size}/{os.path.getsize(self.local)} bytes")
+        self.spool = (spool, name, size)
+
+    def uncompress(self):
+        """握手时服务端不支持压缩数据使用的算法，丢弃压缩数据，发送原数据"""
+
+        if self.spool is None or self.spool[1] in self.codecs:
+            return
+        self.log.warning(f"Server does not support {self.spool[1]} compression, send {self.file} without compression")
+        os.remove(self.spool[0])
+        self.spool = None
+
+    def pack(self):
+        """打包发送前把文件夹里要打包的文件打包到临时文件
+        - 开头为清单，之后是连续存放的文件内容，整个文件夹只需一次获取端口和握手
+        - 在获取端口前打包，临时文件以监听的端口区分
+        - 返回是否打包成功
+        """
+
+        bundlefile = f"{self.file}.{self.hostport}.bundle"
+        try:
+            info = make_bundle(self.file, self.bundle, bundlefile)
+        except (OSError, ValueError) as e:
+            self.log.err(f"Unable to pack {self.file} due to the error : {e}, aborted.")
+            if os.path.exists(bundlefile):
+                os.remove(bundlefile)
+            return False
+        self.log.info(f"Pack {len(self.bundle)} files of {self.file}: {info[0]} bytes")
+        self.packed = (bundlefile, info)
+        self.local = bundlefile
+        return True
+
+    def discard_spool(self):
+        """删除压缩发送和打包发送的临时文件"""
+
+        for spool in (self.spool, self.packed):
+            if spool is not None and os.path.exists(spool[0]):
+                os.remove(spool[0])
+
+    def start_striped(self):
+        """分段发送大文件
+        - 把文件按MSS对齐分成stripes个区间，每个区间由一个子客户端在自己的会话中发送，多个线程并行，
+          每个会话有独立的端口、序号和阻塞控制，服务端的各个接收者把区间写到同一个文件的相应位置
+        - 先启动第一段，等它握手取得会话票据后再启动其余分段，其余分段使用票据一次往返握手，不再获取端口
+        - 请求中附上每段数据的md5码，服务端收完一段即用写入时计算的md5码检查，检查通过的分段留下记录
+        - 全部发送完毕后请求服务端检查整个文件，附上各段会话的签名，各段都检查通过时不需要重新读整个文件
+        """
+
+        # 各个子客户端使用同一个MSS，区间按它对齐
+        self.discover()
+        info = get_fileinfo(self.file)
+        size = int(info[0])
+        step = math.ceil(size / self.stripes / self.MSS) * self.MSS
+        self.log.info(f"Send {self.file} in {math.ceil(size / step)} stripes of {step} bytes")
+        threads = []
+        clients = []
+        for i in range(math.ceil(size / step)):
+            start = i * step
+            stripe = (start, min(start + step, size), info, i)
+            client = Client(f"{self.index}.{i}", "Send", self.file, self.congestion, stripe=stripe, delta=False, fec=self.fec, pacing=self.pacing)
+            t = Thread(target=self.run_stripe, args=(client,))
+            threads.append(t)
+            clients.append(client)
+            t.start()
+            if i == 0:
+                clients[0].shaken.wait()
+        for t in threads:
+            t.join()
+        with session_slot():
+            if self.Getport(resume=True) == False:
+                return False
+            correct = self.Verify(info, verify_command, [str(client.sign) for client in clients])
+        if correct:
+            self.log.info(f"{self.identify} {self.file} Finished! File CORRECT!")
+            return True
+        self.log.warning(f"{self.identify} {self.file} Finished! File UNCORRECT!")
+        return False
+
+    def run_stripe(self, client):
+        """分段发送的线程函数，子客户端异常退出时也通知主客户端握手已结束"""
+
+        try:
+            client.start()
+        finally:
+            client.shaken.set()
+
+    def start_delta(self):
+        """增量发送
+        - 先由一个子客户端取回服务端已有文件的签名，服务端没有该文件时发送整个文件
+        - 根据签名计算增量数据，增量数据超过文件大小的delta_ratio时也发送整个文件
+        - 由另一个子客户端把增量数据发送给服务端，最后请求服务端用已有文件和增量数据合成新文件并检查
+        - 增量数据没有发送成功（握手失败等）时也发送整个文件
+        """
+
+        info = get_fileinfo(self.file)
+        size = int(info[0])
+        client = Client(f"{self.index}.sig", "Receive", self.file, self.congestion, delta=False, signature=delta_block_size(size))
+        if not client.start():
+            if os.path.exists(client.local) and client.local != self.file:
+                os.remove(client.local)
+            self.log.info(f"No signature of {self.file} from server, send the whole file.")
+            self.delta = False
+            return self.start()
+        deltafile = f"{self.file}.{client.sign}.delta"
+        deltainfo = make_delta(self.file, client.local, deltafile)
+        os.remove(client.local)
+        if int(deltainfo[0]) > size * delta_ratio:
+            os.remove(deltafile)
+            self.log.info(f"Delta of {self.file} is too large, send the whole file.")
+            self.delta = False
+            return self.start()
+        self.log.info(f"Send delta of {self.file}: {deltainfo[0]}/{size} bytes")
+        client = Client(f"{self.index}.delta", "Send", self.file, self.congestion, delta=False, patch=(deltafile, info, deltainfo), fec=self.fec, pacing=self.pacing)
+        sent = client.start()
+        os.remove(deltafile)
+        if not sent:
+            self.log.warning(f"Unable to send delta of {self.file}, send the whole file.")
+            self.delta = False
+            return self.start()
+        with session_slot():
+            if self.Getport() == False:
+                return False
+            correct = self.Verify(info, patch_command, [str(client.sign)])
+        if correct:
+            self.log.info(f"{self.identify} {self.file} Finished! File CORRECT!")
+            return True
+        self.log.warning(f"{self.identify} {self.file} Finished! File UNCORRECT!")
+        return False
+
+    def Verify(self, info, command=verify_command, extra=()):
+        """请求服务端检查分段发送完毕的文件，或者合成增量发送的文件
+        - info 整个文件的信息[文件大小, md5码]
+        - command 检查文件或合成文件的指令
+        - extra 附加在请求最后的信息，合成文件时为增量数据所在会话的签名，检查分段发送的文件时为各段会话的签名，
+          解开打包数据时为打包数据所在会话的签名
+        - 服务端检查大文件需要较长时间，超时后重发请求，最多重试verify_retry次
+        - 有会话票据时请求直接发往hostport，票据被拒绝时重新获取端口再请求一次
+        - 返回服务端的文件是否完整
+        """
+
+        pkg = self.package.pack(
+            self.sign,
+            self.rwnd,
+            self.num,
+            spliter.join([command, self.file, *info, *extra]).encode(),
+        )
+        # 与握手相同，等待服务端创建处理请求的进程
+        if not self.fast():
+            time.sleep(0.5)
+        for cnt in range(verify_retry):
+            self.udpsocket.sendto(self.opening(pkg), self.destaddr)
+            try:
+                raw, destaddr = self.udpsocket.recvfrom(self.MSS_size)
+                if self.refused(destaddr):
+                    return self.Getport() != False and self.Verify(info, command, extra)
+                sign, rwnd, num, data = self.package.unpack(raw)
+            except timeout:
+                self.log.warning(f"Waiting for verifying {self.file}, resending for {cnt + 1} tr{'y' if cnt == 0 else 'ies'}......")
+                continue
+            except Exception as e:
+                self.log.warning(
+                    f"Unable to unpack received package due to the error : {e}, droped."
+                )
+                continue
+            if sign != self.sign:
+                continue
+            return self.greeted(data.decode().strip(b"\x00".decode()).split(spliter))[-1] == cosend
+        # 服务端重启后不回复之前的票据，重新获取端口再请求一次
+        if self.refused():
+            return self.Getport() != False and self.Verify(info, command, extra)
+        self.log.err(f"Timeout while verifying {self.file}, aborted.")
+        return False
 
 
 # 主客户端log
@@ -395,25 +946,137 @@ thread_list = []
 # 发送的文件列表
 file_list = []
 
+# 待发送的任务列表：(数据大小, 客户端进程编号, 文件或文件夹, Client的其余参数)
+job_list = []
+
+# 每个服务端同时进行的会话数量的信号量
+server_slots = {}
 
-def scanfile(path):
+
+def session_slot():
+    """当前服务端的会话名额，每个会话（包括分段发送、增量发送的子会话和最后的检查）占用一个"""
+
+    return server_slots.setdefault(Serveraddr, BoundedSemaphore(server_sessions))
+
+
+def scanfile(path, congestion=congestion_control, stripes=stripes, delta=delta, fec=fec, compression=compression, bundle=bundle, pacing=pacing):
     """扫描文件函数
     - path 传输的相对路径的文件或文件夹
-    - 如果传输的是文件，则创建一个进程传输
-    - 如果传输的是文件夹，递归处理该文件夹里的文件和文件夹，创建多个进程实现并发传输
+    - congestion 使用的阻塞控制算法
+    - stripes 大文件并行发送的分段数量
+    - delta 是否使用增量发送
+    - fec 是否发送前向纠错的校验报文
+    - compression 压缩传输使用的"算法:级别"，None表示不压缩
+    - bundle 是否把文件夹里的小文件打包成一个会话发送
+    - pacing 是否按令牌桶控制发送节奏
+    - 如果传输的是文件，则加入一个发送任务
+    - 如果传输的是文件夹，递归处理该文件夹里的文件和文件夹，每个文件加入一个发送任务
+    - 打包发送文件夹时，小于bundle_max_file的文件合为一个打包发送的任务，其余文件各自加入一个任务
+    - 任务由transfer用有限的线程并发发送
     """
 
     global index
+    options = dict(congestion=congestion, stripes=stripes, delta=delta, fec=fec, compression=compression, pacing=pacing)
     if os.path.isfile(path):
-        t = Thread(target=Client(index, "Send", path).start)
-        thread_list.append(t)
+        job_list.append((os.path.getsize(path), index, path, options))
         file_list.append(path)
-        t.start()
         index += 1
+    elif bundle:
+        path = os.path.normpath(path)
+        small, large = list_tree(path, bundle_max_file)
+        if small:
+            size = sum(os.path.getsize(os.path.join(path, file)) for file in small)
+            job_list.append((size, index, path, dict(options, delta=False, bundle=small)))
+            file_list.append(path)
+            index += 1
+        for filepath in large:
+            scanfile(filepath, congestion, stripes, delta, fec, compression, pacing=pacing)
     else:
         for file in os.listdir(path):
             filepath = os.path.join(path, file)
-            scanfile(filepath)
+            scanfile(filepath, congestion, stripes, delta, fec, compression, bundle, pacing)
+
+
+def order_jobs(jobs, order=scan_order):
+    """按数据大小排列发送任务
+    - largest 从大到小，大文件先开始，不会最后只剩一个大文件在发送
+    - interleave 大小交替，大文件占用带宽的同时小文件陆续完成
+    """
+
+    if order not in ("largest", "interleave"):
+        return list(jobs)
+    jobs = sorted(jobs, key=lambda job: job[0], reverse=True)
+    if order == "interleave":
+        jobs = [jobs[i // 2] if i % 2 == 0 else jobs[-(i // 2) - 1] for i in range(len(jobs))]
+    return jobs
+
+
+class Progress(object):
+    """汇总所有发送任务的进度，每完成一个任务输出一次"""
+
+    def __init__(self, jobs):
+        self.files = len(jobs)
+        self.size = sum(job[0] for job in jobs)
+        self.done = 0
+        self.failed = 0
+        self.sent = 0
+        self.lock = Lock()
+        self.start = time.time()
+
+    def finish(self, size, correct):
+        """一个任务完成
+        - size 任务的数据大小
+        - correct 任务是否成功，失败的任务不计入已发送的数据量
+        """
+
+        with self.lock:
+            self.done += 1
+            self.failed += 0 if correct else 1
+            self.sent += size if correct else 0
+            elapsed = max(time.time() - self.start, 1e-6)
+            Client_log.info(
+                f"Progress: {self.done}/{self.files} tasks{f' ({self.failed} failed)' if self.failed else ''}, "
+                f"{self.sent / 1024 / 1024:.1f}/{self.size / 1024 / 1024:.1f} MB, {self.sent / 1024 / 1024 / elapsed:.1f} MB/s"
+            )
+
+
+def transfer(workers=scan_workers, order=scan_order):
+    """并发发送scanfile加入的任务
+    - workers 发送任务的线程数量
+    - order 发送顺序，见order_jobs
+    - 任务排好序后放入队列，线程依次取出任务，创建客户端发送，客户端在发送时才创建，不会同时占用大量端口
+    - 同一服务端同时进行的会话不超过server_sessions个
+    - 返回汇总进度的Progress对象，没有任务时返回None
+    """
+
+    jobs = order_jobs(job_list, order)
+    job_list.clear()
+    if not jobs:
+        return
+    queue = Queue()
+    for job in jobs:
+        queue.put(job)
+    progress = Progress(jobs)
+    Client_log.info(f"Send {len(jobs)} tasks of {progress.size} bytes with {min(workers, len(jobs))} workers")
+
+    def work():
+        while True:
+            try:
+                size, index, path, options = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                correct = Client(index, "Send", path, **options).start()
+            except Exception as e:
+                Client_log.err(f"Error occured while sending {path}: {e}")
+                correct = False
+            progress.finish(size, correct)
+
+    for _ in range(min(workers, len(jobs))):
+        t = Thread(target=work)
+        thread_list.append(t)
+        t.start()
+    return progress
 
 
 def draw(file):
@@ -459,9 +1122,13 @@ def summary(path):
     """总结函数
     - path 传输的相对路径的文件或文件夹
     - 对发送每个文件过程中的rwnd,cwnd,rto的变化过程绘制图表
+    - 失败或被拒绝、没有开始发送的文件没有记录数据，跳过
     """
 
     for file in file_list:
+        if not os.path.exists(f"{file}_data.log"):
+            Client_log.warning(f"No transfer data of {file}, skip drawing.")
+            continue
         draw(file)
 
 
@@ -473,20 +1140,51 @@ def main():
     - 接收命令行参数，创建进程传输文件
     """
 
-    if len(argv) != 3 or (argv[1] != "send" and argv[1] != "receive"):
-        print(f"usage: python3 {argv[0]} <send/receive> <file_name>")
+    if len(argv) not in range(3, 11) or (argv[1] != "send" and argv[1] != "receive"):
+        print(f"usage: python3 {argv[0]} <send/receive> <file_name> [{'/'.join(congestion_algorithms)}] [stripes] [delta] [fec] [pace] [{'/'.join(codecs)}[:level]] [bundle]")
         exit(0)
 
     command = argv[1]
     file = argv[2]
+    congestion = congestion_control
+    stripe = stripes
+    use_delta = delta
+    use_fec = fec
+    use_pacing = pacing
+    use_compression = compression
+    use_bundle = bundle
+    # 可选参数：阻塞控制算法名称，大文件并行发送的分段数量，delta表示使用增量发送，fec表示发送前向纠错的校验报文，pace表示按令牌桶控制发送节奏，
+    # 压缩算法名称（可加:级别）表示压缩传输，bundle表示把文件夹里的小文件打包发送
+    for arg in argv[3:]:
+        if arg.isdigit() and int(arg) > 0:
+            stripe = int(arg)
+        elif arg == "delta":
+            use_delta = True
+        elif arg == "fec":
+            use_fec = True
+        elif arg == "pace":
+            use_pacing = True
+        elif arg == "bundle":
+            use_bundle = True
+        elif arg.partition(":")[0] in codecs and arg.partition(":")[2] in ("", *map(str, range(10))):
+            use_compression = arg
+        elif arg in congestion_algorithms:
+            congestion = arg
+        else:
+            print(f"unknown congestion control {arg}, choose from {', '.join(congestion_algorithms)}")
+            exit(0)
     Client_log.info("Welcome to use Lanly's file transsport software!")
     if command == "send":
-        scanfile(file)
+        scanfile(file, congestion, stripe, use_delta, use_fec, use_compression, use_bundle, use_pacing)
+        progress = transfer()
         for i in thread_list:
             i.join()
         summary(file)
-    else:
-        Client(index, "Receive", file).start()
+        # 有任务失败时以非零状态退出
+        if progress is not None and progress.failed:
+            exit(1)
+    elif not Client(index, "Receive", file, congestion, compression=use_compression).start():
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from math import degrees
-from socket import AF_INET, SOCK_DGRAM, socket
+from socket import AF_INET, SOCK_DGRAM, SOL_SOCKET, socket
+from sys import argv
 from threading import *
-from random import randint
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process
+import asyncio
+from hmac import compare_digest
 from config.config import *
 from config.Logger import *
 from config.Receiver import *
 from config.Sender import *
 from config.util import *
+from config.Package import *
+from config.AsyncEngine import *
+from config.Delta import apply_delta, make_signature
+from config.Merkle import MerkleTree, received_tree, send_tree_steps
+from config.Compress import codecs, compress_file, compressible, parse_codec
+from config.Bundle import unpack_bundle
+from config.Ticket import encode_ticket, issue_ticket, issue_token, mask_codecs, open_ticket
+from config.Transport import size_buffers
+from config.Pmtu import answer_probe, dont_fragment
+from config.Steps import StepProtocol, call, recv, run, run_async
 
 # 用于sign和ip:port的一一映射，防止传输冲突
+# 每个工作进程各有一份，工作进程之间不共享：SO_REUSEPORT按客户端地址把请求分给工作进程，
+# 同一客户端的重发请求总是到达同一个进程，由这份表识别；不同进程中签名相同的会话使用各自的端口，互不干扰，
+# 只是来自另一个地址的重复签名不会被其他进程发现，不回复RESET
 used = {}
 
 
@@ -24,7 +39,7 @@ class Server(object):
     握手完毕后创建Sender类或者Receiver类发送或接受文件。
     """
 
-    def __init__(self, index, hostport, destaddr, sign, client_MSS):
+    def __init__(self, index, hostport, destaddr, sign, client_MSS, version=1, codecs=()):
         """初始化函数
 
         - index 服务进程编号，用于并发时区分不同进程
@@ -32,6 +47,8 @@ class Server(object):
         - destaddr 与进程通信的(ip, port)
         - sign 与进程通信时双方的签名，忽略签名不正确的包，防止干扰
         - client_MSS 客服端要求的握手包及之后数据传输包的数据段的最大大小
+        - version 与客户端协商的报文版本
+        - codecs 与客户端协商的双方都支持的压缩算法
         """
 
         self.log = Logger(f"Server {index}")
@@ -41,20 +58,61 @@ class Server(object):
         self.udpsocket = socket(AF_INET, SOCK_DGRAM)
         self.udpsocket.bind(("", self.hostport))
         self.udpsocket.settimeout(5)
+        dont_fragment(self.udpsocket)
         self.sign = sign
         self.num = startnum + 1
         self.MSS = client_MSS
-        self.package = Struct(f"!HHI{self.MSS}s")
+        self.version = version
+        self.package = Package(self.MSS, self.version)
         self.MSS_size = self.package.size
+        # 作为发送方时使用的阻塞控制算法，客户端可以在请求中指定
+        self.congestion = congestion_control
+        # 分段接收时整个文件的大小，不分段时为None
+        self.total = None
+        # 增量发送：客户端请求签名时的分块大小，是否在接收增量数据，请求合成文件时增量数据所在会话的签名
+        self.signature = None
+        self.delta = False
+        self.patch = None
+        # 增量发送的临时文件，传输结束后删除，或者接收完整时改名为keep
+        self.temp = None
+        self.keep = None
+        # 逐块检查：作为接收方时收到的Merkle树，作为发送方时计算的Merkle树，客户端是否请求了Merkle树
+        self.tree = None
+        self.merkle = False
+        self.codecs = list(codecs)
+        # 压缩传输：作为发送方时客户端请求的"算法:级别"，确定压缩后为算法，以及压缩后的数据大小
+        self.codec = None
+        self.stream = None
+        # 打包接收：是否在接收打包数据，完整接收后改名，等待客户端请求解开；请求解开时打包数据所在会话的签名
+        self.bundle = False
+        self.unbundle = None
+        # 直接发往hostport的握手请求由主进程收到，握手时不需要再接收
+        self.request = None
+        # 握手请求是否直接发往hostport（附上票据或hello），此时握手只需一次往返；hello时回复中还要签发票据
+        self.fast = False
+        self.hello = False
+        # 一次往返握手作为发送方时不等确认就开始发送，握手回复交给发送方，收到第一个ACK前超时时重发
+        self.preamble = None
+        # 一次往返握手时客户端的地址未经验证，还能发送的字节数，收到附上地址验证令牌的报文后为None，不再限制
+        self.budget = None
+        # 一次往返握手时在回复中签发的地址验证令牌，只有收到回复的客户端才能在之后的报文前附上
+        self.token = None
 
     def Shakehand(self):
-        """握手函数
+        """握手函数，阻塞地完成握手，流程见handshake"""
+
+        return run(self.handshake(), self.udpsocket, self.MSS_size)
+
+    def handshake(self):
+        """握手流程
         - 首先接收客户端请求是send还是receive
         - 然后判断自己的职责
         - 若自己为接收方，发送接收文件（如果有）的大小及md5码给客户端，接收客服端的请求（断点续传或重传），接收请求后创建receiver类接收文件
         - 若自己为发送方，接收客户端发来的发送文件（如果有）的大小及md5,比对自身文件，再询问客户端是否断点续传（如果已有数据一致）或重传，接收请求后创建send类发送文件
         - 若期间连续超时5次未收到包，则退出进程
         - 一次超时时间为5秒
+        - 握手写成生成器，接收报文和耗时的计算（md5码、压缩、Merkle树等）作为步骤交给驱动者，
+          线程版本由Shakehand阻塞地完成，asyncio版本由serve在事件循环中完成，见config.Steps
         """
 
         # 用于记录连续超时次数
@@ -62,7 +120,11 @@ class Server(object):
 
         while True:
             try:
-                raw, destaddr = self.udpsocket.recvfrom(self.MSS_size)
+                if self.request is not None:
+                    raw, destaddr = self.request, self.destaddr
+                    self.request = None
+                else:
+                    raw, destaddr = yield from recv()
                 # 更新客户端地址，由于对称型NAT的原因，向主进程发送的数据包的源地址和向该进程发送数据包的源地址可能会不同
                 self.destaddr = destaddr
                 try:
@@ -90,9 +152,60 @@ class Server(object):
                 self.rwnd = rwnd
                 if command == send_command:
                     self.identify = "Receive"
+                    # 客户端附上了Merkle树的[分块大小, 分块数量, 根]
+                    if len(info) == 5:
+                        self.tree = MerkleTree.from_info(info[2:])
+                # 分段发送，info为[整个文件大小, md5码, 区间起点, 区间终点, 区间的md5码]，旧客户端没有区间的md5码
+                elif command == stripe_command and len(info) in (4, 5):
+                    self.identify = "Receive"
+                    self.total = int(info[0])
+                # 压缩发送，info为[文件大小, md5码, 压缩算法, 压缩数据大小]
+                elif command == compress_command and len(info) == 4 and info[2] in self.codecs:
+                    self.identify = "Receive"
+                    self.codec = info[2]
+                    self.stream = info[3]
+                # 打包发送，info为[打包数据大小, md5码]，压缩时再附上[压缩算法, 压缩数据大小]
+                elif command == bundle_command and (len(info) == 2 or len(info) == 4 and info[2] in self.codecs):
+                    self.identify = "Receive"
+                    self.bundle = True
+                    if len(info) == 4:
+                        self.codec = info[2]
+                        self.stream = info[3]
+                # 分段发送完毕，检查整个文件，info为[整个文件大小, md5码, 各段会话的签名...]
+                elif command == verify_command:
+                    self.identify = "Verify"
+                # 增量发送，请求服务端已有文件的签名，info为[分块大小, 阻塞控制算法]
+                elif command == signature_command and len(info) == 2:
+                    self.identify = "Send"
+                    self.rwnd = default_rwnd
+                    self.signature = int(info[0])
+                    self.congestion = info[1]
+                    # 客户端没有签名文件，从头发送
+                    self.Client_fileinfo = ["0", "0"]
+                # 增量发送，发送增量数据，info为[文件大小, md5码, 增量数据大小, 增量数据md5码]
+                elif command == delta_command and len(info) == 4:
+                    self.identify = "Receive"
+                    self.delta = True
+                # 增量数据发送完毕，合成并检查文件，info为[文件大小, md5码, 增量数据所在会话的签名]
+                elif command == patch_command and len(info) == 3:
+                    self.identify = "Verify"
+                    self.patch = info[2]
+                # 打包数据发送完毕，解开到文件夹，info为[打包数据大小, md5码, 打包数据所在会话的签名]
+                elif command == unpack_command and len(info) == 3:
+                    self.identify = "Verify"
+                    self.unbundle = info[2]
                 elif command == receive_command:
                     self.identify = "Send"
                     self.rwnd = default_rwnd
+                    # 客户端可以指定发送时使用的阻塞控制算法
+                    if len(info) > 2:
+                        self.congestion = info[2]
+                    # 客户端请求逐块检查
+                    if len(info) > 3 and info[3] == "1":
+                        self.merkle = True
+                    # 客户端请求压缩传输
+                    if len(info) > 4 and parse_codec(info[4])[0] in self.codecs:
+                        self.codec = info[4]
                 # 无法解析的请求
                 else:
                     self.log.warning(
@@ -119,32 +232,62 @@ class Server(object):
 
         # 收到请求，判断服务端身份
         if self.identify == "Send":
-            info = check_fileinfo(self.file, self.Client_fileinfo)
+            # 增量发送时计算已有文件的签名，把签名发送给客户端
+            if self.signature is not None and os.path.isfile(self.file):
+                self.log.info(f"make signature of {self.file} with {self.signature} bytes blocks")
+                self.temp = f"{self.file}.{self.sign}.sig"
+                yield from call(make_signature, self.file, self.temp, self.signature)
+                self.origin = self.file
+                self.file = self.temp
+            # 客户端请求逐块检查且不压缩时先计算Merkle树，同时计算的整个文件的md5码写入缓存，之后比对和获取文件信息不需要再读文件
+            if self.merkle and self.codec is None and os.path.isfile(self.file):
+                self.tree = yield from call(MerkleTree.build, self.file, self.package.MSS)
+            info = yield from call(check_fileinfo, self.file, self.Client_fileinfo)
             # 如果服务端找不到该文件，则无法发送，返回File not Found
             if info == FILENOTFOUND:
                 self.log.err(f"File not found: {self.file}, aborted.")
-                self.udpsocket.sendto(
-                    self.package.pack(self.sign, self.rwnd, self.num, FILENOTFOUND),
-                    self.destaddr,
+                self.reply(
+                    self.package.pack(self.sign, self.rwnd, self.num, spliter.join([*self.greeting(), FILENOTFOUND]).encode())
                 )
                 return False
-            self.fileinfo = get_fileinfo(self.file)
+            self.fileinfo = yield from call(get_fileinfo, self.file)
             self.filesize = int(self.fileinfo[0])
+            # 客户端请求压缩时，数据可压缩且客户端不能续传则压缩，在回复中附上[压缩算法, 压缩数据大小]
+            if self.codec is not None:
+                yield from call(self.compress, info)
+            # 客户端请求逐块检查时，在回复中附上Merkle树的[分块大小, 分块数量, 根]，压缩传输时不逐块检查
+            if self.merkle and self.codec is None and self.tree is None:
+                self.tree = yield from call(MerkleTree.build, self.file, self.package.MSS)
             # 制作回复报文，如果数据一致，询问是否断点续传，否则就说重传
             pkg = self.package.pack(
                 self.sign,
                 self.rwnd,
                 self.num,
-                spliter.join([cosend if info == cosend else resend, *self.fileinfo]).encode(),
+                spliter.join([
+                    *self.greeting(),
+                    cosend if info == cosend else resend,
+                    *self.fileinfo,
+                    *(self.tree.info() if self.tree is not None else []),
+                    *([self.codec, str(self.stream)] if self.codec is not None else []),
+                ]).encode(),
             )
 
-            while True:
+            # 一次往返握手：客户端没有可以续传的数据时不需要等待确认，发出回复后直接开始发送，
+            # 客户端的地址验证前发送的数据受限制，见config.amplification_limit
+            # 逐块检查时叶子分页较多，仍等待客户端确认后再发送
+            if self.fast and info != cosend and self.tree is None:
+                self.log.info(f"sending the handshake package, starting sending without confirmation")
+                self.reply(pkg)
+                self.offset = 0
+                self.num += 1
+                self.preamble = pkg
+            while self.preamble is None:
 
                 try:
                     self.log.info(
                         f"sending the first handshake package{',file already exist! Asking continuing send or not' if info else ''}"
                     )
-                    self.udpsocket.sendto(pkg, self.destaddr)
+                    self.reply(pkg)
                 except Exception as e:
                     self.log.err(
                         f"Error occured while handling sending in shakehand: {e}, aborted."
@@ -152,7 +295,7 @@ class Server(object):
                     return False
 
                 try:
-                    raw, destaddr = self.udpsocket.recvfrom(self.MSS_size)
+                    raw, destaddr = yield from recv()
                     try:
                         sign, rwnd, num, data = self.package.unpack(raw)
                     except Exception as e:
@@ -160,7 +303,7 @@ class Server(object):
                             f"Unable to unpack received package due to the error : {e}, droped."
                         )
                         continue
-                    data = data.decode().strip(b"\x00".decode())
+                    data = self.validate(data).decode().strip(b"\x00".decode())
                     if sign != self.sign or num != self.num:
                         self.log.warning(
                             f"got an uncorrect message, Expected sign num : {self.sign} {self.num}, but got {sign} {num}, droped and resending."
@@ -198,28 +341,53 @@ class Server(object):
                     self.log.err(f"Error occure while shanking: {e}, aborted.")
                     return False
 
+            # 开始发送前把Merkle树的叶子发给客户端
+            if self.tree is not None:
+                yield from send_tree_steps(self.tree, self.udpsocket, self.package, self.sign, self.destaddr, self.log)
             return True
 
         elif self.identify == "Receive":
-            info = get_fileinfo(self.file)
             # 接收文件，发送客户端服务器上相关文件的信息，如果文件不存在则info=['0', '0']
+            # 分段接收、增量接收、压缩接收和打包接收不支持续传，不需要计算文件信息
+            resumable = self.total is None and not self.delta and self.codec is None and not self.bundle
+            info = (yield from call(get_fileinfo, self.file)) if resumable else ["0", "0"]
             pkg = self.package.pack(
-                self.sign, self.rwnd, self.num, spliter.join([*info]).encode()
+                self.sign, self.rwnd, self.num, spliter.join([*self.greeting(), *info]).encode()
             )
             self.num += 1
             cnt = 0
             self.filesize = self.Client_fileinfo[0]
             self.filemd5 = self.Client_fileinfo[1]
+            # 分段接收文件的[起点, 终点)区间，收完后用区间的md5码检查
+            if self.total is not None:
+                self.filesize = self.Client_fileinfo[3]
+                self.filemd5 = self.Client_fileinfo[4] if len(self.Client_fileinfo) == 5 else None
+            # 增量接收时接收的是增量数据，完整接收后改名，等待客户端请求合成文件
+            if self.delta:
+                self.filesize = self.Client_fileinfo[2]
+                self.filemd5 = self.Client_fileinfo[3]
+                self.keep = f"{self.file}.{self.sign}.delta"
+                self.temp = f"{self.keep}.part"
+                self.file = self.temp
+            # 打包接收时先接收到临时文件，完整接收后改名，等待客户端请求解开到文件夹
+            if self.bundle:
+                self.keep = f"{self.file}.{self.sign}.bundle"
+                self.temp = f"{self.keep}.part"
+                self.file = self.temp
 
             # 记录当前状态，由于握手有两次
             status = 0
+            # 收到Merkle树的分页后不重发握手报文
+            quiet = False
             while True:
 
                 try:
-                    self.log.info(
-                        f"sending {'ACK ' if status == 1 else ''}handshake package {self.num}{', file already exist! Asking continuing send or not' if info[0] != str(0) and status == 0 else ''} to {self.destaddr} "
-                    )
-                    self.udpsocket.sendto(pkg, self.destaddr)
+                    if not quiet:
+                        self.log.info(
+                            f"sending {'ACK ' if status == 1 else ''}handshake package {self.num}{', file already exist! Asking continuing send or not' if info[0] != str(0) and status == 0 else ''} to {self.destaddr} "
+                        )
+                        self.reply(pkg)
+                    quiet = False
                 except Exception as e:
                     self.log.err(
                         f"Error occured while handling sending in shakehand: {e}, aborted."
@@ -227,7 +395,7 @@ class Server(object):
                     return False
 
                 try:
-                    raw, destaddr = self.udpsocket.recvfrom(self.MSS_size)
+                    raw, destaddr = yield from recv()
                     try:
                         sign, rwnd, num, data = self.package.unpack(raw)
                     except Exception as e:
@@ -235,6 +403,19 @@ class Server(object):
                             f"Unable to unpack received package due to the error : {e}, droped."
                         )
                         continue
+                    # 客户端在开始发送前发来Merkle树的叶子分页，序号为页号，回复后继续等待数据
+                    if sign == self.sign and rwnd == TREE_PAGE and self.tree is not None:
+                        self.tree.accept(num, data, self.package.MSS)
+                        self.udpsocket.sendto(self.package.pack(self.sign, TREE_PAGE, num, b""), self.destaddr)
+                        quiet = True
+                        continue
+                    # 一次往返握手：客户端不需要续传时不发送确认，直接发送数据，收到下一个序号的报文即从头接收
+                    if status == 0 and self.fast and sign == self.sign and num == self.num + 1:
+                        self.offset = int(self.Client_fileinfo[2]) if self.total is not None else 0
+                        self.log.info(f"got the data without confirmation, starting receiving......")
+                        self.num += 1
+                        self.data = raw
+                        break
                     if sign != self.sign or num != self.num:
                         self.log.warning(
                             f"got an uncorrect message, Expected sign num : {self.sign} {self.num}, but got {sign} {num}, droped and resending."
@@ -245,7 +426,7 @@ class Server(object):
                         self.log.info(f"got the data, starting receiving......")
                         self.data = raw
                         break
-                    ans = data.decode().strip(b"\x00".decode())
+                    ans = self.validate(data).decode().strip(b"\x00".decode())
                     if ans == resend:
                         self.offset = 0
                     elif ans == cosend:
@@ -253,6 +434,8 @@ class Server(object):
                     else:
                         self.log.warning(f"Unknown respond: {ans}, droping......")
                         continue
+                    if self.total is not None:
+                        self.offset = int(self.Client_fileinfo[2])
                     self.log.info(
                         f"got the respond, {'(over)write' if ans == resend else 'continuing sending'} {self.file}"
                     )
@@ -283,22 +466,199 @@ class Server(object):
                     # return False
             return True
 
+        elif self.identify == "Verify":
+            # 检查客户端分段发送的文件，合成增量发送的文件，或者解开打包数据，回复结果，客户端没收到回复会重发请求，直到一段时间没有请求再结束
+            if self.patch is not None:
+                ans = yield from call(self.apply_patch)
+            elif self.unbundle is not None:
+                ans = yield from call(self.unpack)
+            else:
+                ans = yield from call(self.check_stripes)
+            self.log.info(f"verify {self.file}: {'CORRECT' if ans == cosend else 'UNCORRECT'}")
+            pkg = self.package.pack(self.sign, self.rwnd, self.num, spliter.join([*self.greeting(), ans]).encode())
+            while True:
+                self.reply(pkg)
+                try:
+                    yield from recv()
+                except timeout:
+                    break
+            return True
+
         else:
             self.log.err(f"Unreachable error while shanking, aborted.")
 
-    def start(self):
-        """启动函数
-        先进行握手，握手成功就开始传输或接收文件，否则退出
+    def greeting(self):
+        """一次往返握手时在回复前附上地址验证令牌，hello握手时还有双方都支持的压缩算法和签发的会话票据"""
+
+        if not self.fast:
+            return []
+        if not self.hello:
+            return [encode_ticket(self.token)]
+        return [
+            encode_ticket(self.token),
+            ",".join(self.codecs),
+            issue_ticket(ticket_key, self.MSS, self.version, self.codecs, self.destaddr[0]),
+        ]
+
+    def validate(self, data):
+        """客户端的确认报文前附上了回复中签发的令牌时，客户端收到了回复，地址得到验证，不再限制发送
+        - 只凭源地址不能验证，伪造源地址的报文也能发往新端口
+        - 返回去掉令牌的数据段
         """
 
-        global used
-        # 如果握手失败，终止此次处理
-        if self.Shakehand() == False:
-            used.pop(self.sign)
+        if self.token is not None and compare_digest(data[:token_size], self.token):
+            self.budget = None
+            return data[token_size:]
+        return data
+
+    def reply(self, pkg):
+        """发送握手报文，客户端的地址未经验证时超出发送额度的报文不发送，直到握手超时"""
+
+        if self.budget is not None:
+            if len(pkg) > self.budget:
+                self.log.warning(f"{self.destaddr} is not validated, holding the handshake package.")
+                return
+            self.budget -= len(pkg)
+        self.udpsocket.sendto(pkg, self.destaddr)
+
+    def compress(self, info):
+        """作为发送方时压缩要发送的文件
+        - info 与客户端已有文件比对的结果，可以续传时不压缩
+        - 取样判断数据不可压缩时不压缩
+        - 压缩后的数据写入临时文件，发送完毕后删除
+        """
+
+        name, level = parse_codec(self.codec)
+        self.codec = None
+        if info == cosend or not compressible(self.file, name, level):
+            self.log.info(f"Send {self.file} without compression")
             return
-        self.log.info(f"Finish shakehand! Start {self.identify} {self.file}.....")
+        self.temp = f"{self.file}.{self.sign}.z"
+        self.stream = compress_file(self.file, self.temp, name, level)
+        self.log.info(f"Compress {self.file} with {name} level {level}: {self.stream}/{self.filesize} bytes")
+        self.codec = name
+        self.origin = self.file
+        self.file = self.temp
+        self.filesize = self.stream
+
+    def apply_patch(self):
+        """用客户端发来的增量数据和已有文件合成新文件
+        - 增量数据由另一个会话接收，完整接收后才会改名，最多等待time_limit秒
+        - 合成的文件md5码正确时替换原文件，返回cosend，否则返回resend
+        """
+
+        delta = f"{self.file}.{self.patch}.delta"
+        out = f"{self.file}.{self.patch}.new"
+        for _ in range(time_limit * 10):
+            if os.path.exists(delta):
+                break
+            time.sleep(0.1)
+        else:
+            self.log.warning(f"Delta of {self.file} not found.")
+            return resend
+        md5 = None
+        try:
+            md5 = apply_delta(self.file, delta, out)
+        except Exception as e:
+            self.log.warning(f"Unable to apply delta due to the error : {e}.")
+        finally:
+            os.remove(delta)
+        if md5 != self.Client_fileinfo[1]:
+            if os.path.exists(out):
+                os.remove(out)
+            return resend
+        os.replace(out, self.file)
+        if md5_cache is not None:
+            md5_cache.put(self.file, md5)
+        return cosend
+
+    def check_stripes(self):
+        """检查分段发送的整个文件
+        - 客户端附上了各段会话的签名时，各段都检查通过、区间互不重叠且正好覆盖整个文件时，不需要重新读整个文件
+        - 各段会话收尾需要时间，最多等待time_limit秒
+        - 有分段没有检查通过的记录（检查不通过或者旧客户端没有附上区间的md5码），或者区间与客户端声明的文件大小对不上时，计算整个文件的md5码
+        """
+
+        marks = [f"{self.file}.{sign}.stripe" for sign in self.Client_fileinfo[2:]]
+        for _ in range(time_limit * 10):
+            if all(os.path.exists(mark) for mark in marks):
+                break
+            time.sleep(0.1)
+        found = [mark for mark in marks if os.path.exists(mark)]
+        ranges = []
+        for mark in found:
+            with open(mark, "r") as f:
+                ranges.append(f.read().split())
+            os.remove(mark)
+        if marks and len(found) == len(marks) and self.covered(ranges, int(self.Client_fileinfo[0])):
+            if md5_cache is not None:
+                md5_cache.put(self.file, self.Client_fileinfo[1])
+            return cosend
+        return check_fileinfo(self.file, self.Client_fileinfo[:2])
+
+    def covered(self, ranges, size):
+        """各段检查通过的区间[起点, 终点, 整个文件大小]是否互不重叠、正好覆盖[0, size)，且文件大小都是size"""
+
+        try:
+            ranges = sorted((int(start), int(end), int(total)) for start, end, total in ranges)
+        except ValueError:
+            return False
+        end = 0
+        for start, stop, total in ranges:
+            if start != end or stop <= start or total != size:
+                return False
+            end = stop
+        return end == size and os.path.getsize(self.file) == size
+
+    def cleanup(self, worker=None):
+        """处理增量发送、压缩发送和打包接收的临时文件
+        - worker 完成传输的发送或接收对象，握手失败时为None
+        - 签名和压缩数据发送完毕后删除，增量数据和打包数据完整接收后改名，否则删除
+        - 分段接收的区间检查通过时留下记录[起点, 终点, 整个文件大小]，由客户端最后请求检查整个文件时使用
+        """
+
+        if self.total is not None and worker is not None and worker.correct:
+            with open(f"{self.file}.{self.sign}.stripe", "w") as f:
+                f.write(f"{worker.offset} {worker.file_size} {worker.total}")
+        if self.temp is None or not os.path.exists(self.temp):
+            return
+        if self.keep is not None and worker is not None and worker.correct:
+            os.replace(self.temp, self.keep)
+            return
+        os.remove(self.temp)
+
+    def unpack(self):
+        """把客户端打包发送的数据解开到客户端请求的文件夹
+        - 打包数据由另一个会话接收，完整接收后才会改名，最多等待time_limit秒
+        - 解开成功时返回cosend，否则返回resend，回复给客户端
+        """
+
+        bundle = f"{self.file}.{self.unbundle}.bundle"
+        for _ in range(time_limit * 10):
+            if os.path.exists(bundle):
+                break
+            time.sleep(0.1)
+        else:
+            self.log.warning(f"Bundle of {self.file} not found.")
+            return resend
+        try:
+            count = unpack_bundle(bundle, self.file)
+            self.log.info(f"Unpack {count} files into {self.file}")
+            return cosend
+        except Exception as e:
+            self.log.err(f"Unable to unpack {self.file} due to the error : {e}.")
+            return resend
+        finally:
+            os.remove(bundle)
+
+    def worker(self, sender=Sender, receiver=Receiver):
+        """创建发送或接收文件的对象
+        - sender/receiver 使用的发送类和接收类，线程版本或asyncio版本
+        - 身份不明时返回None
+        """
+
         if self.identify == "Send":
-            Sender(
+            worker = sender(
                 self.destaddr,
                 self.sign,
                 self.file,
@@ -308,10 +668,19 @@ class Server(object):
                 self.num,
                 self.log,
                 self.MSS,
-                self.filesize
-            ).start()
+                self.filesize,
+                self.version,
+                self.congestion
+            )
+            # 发送签名或压缩数据时的数据以原文件命名
+            if self.temp is not None:
+                worker.datalog = f"{self.origin}_data.log"
+            worker.preamble = self.preamble
+            worker.budget = self.budget
+            worker.token = self.token
+            return worker
         elif self.identify == "Receive":
-            Receiver(
+            return receiver(
                 self.destaddr,
                 self.sign,
                 self.file,
@@ -322,70 +691,337 @@ class Server(object):
                 self.log,
                 self.MSS,
                 self.filesize,
-                self.filemd5
-            ).start()
-        else:
+                self.filemd5,
+                self.version,
+                self.total,
+                received_tree(self.tree, self.log),
+                self.codec,
+                self.stream
+            )
+        return None
+
+    def start(self):
+        """启动函数
+        先进行握手，握手成功就开始传输或接收文件，否则退出
+        """
+
+        global used
+        # 如果握手失败，终止此次处理
+        if self.Shakehand() == False or self.identify == "Verify":
+            self.cleanup()
+            used.pop(self.sign)
+            return
+        self.log.info(f"Finish shakehand! Start {self.identify} {self.file}.....")
+        worker = self.worker()
+        if worker is None:
             self.log.err(f"Unreachable error while starting send/receice job")
             used.pop(self.sign)
             return
+        worker.start()
+        self.cleanup(worker)
         self.log.info(f"{self.identify} {self.file} Finished!")
         used.pop(self.sign)
 
+    async def serve(self, executor=None):
+        """在事件循环中处理这个请求
+        - executor 执行握手中耗时计算的线程池
+        - 握手由StepProtocol接收报文，在事件循环中完成
+        - 握手成功后把transport交给asyncio版本的发送类或接收类，在事件循环中传输
+        """
+
+        global used
+        loop = asyncio.get_running_loop()
+        limit = self.udpsocket.gettimeout()
+        transport = None
+        try:
+            transport, protocol = await loop.create_datagram_endpoint(StepProtocol, sock=self.udpsocket)
+            if await run_async(self.handshake(), protocol, limit, executor) == False or self.identify == "Verify":
+                self.cleanup()
+                return
+            self.log.info(f"Finish shakehand! Start {self.identify} {self.file}.....")
+            worker = self.worker(AsyncSender, AsyncReceiver)
+            if worker is None:
+                self.log.err(f"Unreachable error while starting send/receice job")
+                return
+            # transport交给发送类或接收类，由它关闭
+            transport = None
+            await worker.run(protocol.transport, protocol.pending)
+            # 处理临时文件涉及磁盘操作，放在线程池中完成
+            await loop.run_in_executor(executor, self.cleanup, worker)
+            self.log.info(f"{self.identify} {self.file} Finished!")
+        except Exception as e:
+            self.log.err(f"Error occurred while serving {self.destaddr}: {e}")
+        finally:
+            if transport is not None:
+                transport.close()
+            used.pop(self.sign)
+
 
 # 主服务端log
 Server_log = Logger("Serverd")
 
 
-if __name__ == "__main__":
-    """主函数
-    - 一个服务进程监听hostport端口(定义在config.config)
-    - 如果收到请求，则创建一个新进程处理该请求，并回复该进程监听的端口号
-    - 以达到高并发处理
+# 服务进程编号，多个工作进程时各自从不同的编号开始，间隔为工作进程数量
+index = 1
+# 当前工作进程的编号和工作进程的数量
+worker_id = 0
+worker_count = 1
+# 签发会话票据的密钥，所有工作进程共用
+ticket_key = os.urandom(16)
+
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    # Windows等系统不支持，只能使用一个工作进程
+    SO_REUSEPORT = None
+
+
+def accept(data, destaddr, sendto):
+    """处理发往hostport的端口请求
+    - data 收到的请求报文
+    - destaddr 客户端(ip, port)
+    - sendto 回复报文的函数
+    - 为请求分配一个端口并回复端口号，返回在该端口上处理请求的Server，无需处理时返回None
+    - 不是端口请求长度的报文为直接发来的握手请求，见resume
     """
-    Server_log.info("Welcome to use Lanly's file transsport software!")
+
+    if len(data) != reMSS_size:
+        return resume(data, destaddr, sendto)
+    try:
+        sign, rwnd, num, data = repackage.unpack(data)
+    except Exception as e:
+        Server_log.warning(
+            f"Unable to unpack received package due to the error : {e}, droped."
+        )
+        return None
+    # 请求内容为REQUESTPORT, MSS，新版本的客户端还会附上支持的最高报文版本，以及支持的压缩算法
+    data, client_MSS, *client_version = data.decode().strip(b"\x00".decode()).split(spliter)
+    version = min(int(client_version[0]), wire_version) if client_version else 1
+    common = [codec for codec in client_version[1].split(",") if codec in codecs] if len(client_version) > 1 else None
+    # 如果签名重复，且不是对应ip,则发送重置报文，如果ip是对应的，那么已有进程处理该ip,故此处就忽略
+    if sign in used or num != startnum:
+        Server_log.warning(
+            f"receiving an {'duplicated sign' if sign in used else 'uncorrect'} message from {destaddr}, droping."
+        )
+        if sign in used and used[sign] != destaddr:
+            sendto(
+                repackage.pack(sign, rwnd, num, RESET.encode()), destaddr
+            )
+        return None
+    used[sign] = destaddr
+    Server_log.info(
+        f"receiving a request from {destaddr}, deliver a port {startport} for it. {destaddr}"
+    )
+    # 回复报文，包括新进程的端口号，以及协商的报文版本（旧版本的客户端只接收端口号），
+    # 支持压缩协商的客户端还会收到双方都支持的压缩算法和会话票据
+    reply = spliter.join([str(startport), str(version)]) if client_version else str(startport)
+    if common is not None:
+        reply = spliter.join([reply, ",".join(common), issue_ticket(ticket_key, client_MSS, version, common, destaddr[0])])
+    sendto(
+        repackage.pack(sign, rwnd, num, reply.encode()), destaddr
+    )
+    return allocate(destaddr, sign, client_MSS, version, common or ())
+
+
+def resume(data, destaddr, sendto):
+    """处理直接发往hostport的握手请求（0-RTT）
+    - data 前缀和握手请求报文，前缀为会话票据，或客户端的参数（hello）
+    - 票据有效时按票据中协商过的参数直接创建Server，hello时按客户端的参数创建Server并在回复中签发票据
+    - 握手请求交给Server处理，由Server从新端口回复
+    - 客户端没收到回复时会重发请求，已有进程处理的请求忽略
+    - 票据绑定签发时客户端的ip，从其他ip发来的票据视为伪造
+    - 客户端的地址未经验证，Server在收到客户端发往新端口的报文前最多发送请求长度的amplification_limit倍的数据
+    - 只有经过认证的票据过期或者报文版本不再支持时回复RESET，客户端重新获取端口
+    - 格式不对的报文、伪造的票据、不支持客户端报文版本的hello都不回复，避免服务端被用来向伪造的源地址反射报文，
+      hello没有回复时客户端超时后重新获取端口
+    - 路径MTU探测报文附上有效的探测令牌时原样回显，请求令牌时回复令牌，见config.Pmtu.answer_probe
+    """
+
+    if len(data) < opening_kind.size:
+        return None
+    received = len(data)
+    (kind,) = opening_kind.unpack_from(data)
+    if kind == opening_probe:
+        answer = answer_probe(ticket_key, data, destaddr[0])
+        if answer is not None:
+            sendto(answer, destaddr)
+        return None
+    data = data[opening_kind.size :]
+    if kind == opening_ticket:
+        ticket = open_ticket(ticket_key, data[:ticket_size], destaddr[0])
+        if ticket is None:
+            return None
+        client_MSS, version, common, expired = ticket
+        if expired or version > wire_version:
+            Server_log.warning(
+                f"receiving an {'expired' if expired else 'unsupported'} session ticket from {destaddr}, rejected."
+            )
+            sendto(repackage.pack(0, 0, startnum, RESET.encode()), destaddr)
+            return None
+        request = data[ticket_size:]
+    elif kind == opening_hello and len(data) >= hello_body.size:
+        client_MSS, version, mask = hello_body.unpack_from(data)
+        if version > wire_version:
+            return None
+        common = [codec for codec in mask_codecs(mask) if codec in codecs]
+        request = data[hello_body.size :]
+    else:
+        return None
+    try:
+        sign, rwnd, num, _ = Package(client_MSS, version).unpack(request)
+    except Exception as e:
+        Server_log.warning(
+            f"Unable to unpack received package due to the error : {e}, droped."
+        )
+        return None
+    # 签名重复时只回复经过认证的票据，客户端重新获取端口
+    if sign in used or num != startnum + 1:
+        if kind == opening_ticket and sign in used and used[sign] != destaddr:
+            sendto(repackage.pack(0, 0, startnum, RESET.encode()), destaddr)
+        return None
+    used[sign] = destaddr
+    Server_log.info(
+        f"receiving a request with {'session ticket' if kind == opening_ticket else 'hello'} from {destaddr}, deliver a port {startport} for it."
+    )
+    server = allocate(destaddr, sign, client_MSS, version, common)
+    server.request = request
+    server.fast = True
+    server.hello = kind == opening_hello
+    server.budget = amplification_limit * received
+    server.token = issue_token(ticket_key, f"{destaddr[0]}:{sign}")
+    return server
+
+
+def allocate(destaddr, sign, client_MSS, version, common):
+    """在下一个端口上创建处理请求的Server"""
+
+    global index, startport
+    server = Server(index, startport, destaddr, sign, client_MSS, version, common)
+    # 各工作进程分配的端口交错，互不冲突
+    index += worker_count
+    startport += gapport * worker_count
+    # 避免端口号不合法
+    if startport > 65535:
+        startport = 10001 + gapport * worker_id
+    return server
+
+
+def listen():
+    """创建监听hostport的socket
+    - 多个工作进程时每个进程都用SO_REUSEPORT绑定hostport，由内核按客户端地址把请求分给各个进程
+    - 同一个客户端的重发请求总是到达同一个进程
+    """
+
     udp = socket(AF_INET, SOCK_DGRAM)
-    index = 1
+    if worker_count > 1:
+        udp.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     udp.bind(("", hostport))
+    # 回显的探测报文也不能分片，否则反方向的路径MTU更小时仍会收到回显
+    dont_fragment(udp)
+    # 容纳目录并发发送时一起到达的请求和探测报文
+    size_buffers(udp, scan_workers * request_size)
+    return udp
+
+
+def serve_thread():
+    """线程版本：每个请求创建一个线程处理"""
+
+    udp = listen()
     Server_log.info(f"Start service, listening to port {hostport}......")
     destaddr = ""
     while True:
         try:
-            data, destaddr = udp.recvfrom(reMSS_size)
-            try:
-                sign, rwnd, num, data = repackage.unpack(data)
-            except Exception as e:
-                Server_log.warning(
-                    f"Unable to unpack received package due to the error : {e}, droped."
-                )
-                continue
-            data, client_MSS = data.decode().strip(b"\x00".decode()).split(spliter)
-            # 如果签名重复，且不是对应ip,则发送重置报文，如果ip是对应的，那么已有进程处理该ip,故此处就忽略
-            if sign in used or num != startnum:
-                Server_log.warning(
-                    f"receiving an {'duplicated sign' if sign in used else 'uncorrect'} message from {destaddr}, droping."
-                )
-                if used[sign] != destaddr:
-                    udp.sendto(
-                        repackage.pack(sign, rwnd, num, RESET.encode()), destaddr
-                    )
-                continue
-            used[sign] = destaddr
-            Server_log.info(
-                f"receiving a request from {destaddr}, deliver a port {startport} for it. {destaddr}"
-            )
-            # 回复报文，包括新进程的端口号
-            udp.sendto(
-                repackage.pack(sign, rwnd, num, str(startport).encode()), destaddr
+            data, destaddr = udp.recvfrom(request_size)
+            server = accept(data, destaddr, udp.sendto)
+            if server is not None:
+                Thread(target=server.start).start()
+        except Exception as e:
+            Server_log.err(
+                f"Error occurred while handing the message from {destaddr} : {e}"
             )
-            Thread(
-                target=Server(index, startport, destaddr, sign, client_MSS).start
-            ).start()
-            index += 1
-            startport += gapport
-            # 避免端口号不合法
-            if startport > 65535:
-                startport = 10001
+
+
+class Dispatcher(asyncio.DatagramProtocol):
+    """asyncio版本：在hostport上接收端口请求，每个请求作为一个任务在同一个事件循环中处理"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        # 握手中耗时的计算在线程池中完成
+        self.executor = ThreadPoolExecutor(max_workers=handshake_workers)
+        # 保存任务的引用，防止任务被回收
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, destaddr):
+        try:
+            server = accept(data, destaddr, self.transport.sendto)
+            if server is not None:
+                task = self.loop.create_task(server.serve(self.executor))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
         except Exception as e:
             Server_log.err(
                 f"Error occurred while handing the message from {destaddr} : {e}"
             )
+
+
+async def serve_async():
+    """asyncio版本：一个事件循环处理所有传输"""
+
+    loop = asyncio.get_running_loop()
+    udp = listen()
+    await loop.create_datagram_endpoint(Dispatcher, sock=udp)
+    Server_log.info(f"Start service, listening to port {hostport}......")
+    await loop.create_future()
+
+
+def run_worker(worker, workers, engine, key):
+    """工作进程
+    - worker 工作进程编号
+    - workers 工作进程数量
+    - engine 服务方式，thread或asyncio
+    - key 签发会话票据的密钥，由主进程生成，各工作进程签发的票据互相通用
+    """
+
+    global index, startport, worker_id, worker_count, Server_log, ticket_key
+    worker_id = worker
+    worker_count = workers
+    ticket_key = key
+    index += worker
+    startport += gapport * worker
+    if workers > 1:
+        Server_log = Logger(f"Serverd {worker}")
+    if engine == "asyncio":
+        asyncio.run(serve_async())
+    else:
+        serve_thread()
+
+
+if __name__ == "__main__":
+    """主函数
+    - 预先创建多个工作进程（默认为CPU核数，见config.server_workers），每个进程都监听hostport端口(定义在config.config)，由内核分配请求
+    - 工作进程收到请求，则创建一个新线程（或asyncio任务）处理该请求，并回复该线程监听的端口号
+    - 以达到高并发处理，传输不再共用一个GIL
+    - 可选参数指定服务方式：thread（默认，见config.server_engine）或asyncio，以及工作进程数量
+    """
+    engine = argv[1] if len(argv) > 1 else server_engine
+    if engine not in ("thread", "asyncio") or (len(argv) > 2 and not argv[2].isdigit()):
+        print(f"usage: python3 {argv[0]} [thread/asyncio] [workers]")
+        exit(0)
+    workers = int(argv[2]) if len(argv) > 2 else server_workers
+    workers = workers or os.cpu_count() or 1
+    if SO_REUSEPORT is None:
+        workers = 1
+    Server_log.info("Welcome to use Lanly's file transsport software!")
+    if workers == 1:
+        run_worker(0, 1, engine, ticket_key)
+    else:
+        Server_log.info(f"Start {workers} workers......")
+        processes = [Process(target=run_worker, args=(i, workers, engine, ticket_key)) for i in range(workers)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import time
+from .config import *
+from .Sender import Sender
+from .Receiver import Receiver
+
+
+class AsyncSender(Sender, asyncio.DatagramProtocol):
+    """asyncio版本的发送类
+    - 与Sender共用发送、ACK处理、阻塞控制、重传的逻辑，由事件循环驱动，不创建线程
+    - 收到ACK时在datagram_received中处理，然后继续填满窗口
+    - RTO、询问rwnd、pacing的等待都用事件循环的定时器实现
+    - 调用run()协程完成一次传输，一个事件循环可以同时运行大量传输
+    """
+
+    io_backend = "loop"
+
+    def __init__(self, *args, **kwargs):
+        """参数与Sender相同"""
+
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.transport = None
+        # 传输结束时完成的future
+        self.done = None
+        # RTO定时器、询问rwnd的定时器、pacing等待令牌的定时器
+        self.timer = None
+        self.prober = None
+        self.pacing_timer = None
+
+    async def run(self, transport=None, pending=()):
+        """完成一次传输
+        - transport 握手时使用的transport，交给这里继续使用，None时把udpsocket交给事件循环
+        - pending 握手结束时还没处理的报文，开始发送后处理
+        - 映射文件，发出第一个窗口后等待ACK驱动的状态机结束
+        - 执行summary函数，保存数据
+        """
+
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        self.open_file()
+        self.status = status.SLOW_START
+        self.transport = await attach(self, transport)
+        self.io.transport = self.transport
+        self.log.info("----------------Sending start----------------")
+        try:
+            self.advance()
+            for data, addr in list(pending):
+                self.datagram_received(data, addr)
+            await self.done
+        finally:
+            for timer in (self.timer, self.prober, self.pacing_timer):
+                if timer is not None:
+                    timer.cancel()
+            self.transport.close()
+            self.close_file()
+        self.log.info("----------------Sending complete----------------")
+        self.summary()
+
+    def datagram_received(self, data, addr):
+        """收到一个ACK报文"""
+
+        self.handle_acks([(data, addr)], time.monotonic())
+        self.advance()
+
+    def error_received(self, exc):
+        self.log.warning(f"Error occured on socket: {exc}, ignore.")
+
+    def connection_lost(self, exc):
+        self.finish()
+
+    def advance(self):
+        """处理完事件后推进状态机：传输结束则完成，否则填满窗口并重新设置定时器"""
+
+        if self.complete():
+            self.finish()
+            return
+        self.fill()
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(self.RTO, self.on_timeout)
+        # 受rwnd限制时0.2s后询问接收方
+        if self.nextseq - self.unackseq >= self.rwnd and not self.fin and self.prober is None:
+            self.prober = self.loop.call_later(0.2, self.on_probe)
+
+    def finish(self):
+        if self.done is not None and not self.done.done():
+            self.done.set_result(None)
+
+    def fill(self, limit=None):
+        """在窗口允许的范围内发送报文
+        - 开启pacing时令牌不足，用定时器等到令牌产生的时刻再继续，不阻塞事件循环
+        - 结束报文发出后发送完毕，等待剩余的ACK
+        """
+
+        super().fill(limit)
+        delay = self.pacing_delay()
+        if delay > 0 and self.pacing_timer is None:
+            self.pacing_timer = self.loop.call_later(delay, self.on_pacing)
+        if self.fin and self.status != status.CLOSE:
+            self.status = status.CLOSE
+            self.log.info(f"change status to **Close**")
+
+    def on_timeout(self):
+        """RTO时间内没有收到ACK"""
+
+        self.timer = None
+        if not self.handle_timeout():
+            self.finish()
+            return
+        self.advance()
+
+    def on_probe(self):
+        """仍受rwnd限制时发送空报文询问接收方最新rwnd"""
+
+        self.prober = None
+        if self.complete() or self.fin:
+            return
+        if self.nextseq - self.unackseq >= self.rwnd:
+            self.probe()
+        self.advance()
+
+    def on_pacing(self):
+        """有令牌了，继续发送"""
+
+        self.pacing_timer = None
+        if not self.complete():
+            self.fill()
+
+
+async def attach(protocol, transport=None):
+    """让protocol接收udpsocket上的报文
+    - transport 握手时使用的transport，改由protocol处理之后的报文
+    - 没有时把protocol.udpsocket交给事件循环，创建新的transport
+    """
+
+    if transport is None:
+        transport, _ = await protocol.loop.create_datagram_endpoint(
+            lambda: protocol, sock=protocol.udpsocket
+        )
+    else:
+        transport.set_protocol(protocol)
+    return transport
+
+
+class AsyncReceiver(Receiver, asyncio.DatagramProtocol):
+    """asyncio版本的接收类
+    - 与Receiver共用报文处理、乱序缓冲、SACK的逻辑，由事件循环驱动，不创建线程
+    - 按序到达的数据放入缓冲区，由线程池中的写入任务（同一时间只有一个）解压、合并写入文件，写完后归还rwnd，不阻塞事件循环
+    - 打开、关闭文件，逐块检查时写入剩余数据，写回修复报文也在线程池中完成
+    - 接收超时、延迟确认用事件循环的定时器实现
+    - 调用run()协程完成一次传输
+    """
+
+    io_backend = "loop"
+
+    def __init__(self, *args, **kwargs):
+        """参数与Receiver相同"""
+
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.transport = None
+        self.done = None
+        self.timer = None
+        self.acker = None
+        # 正在进行的写入任务，正在写回的修复报文编号 -> 写入任务
+        self.writing = None
+        self.repairs = {}
+
+    async def run(self, transport=None, pending=()):
+        """完成一次传输
+        - transport 握手时使用的transport，交给这里继续使用，None时把udpsocket交给事件循环
+        - pending 握手结束时还没处理的报文，处理第一份数据后处理
+        - 打开文件，处理第一份数据后等待接收结束
+        - 最后再发一遍结束包的ACK，防止意外丢包
+        - 等写入任务结束后关闭文件，在线程池中检查md5码
+        """
+
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        await self.loop.run_in_executor(None, self.open_file)
+        self.status = status.WORK
+        self.transport = await attach(self, transport)
+        self.io.transport = self.transport
+        self.log.info("Receiving start")
+        try:
+            self.handle_first()
+            self.advance()
+            for data, addr in list(pending):
+                self.datagram_received(data, addr)
+            await self.done
+            if self.total_package != self.seq - 1:
+                self.log.warning(f"Stop unnormally!")
+            self.io.sendto(self.pkg, self.destaddr)
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            if self.acker is not None:
+                self.acker.cancel()
+            self.transport.close()
+            jobs = [job for job in (self.writing, *self.repairs.values()) if job is not None]
+            if jobs:
+                await asyncio.wait(jobs)
+            if self.failed:
+                os.close(self.fd)
+                self.fd = None
+            else:
+                await self.loop.run_in_executor(None, self.close_file)
+        if not self.failed:
+            await self.loop.run_in_executor(None, self.check)
+
+    def store(self, data):
+        """把按序到达的数据放入缓冲区，交给写入任务"""
+
+        self.buffer.append(data)
+        self.rwnd -= 1
+        self.schedule()
+
+    def schedule(self):
+        """没有正在进行的写入任务时，把缓冲区中的数据交给线程池写入"""
+
+        if self.writing is not None or not self.buffer or self.failed:
+            return
+        chunks = list(self.buffer)
+        self.buffer.clear()
+        self.writing = self.loop.run_in_executor(None, self.write_chunks, chunks)
+        self.writing.add_done_callback(lambda job: self.on_written(job, len(chunks)))
+
+    def write_chunks(self, chunks):
+        """在线程池中把一批数据（压缩传输时解压后）合并写入文件"""
+
+        start = time.monotonic()
+        for data in chunks:
+            self.consume(data)
+        self.drain(sum(len(data) for data in chunks), time.monotonic() - start)
+
+    def on_written(self, job, count):
+        """写入任务结束，归还rwnd，继续写入之后到达的数据"""
+
+        self.writing = None
+        self.rwnd += count
+        if self.written(job):
+            self.schedule()
+            self.advance()
+
+    def written(self, job):
+        """检查线程池中的任务，出错时中止接收并返回False"""
+
+        if job.cancelled() or job.exception() is not None:
+            self.log.err(f"Error occured while writing {self.file}: {None if job.cancelled() else job.exception()}, aborted.")
+            self.abort()
+            self.finish()
+            return False
+        return True
+
+    def settle(self):
+        """逐块检查时，收到结束报文并写完缓冲区后，在线程池中写入剩余数据，然后检查所有分块"""
+
+        self.writing = self.loop.run_in_executor(None, self.flush_pending)
+        self.writing.add_done_callback(self.on_settled)
+
+    def on_settled(self, job):
+        """剩余数据已写入，所有分块检查完毕，请求修复检查失败的分块"""
+
+        self.writing = None
+        if self.written(job):
+            self.verified = True
+            self.begin_repair()
+            self.advance()
+
+    def repair_piece(self, piece, data):
+        """收到修复报文，在线程池中写回文件，写完后检查所在分块"""
+
+        if piece not in self.missing or piece in self.repairs:
+            return
+        job = self.repairs[piece] = self.loop.run_in_executor(None, self.write_piece, piece, data)
+        job.add_done_callback(lambda job: self.on_repaired(job, piece))
+
+    def on_repaired(self, job, piece):
+        """修复报文已写回"""
+
+        self.repairs.pop(piece, None)
+        if self.written(job):
+            self.piece_written(piece)
+            self.advance()
+
+    def datagram_received(self, data, addr):
+        """收到一个数据报文，结束后只处理修复报文"""
+
+        if self.failed or (self.finished and not self.missing):
+            return
+        self.handle_packages([(data, addr)])
+        self.advance()
+
+    def error_received(self, exc):
+        self.log.warning(f"Error occured on socket: {exc}, ignore.")
+
+    def connection_lost(self, exc):
+        self.finish()
+
+    def advance(self):
+        """收到结束报文并写完缓冲区中的数据则完成，否则重新设置接收超时的定时器
+        - 逐块检查时，收到结束报文后写入剩余数据，检查完所有分块，修复完检查失败的分块才完成
+        """
+
+        limit = time_limit
+        if self.done.done():
+            return
+        if self.finished and self.writing is None and not self.buffer:
+            if self.tree is not None and not self.verified:
+                self.settle()
+            elif not self.missing and not self.repairs:
+                self.close()
+                self.finish()
+                return
+            elif self.missing:
+                limit = repair_timeout
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(limit, self.on_timeout)
+        # 有延迟的ACK时到期发出
+        if self.deadline is not None and self.acker is None:
+            self.acker = self.loop.call_later(max(self.deadline - time.monotonic(), 0), self.on_ack_timer)
+
+    def finish(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.done is not None and not self.done.done():
+            self.done.set_result(None)
+
+    def on_ack_timer(self):
+        """延迟的ACK到期，已经随之后的ACK发出时不做任何事"""
+
+        self.acker = None
+        self.flush_ack()
+
+    def on_timeout(self):
+        """time_limit秒没有收到数据报文，或repair_timeout秒没有收到修复报文，或写入任务time_limit秒没有写完"""
+
+        self.timer = None
+        if self.finished and not self.missing:
+            self.log.warning(f"{time_limit} seconds not finish writing, still waiting......")
+            self.advance()
+            return
+        if not (self.retry_repair() if self.finished else self.handle_timeout()):
+            self.finish()
+            return
+        self.advance()
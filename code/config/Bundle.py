@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+from hashlib import md5 as md5sum
+from .config import *
+
+
+def list_tree(root, limit):
+    """遍历文件夹
+    - root 要发送的文件夹
+    - limit 小于该大小的文件打包发送
+    - 返回值：(打包发送的文件相对root的路径列表, 单独发送的文件路径列表)，按路径排序
+    """
+
+    small = []
+    large = []
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(folder, name)
+            if not os.path.isfile(path):
+                continue
+            if os.path.getsize(path) < limit:
+                small.append(os.path.relpath(path, root).replace(os.sep, "/"))
+            else:
+                large.append(path)
+    return small, large
+
+
+def make_bundle(root, files, outfile):
+    """把root下的文件打包写入outfile
+    - root 要发送的文件夹
+    - files 文件相对root的路径列表
+    - 开头为清单：文件数量，每个文件的[路径长度, 文件大小]和路径
+    - 之后按清单顺序连续写入每个文件的内容，不按报文对齐，多个小文件共享一个报文
+    - 打包期间文件被修改、大小与清单不一致时抛出ValueError
+    - 返回值：[打包数据大小, md5码]
+    """
+
+    sizes = [os.path.getsize(os.path.join(root, file)) for file in files]
+    hasher = md5sum()
+    with open(outfile, "wb") as out:
+        manifest = bytearray(bundle_header.pack(len(files)))
+        for file, size in zip(files, sizes):
+            path = file.encode()
+            manifest += bundle_entry.pack(len(path), size)
+            manifest += path
+        out.write(manifest)
+        hasher.update(manifest)
+        for file, size in zip(files, sizes):
+            with open(os.path.join(root, file), "rb") as f:
+                remain = size
+                while remain > 0:
+                    data = f.read(min(remain, hash_chunk))
+                    if not data:
+                        raise ValueError(f"{file} changed while packing")
+                    out.write(data)
+                    hasher.update(data)
+                    remain -= len(data)
+        return [str(out.tell()), hasher.hexdigest()]
+
+
+def read_manifest(f):
+    """读取清单，返回[(相对路径, 文件大小), ...]，路径越界时抛出ValueError"""
+
+    (count,) = bundle_header.unpack(f.read(bundle_header.size))
+    entries = []
+    for _ in range(count):
+        length, size = bundle_entry.unpack(f.read(bundle_entry.size))
+        path = f.read(length).decode()
+        parts = path.split("/")
+        # 只允许写到root之下
+        if path.startswith("/") or any(part in ("", ".", "..") for part in parts):
+            raise ValueError(f"invalid path {path} in manifest")
+        entries.append((path, size))
+    return entries
+
+
+def unpack_bundle(bundlefile, root):
+    """把打包数据解开到root下
+    - bundlefile 完整接收的打包数据
+    - root 文件夹，不存在时创建
+    - 返回值：文件数量，打包数据损坏时抛出ValueError
+    """
+
+    with open(bundlefile, "rb") as f:
+        entries = read_manifest(f)
+        for path, size in entries:
+            target = os.path.join(root, *path.split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as out:
+                remain = size
+                while remain > 0:
+                    data = f.read(min(remain, hash_chunk))
+                    if not data:
+                        raise ValueError(f"truncated data of {path}")
+                    out.write(data)
+                    remain -= len(data)
+        return len(entries)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import importlib
+import os
+from .config import *
+
+# 支持的压缩算法
+codec_names = ("zlib", "lzma", "bz2")
+# 本机可用的压缩算法，精简的python可能缺少lzma、bz2
+codecs = {}
+for codec in codec_names:
+    try:
+        codecs[codec] = importlib.import_module(codec)
+    except ImportError:
+        pass
+
+
+def parse_codec(spec):
+    """解析"算法:级别"形式的压缩设置，返回(算法, 级别)，没有指定级别时为compress_level"""
+
+    name, _, level = str(spec).partition(":")
+    return name, int(level) if level else compress_level
+
+
+def compress(name, data, level):
+    """用指定算法和级别压缩一块数据"""
+
+    if name == "lzma":
+        return codecs[name].compress(data, preset=level)
+    if name == "bz2":
+        return codecs[name].compress(data, compresslevel=min(max(level, 1), 9))
+    return codecs[name].compress(data, level)
+
+
+def compressible(file, name, level):
+    """从文件中均匀取样压缩，判断是否值得压缩，已压缩过的文件（图片、压缩包等）返回False"""
+
+    size = os.path.getsize(file)
+    if size == 0:
+        return False
+    raw = 0
+    packed = 0
+    with open(file, "rb") as f:
+        step = max(size // compress_samples, compress_sample_size)
+        for offset in range(0, size, step):
+            f.seek(offset)
+            data = f.read(compress_sample_size)
+            raw += len(data)
+            packed += len(compress(name, data, level))
+    return packed <= raw * compress_ratio
+
+
+def compress_file(file, outfile, name, level):
+    """把文件按compress_block分块压缩写入outfile
+    - 每块写成[是否压缩, 原始长度, 块数据长度]的头和块数据，压缩效果不好的块按原样写入
+    - 返回值：压缩后的数据大小
+    """
+
+    with open(file, "rb") as f, open(outfile, "wb") as out:
+        while True:
+            data = f.read(compress_block)
+            if not data:
+                break
+            packed = compress(name, data, level)
+            if len(packed) <= len(data) * compress_ratio:
+                out.write(compress_frame.pack(1, len(data), len(packed)))
+                out.write(packed)
+            else:
+                out.write(compress_frame.pack(0, len(data), len(data)))
+                out.write(data)
+        return out.tell()
+
+
+class StreamDecoder(object):
+    """接收方按序解压收到的压缩数据
+    - 收到的数据先积攒起来，凑齐一块后解压交给写文件
+    - 块数据损坏时抛出ValueError
+    """
+
+    def __init__(self, name):
+        """初始化函数
+        - name 压缩算法
+        """
+
+        self.name = name
+        self.module = codecs[name]
+        self.pending = bytearray()
+
+    def feed(self, data):
+        """交付按序到达的压缩数据，返回已解压的块列表"""
+
+        self.pending += data
+        blocks = []
+        while len(self.pending) >= compress_frame.size:
+            packed, raw, length = compress_frame.unpack_from(self.pending)
+            end = compress_frame.size + length
+            if len(self.pending) < end:
+                break
+            body = bytes(self.pending[compress_frame.size : end])
+            del self.pending[:end]
+            block = self.module.decompress(body) if packed else body
+            if len(block) != raw:
+                raise ValueError(f"expect {raw} bytes block but got {len(block)}")
+            blocks.append(block)
+        return blocks
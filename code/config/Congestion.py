@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from .config import *
+
+
+class Congestion(object):
+    """阻塞控制算法基类
+    - 发送方在收到新ACK、冗余ACK、RTT样本，以及快速重传、超时时调用相应的事件函数
+    - cwnd 拥塞窗口（报文数），可以是小数，发送方向上取整使用
+    - pacing_rate 建议的发送速率（报文/秒），None表示只受窗口限制
+    - 事件函数只用内置的整数/浮点数运算，每个ACK都会调用，不使用numpy
+    - 新ACK按确认的数据量（以MSS为单位）增长cwnd，而不是按ACK的数量，接收方延迟确认时增长速度不变
+    """
+
+    name = ""
+
+    def __init__(self, log):
+        """初始化函数
+        - log 复用发送方的log
+        """
+
+        self.log = log
+        self.cwnd = initial_cwnd
+        self.ssthresh = initial_ssthresh
+        self.status = status.SLOW_START
+        self.pacing_rate = None
+        # 最近的RTT样本和观测到的最小RTT
+        self.RTT = None
+        self.min_RTT = None
+
+    def on_ack(self, acked, now):
+        """累计确认了acked个MSS的新数据，可以是小数"""
+
+    def on_dupack(self, now):
+        """收到一个冗余ACK"""
+
+    def on_rtt(self, RTT, now):
+        """得到一个RTT样本"""
+
+        self.RTT = RTT
+        if self.min_RTT is None or RTT < self.min_RTT:
+            self.min_RTT = RTT
+
+    def on_fast_retransmit(self, now):
+        """三次冗余ACK触发快速重传"""
+
+    def on_timeout(self, now):
+        """接收ACK超时"""
+
+    def change_status(self, new, reason=""):
+        """切换状态并记录日志"""
+
+        self.log.info(f"change status from **{self.status.name}** to **{new.name}**{reason}")
+        self.status = new
+
+
+class Reno(Congestion):
+    """Reno阻塞控制，即原来的慢启动、阻塞避免、快速恢复状态机"""
+
+    name = "reno"
+
+    def on_ack(self, acked, now):
+        """按确认的数据量更新cwnd（RFC 3465），慢启动用剩的数据量计入阻塞避免"""
+
+        # 快速恢复状态，收到正确ACK,切换到阻塞避免状态
+        if self.status == status.FASTRE_RECOVERY and acked > 0:
+            self.cwnd += 1
+            acked -= min(acked, 1)
+            self.change_status(status.AVOID)
+        # 慢启动状态，每确认一个MSS的数据就增加一个MSS,这样在一个RTT时间，窗口内的报文全收到，cwnd就会翻倍
+        if self.status == status.SLOW_START and acked > 0:
+            grow = min(acked, max(self.ssthresh - self.cwnd, 0))
+            self.cwnd += grow
+            acked -= grow
+            if self.cwnd >= self.ssthresh:
+                self.cwnd = self.ssthresh
+                self.change_status(status.AVOID)
+        # 阻塞避免状态，经过一个RTT才会cwnd才会增加1个MSS
+        if self.status == status.AVOID and acked > 0:
+            self.cwnd += acked / self.cwnd
+        self.log.info(f"change cwnd to {self.cwnd}")
+
+    def on_dupack(self, now):
+        """阻塞避免和快速恢复状态下冗余ACK也会让cwnd增加"""
+
+        if self.status == status.AVOID:
+            self.cwnd += 1.0 / self.cwnd
+        elif self.status == status.FASTRE_RECOVERY:
+            self.cwnd += 1
+        else:
+            return
+        self.log.info(f"change cwnd to {self.cwnd}")
+
+    def on_fast_retransmit(self, now):
+        """ssthresh变为cwnd的一半，cwnd置为ssthresh,变为快速恢复状态"""
+
+        self.change_status(status.FASTRE_RECOVERY, " due to duplicated ack")
+        self.ssthresh = max(int(self.cwnd) // 2, 1)
+        self.cwnd = self.ssthresh
+        self.log.warning(f"change cwnd to {self.cwnd}")
+
+    def on_timeout(self, now):
+        """ssthresh变为cwnd的一半，cwnd置为1,变为慢启动状态"""
+
+        self.change_status(status.SLOW_START, " due to Timeout")
+        self.ssthresh = max(int(self.cwnd) // 2, 1)
+        self.cwnd = 1
+        self.log.warning(f"change cwnd to {self.cwnd}")
+
+
+class Cubic(Congestion):
+    """CUBIC阻塞控制（RFC 8312）
+    - 阻塞避免阶段cwnd按距上次丢包的时间的三次函数增长，与RTT无关，适合高带宽长时延的链路
+    - 丢包时cwnd乘以cubic_beta，而不是减半
+    - 同时估计Reno在相同情况下的窗口，取较大值，保证在短RTT链路上不比Reno慢
+    """
+
+    name = "cubic"
+
+    def __init__(self, log):
+        super().__init__(log)
+        # 上次丢包前的cwnd
+        self.W_max = 0
+        # 本轮阻塞避免的起始时间，丢包后重新开始
+        self.epoch = None
+        self.K = 0
+        self.origin = 0
+        # 模拟Reno的窗口
+        self.W_est = 0
+
+    def on_ack(self, acked, now):
+        """慢启动阶段每确认一个MSS的数据增加1,阻塞避免阶段按三次函数增长"""
+
+        if self.status == status.FASTRE_RECOVERY:
+            self.change_status(status.AVOID)
+        if self.status == status.SLOW_START:
+            self.cwnd = min(self.cwnd + acked, max(self.ssthresh, self.cwnd))
+            if self.cwnd >= self.ssthresh:
+                self.change_status(status.AVOID)
+        else:
+            if self.epoch is None:
+                self.epoch = now
+                if self.W_max > self.cwnd:
+                    self.K = ((self.W_max - self.cwnd) / cubic_C) ** (1 / 3)
+                    self.origin = self.W_max
+                else:
+                    self.K = 0
+                    self.origin = self.cwnd
+                self.W_est = self.cwnd
+            t = now - self.epoch + (self.min_RTT or 0)
+            target = self.origin + cubic_C * (t - self.K) ** 3
+            if target > self.cwnd:
+                self.cwnd += (target - self.cwnd) / self.cwnd * acked
+            else:
+                self.cwnd += 0.01 * acked / self.cwnd
+            self.W_est += 3 * (1 - cubic_beta) / (1 + cubic_beta) * acked / self.cwnd
+            self.cwnd = max(self.cwnd, self.W_est)
+        self.log.info(f"change cwnd to {self.cwnd}")
+
+    def reduce(self):
+        """丢包，记录W_max并开始新一轮增长，快速收敛：W_max比上次小说明有新的流加入，让出一部分带宽"""
+
+        if self.cwnd < self.W_max:
+            self.W_max = self.cwnd * (1 + cubic_beta) / 2
+        else:
+            self.W_max = self.cwnd
+        self.ssthresh = max(self.cwnd * cubic_beta, 2)
+        self.epoch = None
+
+    def on_fast_retransmit(self, now):
+        """cwnd乘以cubic_beta,变为快速恢复状态"""
+
+        self.change_status(status.FASTRE_RECOVERY, " due to duplicated ack")
+        self.reduce()
+        self.cwnd = self.ssthresh
+        self.log.warning(f"change cwnd to {self.cwnd}")
+
+    def on_timeout(self, now):
+        """cwnd置为1,变为慢启动状态"""
+
+        self.change_status(status.SLOW_START, " due to Timeout")
+        self.reduce()
+        self.cwnd = 1
+        self.log.warning(f"change cwnd to {self.cwnd}")
+
+
+class BBR(Congestion):
+    """基于交付速率的阻塞控制（BBR风格）
+    - 不以丢包作为拥塞信号，而是测量瓶颈带宽（最近bbr_bw_rounds轮交付速率的最大值）和最小RTT
+    - cwnd = bbr_cwnd_gain * 带宽 * 最小RTT（即BDP的倍数），pacing_rate = pacing_gain * 带宽
+    - 启动阶段（SLOW_START）指数增长，直到带宽连续3轮增长不到25%，排空一轮（FASTRE_RECOVERY用作DRAIN）后进入带宽探测（AVOID）
+    - 带宽探测阶段每轮按bbr_pacing_gains循环调整pacing_gain
+    """
+
+    name = "bbr"
+
+    def __init__(self, log):
+        super().__init__(log)
+        self.cwnd = max(initial_cwnd, bbr_min_cwnd)
+        # 已交付（被确认）的报文总数
+        self.delivered = 0
+        # 当前轮的起始时间和起始交付数，交付数达到round_end时这一轮结束，一轮约为一个RTT
+        self.round_start = None
+        self.round_delivered = 0
+        self.round_end = 0
+        # 最近几轮的交付速率（报文/秒）
+        self.rates = deque(maxlen=bbr_bw_rounds)
+        self.bw = 0
+        self.min_RTT_stamp = 0
+        # 启动阶段判断带宽是否已经跑满
+        self.full_bw = 0
+        self.full_bw_count = 0
+        self.pacing_gain = bbr_high_gain
+        self.cycle = 0
+
+    def on_rtt(self, RTT, now):
+        """最小RTT超过bbr_min_rtt_window秒没有更新则重新采样，适应路由变化"""
+
+        self.RTT = RTT
+        if self.min_RTT is None or RTT <= self.min_RTT or now - self.min_RTT_stamp > bbr_min_rtt_window:
+            self.min_RTT = RTT
+            self.min_RTT_stamp = now
+
+    def on_ack(self, acked, now):
+        """累计交付量（以MSS为单位），每交付一个窗口的数据（约一个RTT）计算一次交付速率，再按带宽模型更新cwnd"""
+
+        self.delivered += acked
+        if self.round_start is None:
+            self.new_round(now, self.delivered - acked)
+        elapsed = now - self.round_start
+        if self.delivered >= self.round_end and elapsed > 0:
+            self.rates.append((self.delivered - self.round_delivered) / elapsed)
+            self.bw = max(self.rates)
+            self.new_round(now, self.delivered)
+            self.next_round()
+        target = self.target()
+        # 还没有带宽样本，或者启动阶段，按慢启动增长
+        if target is None or self.status == status.SLOW_START:
+            self.cwnd += acked
+        else:
+            self.cwnd = min(self.cwnd + acked, target)
+        self.cwnd = max(self.cwnd, bbr_min_cwnd)
+        if self.bw > 0:
+            self.pacing_rate = self.pacing_gain * self.bw
+        self.log.info(f"change cwnd to {self.cwnd}")
+
+    def new_round(self, now, delivered):
+        """开始新的一轮，当前窗口内的报文都被确认时结束"""
+
+        self.round_start = now
+        self.round_delivered = delivered
+        self.round_end = delivered + max(int(self.cwnd), 1)
+
+    def target(self):
+        """根据带宽和最小RTT估计的目标cwnd"""
+
+        if self.bw <= 0 or self.min_RTT is None:
+            return None
+        return max(bbr_cwnd_gain * self.bw * self.min_RTT, bbr_min_cwnd)
+
+    def next_round(self):
+        """每轮结束时推进状态机"""
+
+        if self.status == status.SLOW_START:
+            if self.bw >= self.full_bw * 1.25:
+                self.full_bw = self.bw
+                self.full_bw_count = 0
+            else:
+                self.full_bw_count += 1
+            if self.full_bw_count >= 3:
+                self.change_status(status.FASTRE_RECOVERY, " (drain)")
+                self.pacing_gain = 1 / bbr_high_gain
+        elif self.status == status.FASTRE_RECOVERY:
+            self.change_status(status.AVOID, " (probe bandwidth)")
+            self.cycle = 0
+            self.pacing_gain = bbr_pacing_gains[self.cycle]
+        elif self.status == status.AVOID:
+            self.cycle = (self.cycle + 1) % len(bbr_pacing_gains)
+            self.pacing_gain = bbr_pacing_gains[self.cycle]
+
+    def on_fast_retransmit(self, now):
+        """丢包不是拥塞信号，只把cwnd收回到带宽模型的估计值"""
+
+        target = self.target()
+        if target is not None and self.cwnd > target:
+            self.cwnd = target
+            self.log.warning(f"change cwnd to {self.cwnd}")
+
+    def on_timeout(self, now):
+        """超时说明模型可能已经失效，cwnd降到最小值，之后按ACK重新增长到模型估计值"""
+
+        self.cwnd = bbr_min_cwnd
+        self.log.warning(f"change cwnd to {self.cwnd} due to Timeout")
+
+
+# 可选的阻塞控制算法
+congestion_algorithms = {cls.name: cls for cls in (Reno, Cubic, BBR)}
+
+
+def make_congestion(name, log):
+    """根据名称创建阻塞控制算法，未知的名称使用默认算法congestion_control"""
+
+    if name not in congestion_algorithms:
+        log.warning(f"Unknown congestion control {name}, use {congestion_control} instead.")
+        name = congestion_control
+    return congestion_algorithms[name](log)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import mmap
+import os
+from hashlib import md5 as md5sum
+import numpy as np
+from .config import *
+
+
+def delta_block_size(size):
+    """根据文件大小选择分块大小，约为文件大小的平方根，在[delta_block, delta_max_block]之间，按KB对齐"""
+
+    return min(max(delta_block, int(math.sqrt(size)) // 1024 * 1024), delta_max_block)
+
+
+def weak_checksums(data, L):
+    """向量化计算滚动校验和
+    - data 字节的numpy数组
+    - L 分块大小
+    - 返回值：data中每个起点k处长度为L的窗口的弱校验和，共len(data) - L + 1个
+    - 与rsync相同，a = sum(x_i)，b = sum((k + L - i) * x_i)，校验和为两者的低16位，用前缀和一次算出所有窗口
+    - 只需要低16位，用uint32计算，溢出回绕不影响结果
+    """
+
+    x = data.astype(np.uint32)
+    s1 = np.zeros(len(x) + 1, dtype=np.uint32)
+    np.cumsum(x, out=s1[1:])
+    s2 = np.zeros(len(x) + 1, dtype=np.uint32)
+    np.cumsum(x * np.arange(len(x), dtype=np.uint32), out=s2[1:])
+    a = s1[L:] - s1[:-L]
+    b = np.arange(L, len(x) + 1, dtype=np.uint32) * a - (s2[L:] - s2[:-L])
+    return ((a & 0xFFFF) | ((b & 0xFFFF) << 16)).astype(np.int64)
+
+
+def make_signature(file, sigfile, L):
+    """计算已有文件的签名
+    - file 接收方已有的旧文件
+    - sigfile 签名写入的文件
+    - L 分块大小
+    - 签名为分块大小、完整分块数量，以及每个分块的弱校验和与md5码，不足一块的结尾不参与匹配
+    """
+
+    with open(file, "rb") as f, open(sigfile, "wb") as out:
+        count = os.fstat(f.fileno()).st_size // L
+        out.write(signature_header.pack(L, count))
+        weights = np.arange(L, 0, -1, dtype=np.int64)
+        per = max(1, delta_window // L)
+        done = 0
+        while done < count:
+            n = min(per, count - done)
+            data = f.read(n * L)
+            rows = np.frombuffer(data, dtype=np.uint8).reshape(n, L).astype(np.int64)
+            weak = (rows.sum(axis=1) & 0xFFFF) | (((rows @ weights) & 0xFFFF) << 16)
+            for i in range(n):
+                out.write(signature_block.pack(int(weak[i]), md5sum(data[i * L : (i + 1) * L]).digest()))
+            done += n
+
+
+def read_signature(sigfile):
+    """读取签名，返回(分块大小, {弱校验和: [(分块编号, md5码), ...]})"""
+
+    blocks = {}
+    with open(sigfile, "rb") as f:
+        L, count = signature_header.unpack(f.read(signature_header.size))
+        for i in range(count):
+            weak, strong = signature_block.unpack(f.read(signature_block.size))
+            blocks.setdefault(weak, []).append((i, strong))
+    return L, blocks
+
+
+class DeltaWriter(object):
+    """把增量数据写入文件，同时计算md5码
+    - 连续的分块引用合并为一条复制指令，字面数据按delta_literal大小分条
+    """
+
+    def __init__(self, deltafile, L, size):
+        self.f = open(deltafile, "wb")
+        self.hasher = md5sum()
+        self.size = 0
+        # 还未写出的复制指令[起始分块, 分块数量]
+        self.run = None
+        self.emit(delta_header.pack(L, size))
+
+    def emit(self, data):
+        self.f.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def flush_run(self):
+        if self.run is not None:
+            self.emit(delta_copy_op + delta_copy.pack(*self.run))
+            self.run = None
+
+    def copy(self, index):
+        """引用旧文件的第index块"""
+
+        if self.run is not None and self.run[0] + self.run[1] == index:
+            self.run[1] += 1
+            return
+        self.flush_run()
+        self.run = [index, 1]
+
+    def literal(self, data):
+        """字面数据"""
+
+        if len(data) == 0:
+            return
+        self.flush_run()
+        for i in range(0, len(data), delta_literal):
+            chunk = data[i : i + delta_literal]
+            self.emit(delta_literal_op + delta_length.pack(len(chunk)))
+            self.emit(chunk)
+
+    def close(self):
+        """写出剩余指令并关闭，返回[增量数据大小, md5码]"""
+
+        self.flush_run()
+        self.f.close()
+        return [str(self.size), self.hasher.hexdigest()]
+
+
+def make_delta(file, sigfile, deltafile):
+    """根据接收方的签名计算新文件的增量数据
+    - file 发送方的新文件
+    - sigfile 接收方旧文件的签名
+    - deltafile 增量数据写入的文件
+    - 每次取delta_window个起点，向量化计算所有起点的弱校验和，只对与签名中弱校验和相同的起点计算md5码确认
+    - 从前往后贪心匹配，匹配到的分块写成对旧文件的引用，其余写成字面数据
+    - 返回值：[增量数据大小, md5码]
+    """
+
+    L, blocks = read_signature(sigfile)
+    # 排好序的弱校验和，先用按低位索引的位图快速排除绝大多数起点，再对剩下的起点二分查找
+    weaks = np.sort(np.fromiter(blocks.keys(), dtype=np.int64, count=len(blocks)))
+    bitmap = np.zeros(delta_bitmap, dtype=bool)
+    bitmap[weaks & (delta_bitmap - 1)] = True
+    size = os.path.getsize(file)
+    writer = DeltaWriter(deltafile, L, size)
+    with open(file, "rb") as f:
+        # 空文件无法映射，用空的字节串代替
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b""
+        view = memoryview(mm)
+        # 下一个还未编码的字节
+        pos = 0
+        start = 0
+        while len(weaks) > 0 and start + L <= size:
+            end = min(start + delta_window, size - L + 1)
+            weak = weak_checksums(np.frombuffer(view, dtype=np.uint8, count=end - start + L - 1, offset=start), L)
+            candidates = np.nonzero(bitmap[weak & (delta_bitmap - 1)])[0]
+            found = weaks[np.minimum(np.searchsorted(weaks, weak[candidates]), len(weaks) - 1)] == weak[candidates]
+            for k in (candidates[found] + start).tolist():
+                if k < pos:
+                    continue
+                strong = md5sum(view[k : k + L]).digest()
+                matches = [i for i, s in blocks[int(weak[k - start])] if s == strong]
+                if not matches:
+                    continue
+                writer.literal(view[pos:k])
+                # 优先选择紧接着上一个引用的分块，合并成一条复制指令
+                following = writer.run[0] + writer.run[1] if writer.run is not None else None
+                writer.copy(following if following in matches else matches[0])
+                pos = k + L
+            start = end
+        writer.literal(view[pos:size])
+        view.release()
+        if size > 0:
+            mm.close()
+    return writer.close()
+
+
+def apply_delta(file, deltafile, outfile):
+    """用旧文件和增量数据合成新文件
+    - file 接收方的旧文件
+    - deltafile 增量数据
+    - outfile 合成的新文件
+    - 返回值：新文件的md5码，增量数据损坏时抛出ValueError
+    """
+
+    hasher = md5sum()
+    with open(file, "rb") as old, open(deltafile, "rb") as delta, open(outfile, "wb") as out:
+        L, size = delta_header.unpack(delta.read(delta_header.size))
+        while True:
+            op = delta.read(1)
+            if not op:
+                break
+            if op == delta_copy_op:
+                index, count = delta_copy.unpack(delta.read(delta_copy.size))
+                old.seek(index * L)
+                remain = count * L
+                while remain > 0:
+                    data = old.read(min(remain, hash_chunk))
+                    if not data:
+                        raise ValueError(f"block {index} out of range")
+                    out.write(data)
+                    hasher.update(data)
+                    remain -= len(data)
+            elif op == delta_literal_op:
+                (length,) = delta_length.unpack(delta.read(delta_length.size))
+                data = delta.read(length)
+                if len(data) != length:
+                    raise ValueError(f"truncated literal, expect {length} bytes but got {len(data)}")
+                out.write(data)
+                hasher.update(data)
+            else:
+                raise ValueError(f"unknown delta op {op}")
+        if out.tell() != size:
+            raise ValueError(f"expect {size} bytes but got {out.tell()}")
+    return hasher.hexdigest()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from collections import deque
+from .config import *
+
+
+def parity_seq(first, count):
+    """校验报文的序号：fec_flag | (组大小 << fec_shift) | 组内第一个报文序号的低fec_shift位"""
+
+    return fec_flag | (count << fec_shift) | (first & ((1 << fec_shift) - 1))
+
+
+def parity_group(seq, near=0):
+    """由校验报文的序号得到(组内第一个报文序号, 组大小)
+    - near 接收方期望的报文序号，组内第一个报文序号取低fec_shift位相同的值中离near最近的一个
+    """
+
+    span = 1 << fec_shift
+    first = near + (((seq & (span - 1)) - near + span // 2) % span) - span // 2
+    return first, (seq & ~fec_flag) >> fec_shift
+
+
+class FecEncoder(object):
+    """发送方的XOR前向纠错
+    - 连续发送的group个新报文（数据、结束、请求rwnd报文都算）为一组，数据段补零后按位异或得到一个校验报文
+    - 校验报文的窗口字段为组内报文窗口字段的异或，接收方还原报文时一并还原数据段长度或特殊标识
+    - 组大小随丢包率调整：丢包率越高组越小，校验报文占比越高，平均每组丢失fec_loss_target个报文
+    - 丢包率由重传的报文和接收方报告的还原报文估计，还原的报文不会重传，只看重传会低估丢包率
+    - 校验报文在组内的报文都被确认之前视为在途，数据量计入cwnd
+    """
+
+    def __init__(self, MSS):
+        """初始化函数
+        - MSS 数据段的最大长度
+        """
+
+        self.MSS = MSS
+        self.group = fec_group_max
+        # 当前组的第一个报文序号、已计入的报文数量、窗口字段的异或、数据段的异或及其最大长度
+        self.first = None
+        self.count = 0
+        self.rwnd = 0
+        self.parity = np.zeros(MSS, dtype=np.uint8)
+        self.length = 0
+        # 估计的丢包率，上次调整以来发送和丢失的报文数量，接收方报告的累计还原数量
+        self.loss = 0.0
+        self.sent = 0
+        self.lost = 0
+        self.recovered = 0
+        # 在途的校验报文[(组内最后一个报文序号, 数据段长度), ...]，已发出和已离开网络的校验数据量，
+        # 两个计数分别只由发送和处理ACK的一方增加，不需要加锁
+        self.flight = deque()
+        self.sent_bytes = 0
+        self.released_bytes = 0
+
+    def add(self, seq, rwnd, data):
+        """计入一个新发送的报文
+        - seq 报文序号
+        - rwnd 报文的窗口字段，数据段长度或结束、请求rwnd的特殊标识
+        - data 数据段，不含补齐的零字节
+        - 凑满一组或发出结束报文时返回校验报文(序号, 窗口字段, 数据段)，否则返回None
+        """
+
+        if self.first is None:
+            self.first = seq
+        self.rwnd ^= rwnd
+        if len(data) > 0:
+            view = self.parity[: len(data)]
+            np.bitwise_xor(view, np.frombuffer(data, dtype=np.uint8), out=view)
+            self.length = max(self.length, len(data))
+        self.count += 1
+        self.sent += 1
+        if self.count >= self.group or rwnd == DONE:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """结束当前组，返回校验报文"""
+
+        packet = None
+        if self.count > 0:
+            packet = (parity_seq(self.first, self.count), self.rwnd, self.parity[: self.length].tobytes())
+            self.flight.append((self.first + self.count - 1, self.length))
+            self.sent_bytes += self.length
+        self.first = None
+        self.count = 0
+        self.rwnd = 0
+        self.parity[: self.length] = 0
+        self.length = 0
+        self.adapt()
+        return packet
+
+    def release(self, unackseq):
+        """累计确认到unackseq之前，组内报文都已确认的校验报文不再在途"""
+
+        while self.flight and self.flight[0][0] < unackseq:
+            self.released_bytes += self.flight.popleft()[1]
+
+    def inflight(self):
+        """在途的校验数据量（字节）"""
+
+        return self.sent_bytes - self.released_bytes
+
+    def on_loss(self, count=1):
+        """有报文重传"""
+
+        self.lost += count
+
+    def report(self, data):
+        """解析ACK中SACK信息之后的还原数量"""
+
+        if len(data) < sack_count.size:
+            return
+        (count,) = sack_count.unpack_from(data)
+        offset = sack_count.size + count * sack_block.size
+        if len(data) < offset + fec_report.size:
+            return
+        (recovered,) = fec_report.unpack_from(data, offset)
+        if recovered > self.recovered:
+            self.lost += recovered - self.recovered
+            self.recovered = recovered
+
+    def adapt(self):
+        """每组结束时更新丢包率的估计，调整组大小"""
+
+        if self.sent == 0:
+            return
+        self.loss = (1 - fec_alpha) * self.loss + fec_alpha * min(self.lost / self.sent, 1)
+        self.sent = 0
+        self.lost = 0
+        group = int(fec_loss_target / self.loss) if self.loss > 0 else fec_group_max
+        self.group = min(max(group, fec_group_min), fec_group_max)
+
+
+class FecDecoder(object):
+    """接收方的XOR前向纠错
+    - 缓存最近收到的报文，收到校验报文时，组内只缺一个报文就用校验报文与其余报文异或还原，不需要等待重传
+    - 校验报文先于组内的报文到达时暂存，之后每收到一个组内的报文再尝试还原
+    - 组大小不超过fec_group_max，只需缓存期望序号之前fec_group_max个报文
+    """
+
+    def __init__(self, MSS):
+        """初始化函数
+        - MSS 数据段的最大长度
+        """
+
+        self.MSS = MSS
+        # 报文序号 -> (窗口字段, 数据段)
+        self.packets = {}
+        # 组内第一个报文序号 -> (组大小, 窗口字段的异或, 数据段的异或)
+        self.groups = {}
+        # 累计还原的报文数量，在ACK中报告给发送方
+        self.recovered = 0
+
+    def record(self, seq, rwnd, data, expect):
+        """记录收到的报文
+        - expect 接收方期望的下一个报文序号，之前的报文都已收到
+        - 返回因此能还原的报文[(序号, 窗口字段, 数据段), ...]
+        """
+
+        self.packets[seq] = (rwnd, data)
+        rebuilt = []
+        for first, (count, _, _) in list(self.groups.items()):
+            if first <= seq < first + count:
+                rebuilt += self.decode(first, expect)
+        self.evict(expect)
+        return rebuilt
+
+    def parity(self, seq, rwnd, data, expect):
+        """收到校验报文，返回能还原的报文[(序号, 窗口字段, 数据段), ...]"""
+
+        first, count = parity_group(seq, expect)
+        if first + count <= expect:
+            return []
+        self.groups[first] = (count, rwnd, data)
+        return self.decode(first, expect)
+
+    def decode(self, first, expect):
+        """尝试还原一组中缺失的报文"""
+
+        count, rwnd, data = self.groups[first]
+        missing = [seq for seq in range(first, first + count) if seq not in self.packets]
+        # 缓存之前已交付的报文无法参与还原
+        if len(missing) == 0 or any(seq < expect for seq in missing):
+            del self.groups[first]
+            return []
+        if len(missing) > 1:
+            return []
+        del self.groups[first]
+        parity = np.zeros(self.MSS, dtype=np.uint8)
+        parity[: len(data)] = np.frombuffer(data, dtype=np.uint8)
+        for seq in range(first, first + count):
+            if seq == missing[0]:
+                continue
+            r, d = self.packets[seq]
+            rwnd ^= r
+            view = parity[: len(d)]
+            np.bitwise_xor(view, np.frombuffer(d, dtype=np.uint8), out=view)
+        self.recovered += 1
+        self.packets[missing[0]] = (rwnd, parity.tobytes())
+        return [(missing[0], rwnd, self.packets[missing[0]][1])]
+
+    def evict(self, expect):
+        """丢弃不会再用到的报文和校验报文"""
+
+        if len(self.packets) > 4 * fec_group_max:
+            for seq in [seq for seq in self.packets if seq < expect - fec_group_max]:
+                del self.packets[seq]
+        for first in [first for first, (count, _, _) in self.groups.items() if first + count <= expect]:
+            del self.groups[first]
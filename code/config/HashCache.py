@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import atexit
+import json
+import os
+import time
+from threading import Lock, Timer
+from .config import *
+
+
+class HashCache(object):
+    """文件md5码的持久化缓存
+    - 以文件的绝对路径为键，记录inode、大小、mtime_ns，任何一项变化都视为文件已改变，缓存失效
+    - 每个文件保存整个文件的md5码和若干前缀（前多少字节）的md5码，用于续传时比对，以及逐块检查的Merkle树叶子
+    - 最多保存size个文件，超过时淘汰最久未使用的，查询时也会更新使用时间
+    - 保存在JSON文件中，写入时先合并文件中其他进程的记录，再原子地替换
+    - 改变后不立即写入，flush秒内的改变合并为一次写入，进程退出时写入剩余的改变
+    """
+
+    def __init__(self, path=hash_cache_file, size=hash_cache_size, flush=hash_cache_flush):
+        """初始化函数
+        - path 缓存文件路径
+        - size 最多缓存的文件数量
+        - flush 改变后最多等待多少秒写入缓存文件
+        """
+
+        self.path = path
+        self.size = size
+        self.flush = flush
+        # 绝对路径 -> {"ino", "size", "mtime", "used", "md5", "prefix": {字节数: md5}, "tree": [分块大小, 叶子的十六进制]}
+        self.entries = None
+        self.lock = Lock()
+        # 有没写入的改变时为等待写入的定时器，以及创建它的进程（fork出的工作进程中没有这个定时器线程）
+        self.timer = None
+        self.owner = None
+        atexit.register(self.close)
+
+    def load(self):
+        """从缓存文件读取记录，文件不存在或损坏时返回空记录"""
+
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """合并缓存文件中的记录后写回，只保留最近使用的size个，调用时需持有锁"""
+
+        if self.timer is not None and self.owner == os.getpid():
+            self.timer.cancel()
+        self.timer = None
+        entries = self.load()
+        for path, entry in self.entries.items():
+            if path not in entries or entries[path]["used"] <= entry["used"]:
+                entries[path] = entry
+        keep = sorted(entries.items(), key=lambda item: item[1]["used"], reverse=True)
+        self.entries = dict(keep[: self.size])
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def changed(self):
+        """记录有改变，flush秒后写入缓存文件，已经在等待写入时不重复安排，调用时需持有锁"""
+
+        if self.timer is not None and self.owner == os.getpid():
+            return
+        self.timer = Timer(self.flush, self.close)
+        self.timer.daemon = True
+        self.owner = os.getpid()
+        self.timer.start()
+
+    def close(self):
+        """立即写入没有写入的改变，定时器到期和进程退出时调用"""
+
+        with self.lock:
+            if self.timer is not None:
+                self.save()
+
+    def entry(self, file, st=None):
+        """返回文件当前有效的记录，文件改变过则换成新的空记录，调用时需持有锁
+        - st 文件的os.stat结果，None时重新获取
+        """
+
+        if self.entries is None:
+            self.entries = self.load()
+        st = os.stat(file) if st is None else st
+        path = os.path.abspath(file)
+        entry = self.entries.get(path)
+        if entry is None or (entry["ino"], entry["size"], entry["mtime"]) != (st.st_ino, st.st_size, st.st_mtime_ns):
+            entry = {"ino": st.st_ino, "size": st.st_size, "mtime": st.st_mtime_ns, "md5": None, "prefix": {}}
+            self.entries[path] = entry
+        entry["used"] = time.time()
+        self.changed()
+        return entry
+
+    def get(self, file, size=None):
+        """查询文件（或前size字节）的md5码，没有缓存时返回None"""
+
+        with self.lock:
+            entry = self.entry(file)
+            if size is None or size >= entry["size"]:
+                return entry["md5"]
+            return entry["prefix"].get(str(size))
+
+    def current(self, file, st=None):
+        """返回要写入的记录，调用时需持有锁
+        - st 开始计算前文件的os.stat结果，计算期间文件被修改过时返回None，不记录
+        """
+
+        now = os.stat(file)
+        if st is not None and (st.st_ino, st.st_size, st.st_mtime_ns) != (now.st_ino, now.st_size, now.st_mtime_ns):
+            return None
+        return self.entry(file, now)
+
+    def get_tree(self, file, chunk):
+        """查询文件按chunk字节分块的Merkle树叶子列表，没有缓存时返回None"""
+
+        with self.lock:
+            tree = self.entry(file).get("tree")
+            if tree is None or tree[0] != chunk:
+                return None
+            data = bytes.fromhex(tree[1])
+            return [data[i : i + 16] for i in range(0, len(data), 16)]
+
+    def put_tree(self, file, chunk, leaves, st=None):
+        """记录文件按chunk字节分块的Merkle树叶子，每个文件只保存一种分块大小，st同put"""
+
+        with self.lock:
+            entry = self.current(file, st)
+            if entry is not None:
+                entry["tree"] = [chunk, b"".join(leaves).hex()]
+
+    def put(self, file, md5, size=None, st=None):
+        """记录文件（或前size字节）的md5码，之后写入缓存文件
+        - st 开始计算md5码前文件的os.stat结果，计算期间文件被修改过则不记录
+        """
+
+        with self.lock:
+            entry = self.current(file, st)
+            if entry is None:
+                return
+            if size is None or size >= entry["size"]:
+                entry["md5"] = md5
+            else:
+                prefix = entry["prefix"]
+                prefix[str(size)] = md5
+                # 前缀记录过多时丢弃最早的
+                while len(prefix) > hash_cache_prefixes:
+                    del prefix[next(iter(prefix))]
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import os
+from hashlib import md5 as md5sum
+from socket import timeout
+from .config import *
+from .util import md5_cache
+from .Steps import recv, run
+
+
+def merkle_chunk_size(size, MSS):
+    """选择分块大小：merkle_chunk向上取整到MSS的整数倍，分块数量超过merkle_max_leaves时加倍"""
+
+    chunk = math.ceil(merkle_chunk / MSS) * MSS
+    while math.ceil(size / chunk) > merkle_max_leaves:
+        chunk *= 2
+    return chunk
+
+
+class MerkleTree(object):
+    """文件分块的Merkle树
+    - 文件按chunk字节分块，分块大小是MSS的整数倍，修复时按报文重发
+    - 叶子为每块的md5码，父节点为两个子节点拼接后的md5码，落单的节点直接升到上一层
+    - 发送方在握手时公布[分块大小, 分块数量, 根]，之后把叶子分页发给接收方，接收方收齐并核对根之后逐块检查写入的数据
+    """
+
+    def __init__(self, chunk, count, root=None, leaves=None):
+        """初始化函数
+        - chunk 分块大小
+        - count 分块数量
+        - root 根的十六进制字符串，None时由叶子计算
+        - leaves 叶子列表，接收方为None，收到分页后填入
+        """
+
+        self.chunk = int(chunk)
+        self.count = int(count)
+        self.leaves = leaves if leaves is not None else [None] * self.count
+        self.root = root if root is not None else self.compute_root()
+
+    @classmethod
+    def build(cls, file, MSS):
+        """发送方计算文件的Merkle树
+        - 文件未改变时使用md5码缓存中的叶子，不需要读文件
+        - 否则读一遍文件，同时计算整个文件的md5码，一起写入缓存，握手时获取文件信息不需要再读一遍
+        """
+
+        size = os.path.getsize(file)
+        chunk = merkle_chunk_size(size, MSS)
+        leaves = md5_cache.get_tree(file, chunk) if md5_cache is not None else None
+        if leaves is not None and len(leaves) == math.ceil(size / chunk):
+            return cls(chunk, len(leaves), leaves=leaves)
+        st = os.stat(file)
+        whole = md5sum()
+        leaves = []
+        buf = memoryview(bytearray(hash_chunk))
+        with open(file, "rb", buffering=0) as f:
+            for _ in range(math.ceil(size / chunk)):
+                hasher = md5sum()
+                left = chunk
+                while left > 0:
+                    n = f.readinto(buf[: min(left, len(buf))])
+                    if not n:
+                        break
+                    hasher.update(buf[:n])
+                    whole.update(buf[:n])
+                    left -= n
+                leaves.append(hasher.digest())
+        if md5_cache is not None:
+            md5_cache.put(file, whole.hexdigest(), None, st)
+            md5_cache.put_tree(file, chunk, leaves, st)
+        return cls(chunk, len(leaves), leaves=leaves)
+
+    @classmethod
+    def from_info(cls, info):
+        """接收方根据握手时公布的[分块大小, 分块数量, 根]创建，叶子为空"""
+
+        return cls(info[0], info[1], info[2])
+
+    def info(self):
+        """握手时公布的信息"""
+
+        return [str(self.chunk), str(self.count), self.root]
+
+    def compute_root(self):
+        """由叶子计算根，没有分块时为空数据的md5码"""
+
+        level = list(self.leaves)
+        if not level:
+            return md5sum(b"").hexdigest()
+        while len(level) > 1:
+            level = [
+                md5sum(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                for i in range(0, len(level), 2)
+            ]
+        return level[0].hex()
+
+    def pages(self, MSS):
+        """叶子分页发送，每页为一个报文，返回页数"""
+
+        return math.ceil(self.count / (MSS // 16))
+
+    def page(self, index, MSS):
+        """第index页的数据"""
+
+        per = MSS // 16
+        return b"".join(self.leaves[index * per : (index + 1) * per])
+
+    def accept(self, index, data, MSS):
+        """接收方收到第index页，填入叶子"""
+
+        per = MSS // 16
+        for i in range(index * per, min((index + 1) * per, self.count)):
+            offset = (i - index * per) * 16
+            if offset + 16 <= len(data):
+                self.leaves[i] = bytes(data[offset : offset + 16])
+
+    def verified(self):
+        """叶子是否已收齐且与根一致"""
+
+        return None not in self.leaves and self.compute_root() == self.root
+
+    def span(self, index, size):
+        """第index块在文件中的[起点, 终点)"""
+
+        return index * self.chunk, min((index + 1) * self.chunk, size)
+
+
+def send_tree(tree, udpsocket, package, sign, destaddr, log):
+    """发送方握手后把叶子分页发给接收方，阻塞直到完成，见send_tree_steps"""
+
+    return run(send_tree_steps(tree, udpsocket, package, sign, destaddr, log), udpsocket, package.size)
+
+
+def send_tree_steps(tree, udpsocket, package, sign, destaddr, log):
+    """发送方握手后把叶子分页发给接收方，作为握手的步骤（见config.Steps）
+    - 每页报文的窗口字段为TREE_PAGE，序号为页号，接收方收到后回复相同窗口字段和序号的空报文
+    - 每轮发出所有未确认的页，连续超时5次放弃，接收方没有收齐叶子时不检查分块
+    - 返回是否全部确认
+    """
+
+    pending = set(range(tree.pages(package.MSS)))
+    cnt = 0
+    while pending and cnt < 5:
+        for index in sorted(pending):
+            udpsocket.sendto(package.pack(sign, TREE_PAGE, index, tree.page(index, package.MSS)), destaddr)
+        try:
+            while pending:
+                raw, addr = yield from recv(Minimum_RTO)
+                try:
+                    s, rwnd, index, data = package.unpack(raw)
+                except Exception:
+                    continue
+                if s == sign and rwnd == TREE_PAGE:
+                    pending.discard(index)
+        except timeout:
+            cnt += 1
+            log.warning(f"Timeout while sending merkle tree, resending {len(pending)} page{'s' if len(pending) > 1 else ''}......")
+    if pending:
+        log.warning(f"Unable to send merkle tree, chunks will not be verified.")
+    else:
+        log.info(f"Send merkle tree of {tree.count} chunks")
+    return not pending
+
+
+def received_tree(tree, log):
+    """接收方握手后检查收到的叶子，收齐且与根一致时返回tree，否则返回None，不逐块检查"""
+
+    if tree is None:
+        return None
+    if not tree.verified():
+        log.warning(f"Merkle tree incomplete or mismatched, chunks will not be verified.")
+        return None
+    log.info(f"Receive merkle tree of {tree.count} chunks")
+    return tree
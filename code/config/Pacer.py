@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+import time
+from .config import *
+
+
+class Pacer(object):
+    """令牌桶发送节奏控制
+    - 令牌按rate（报文/秒）匀速产生，最多积攒burst个，每发送一个报文消耗一个令牌
+    - 新报文令牌不足时，发送线程等到令牌产生的时刻再发送，把一个窗口的报文均匀地分散到一个RTT内
+    - 重传、修复和校验报文排队，由发送线程在有令牌时发出，先于新报文；接收ACK的线程只排队，不会因pacing阻塞
+    - 结束报文发出后，发送线程继续按令牌发出排队的报文，直到所有报文都已确认
+    - 内部加锁
+    """
+
+    def __init__(self, burst=pacing_burst):
+        """初始化函数
+        - burst 令牌桶容量，允许连续发送的报文数量
+        """
+
+        self.burst = burst
+        self.tokens = burst
+        # rate为None时不限制发送速率
+        self.rate = None
+        self.stamp = time.monotonic()
+        self.lock = Lock()
+
+    def set_rate(self, rate):
+        """更新发送速率，rate为None或非正数时不限制"""
+
+        self.rate = rate if rate and rate > 0 else None
+
+    def delay(self):
+        """不取令牌，返回还要等待多少秒才有一个完整的令牌"""
+
+        with self.lock:
+            if self.rate is None:
+                return 0
+            tokens = min(self.burst, self.tokens + (time.monotonic() - self.stamp) * self.rate)
+            return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self):
+        """取一个令牌，返回发送前需要等待的秒数，令牌可以预支，等待结束时正好产生"""
+
+        with self.lock:
+            now = time.monotonic()
+            if self.rate is None:
+                self.stamp = now
+                return 0
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from struct import Struct, error
+from .config import *
+
+
+class Package(object):
+    """报文结构类
+    - version 1：!HHI{MSS}s，签名、窗口、序号，数据段补零到MSS长度，所有报文长度相同
+    - version 2：!BHHIH + 数据段，版本、签名、窗口、序号、数据段长度，数据段只携带实际数据，ACK报文只有十几个字节
+    - version 3：!BBHHIH + 数据段，版本之后多一个标志字节，结束、请求rwnd等特殊标识由标志位表示，窗口字段不再与特殊标识共用取值
+    - version 3的标志字节高4位为窗口的缩放位数（窗口缩放选项），窗口超过16位时右移放入窗口字段，可以通告几百万个报文的窗口
+    - pack/unpack与struct.Struct的用法一致，返回(sign, rwnd, seq, data)，rwnd在内存中仍用特殊标识的取值表示
+    """
+
+    def __init__(self, MSS, version):
+        """初始化函数
+        - MSS 数据段的最大长度
+        - version 报文版本，由握手协商
+        """
+
+        self.MSS = int(MSS)
+        self.version = int(version)
+        if self.version == 1:
+            self.header = Struct("!HHI")
+            self.full = Struct(f"!HHI{self.MSS}s")
+        elif self.version == 2:
+            self.header = Struct("!BHHIH")
+        else:
+            self.header = Struct("!BBHHIH")
+        # 报文的最大长度，用于接收缓冲区大小
+        self.size = self.header.size + self.MSS
+        # 数据段是否需要补零到MSS长度
+        self.padded = self.version == 1
+
+    def pack(self, sign, rwnd, seq, data):
+        """制作报文"""
+
+        if self.padded:
+            return self.full.pack(sign, rwnd, seq, data)
+        if len(data) > self.MSS:
+            raise error(f"data is longer than MSS {self.MSS}")
+        if self.version == 2:
+            return self.header.pack(self.version, sign, rwnd, seq, len(data)) + data
+        flags, window = self.encode(rwnd)
+        return self.header.pack(self.version, flags, sign, window, seq, len(data)) + data
+
+    def pack_header_into(self, buf, sign, rwnd, seq, length):
+        """把报文头写入预分配的缓冲区buf，数据段由调用者另外发送
+        - length 数据段的实际长度，version 1时由调用者补零
+        """
+
+        if self.padded:
+            self.header.pack_into(buf, 0, sign, rwnd, seq)
+        elif self.version == 2:
+            self.header.pack_into(buf, 0, self.version, sign, rwnd, seq, length)
+        else:
+            flags, window = self.encode(rwnd)
+            self.header.pack_into(buf, 0, self.version, flags, sign, window, seq, length)
+
+    def encode(self, rwnd):
+        """version 3中把窗口字段的取值拆成(标志字节, 窗口字段)
+        - 特殊标识只置标志位，窗口字段为0
+        - 窗口超过16位时按需右移，缩放位数放在标志字节的高4位，低位的误差只会让通告的窗口略小
+        """
+
+        if rwnd in package_flags:
+            return package_flags[rwnd], 0
+        scale = max(rwnd.bit_length() - 16, 0)
+        return scale << scale_shift, rwnd >> scale
+
+    def decode(self, flags, window):
+        """encode的逆过程，返回特殊标识或还原后的窗口"""
+
+        kind = flags & flag_mask
+        for rwnd, flag in package_flags.items():
+            if kind == flag:
+                return rwnd
+        if kind:
+            raise error(f"unknown package flags {flags:#04x}")
+        return window << (flags >> scale_shift)
+
+    def window(self, rwnd):
+        """ACK中通告的接收窗口
+        - version 1/2的窗口字段与特殊标识共用取值，窗口限制在最小的标识之下
+        - version 3只需避开特殊标识本身的取值，窗口可以超过16位
+        """
+
+        if self.version < 3:
+            return min(rwnd, min(package_flags) - 1)
+        return rwnd - 1 if rwnd in package_flags else rwnd
+
+    def unpack(self, raw):
+        """解析报文，返回(sign, rwnd, seq, data)"""
+
+        if self.padded:
+            return self.full.unpack(raw)
+        if self.version == 2:
+            version, sign, rwnd, seq, length = self.header.unpack_from(raw)
+        else:
+            version, flags, sign, window, seq, length = self.header.unpack_from(raw)
+            rwnd = self.decode(flags, window)
+        if version != self.version:
+            raise error(f"unexpected package version {version}, expect {self.version}")
+        data = raw[self.header.size : self.header.size + length]
+        if len(data) != length:
+            raise error(f"truncated package, expect {length} bytes data but got {len(data)}")
+        return sign, rwnd, seq, data
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+from socket import AF_INET, IPPROTO_IP, SOCK_DGRAM, socket, timeout
+from .config import *
+from .Ticket import check_token, issue_token
+
+# python的socket模块里没有定义，Linux的取值
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_PROBE = 3
+
+
+def dont_fragment(udpsocket):
+    """发送的报文DF置位，超过路径MTU时被丢弃而不是分片，只在Linux上设置
+    - 使用IP_PMTUDISC_PROBE：不按内核记录的路径MTU拒绝发送，报文大小由探测结果决定，超过本机网卡MTU时发送报错
+    - 返回是否设置成功
+    """
+
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        udpsocket.setsockopt(IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+        return True
+    except OSError:
+        return False
+
+
+def probe_packet(size, token=b""):
+    """size字节的探测报文：类型、报文大小、探测令牌，之后补零；size为0时是请求令牌的报文，补零到比端口请求长"""
+
+    return (opening_kind.pack(opening_probe) + probe_body.pack(size) + token).ljust(max(size, reMSS_size + 1), b"\x00")
+
+
+def probe_size(raw):
+    """回显的探测报文的大小，不是探测报文时返回None"""
+
+    if len(raw) < opening_kind.size + probe_body.size:
+        return None
+    (kind,) = opening_kind.unpack_from(raw)
+    (size,) = probe_body.unpack_from(raw, opening_kind.size)
+    if kind != opening_probe or size != len(raw):
+        return None
+    return size
+
+
+def answer_probe(key, raw, host):
+    """服务端处理发往hostport的探测报文，返回要回复的报文，不回复时返回None
+    - key 服务端的密钥
+    - raw 收到的探测报文，host 发来探测报文的ip
+    - 请求令牌的报文回复签发给这个ip的令牌，回复比请求短，不会放大流量
+    - 其余探测报文附上的令牌有效时原样回显，否则不回复，服务端不会向伪造的源地址回显大报文
+    """
+
+    head = opening_kind.size + probe_body.size
+    if len(raw) < head:
+        return None
+    (size,) = probe_body.unpack_from(raw, opening_kind.size)
+    if size == 0:
+        return opening_kind.pack(opening_probe) + probe_body.pack(0) + issue_token(key, host)
+    if size != len(raw) or not check_token(key, raw[head : head + token_size], host):
+        return None
+    return raw
+
+
+def request_token(udpsocket, destaddr):
+    """向服务端hostport请求探测令牌，pmtu_probe_rounds轮都没有回复时返回None
+    - 旧服务端原样回显请求令牌的报文，得到全零的令牌，旧服务端回显探测报文时不检查令牌
+    """
+
+    head = opening_kind.size + probe_body.size
+    for _ in range(pmtu_probe_rounds):
+        udpsocket.sendto(probe_packet(0), destaddr)
+        deadline = time.monotonic() + pmtu_probe_timeout
+        try:
+            while True:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    break
+                udpsocket.settimeout(remain)
+                raw, addr = udpsocket.recvfrom(udp_max)
+                if addr != destaddr or len(raw) < head + token_size:
+                    continue
+                (kind,) = opening_kind.unpack_from(raw)
+                (size,) = probe_body.unpack_from(raw, opening_kind.size)
+                if kind == opening_probe and size == 0:
+                    return raw[head : head + token_size]
+        except timeout:
+            pass
+    return None
+
+
+def probe_path(destaddr, log):
+    """探测到服务端的路径MTU（DPLPMTUD），返回本次会话的MSS
+    - 探测使用单独的socket，迟到的回显不会被当作握手的回复
+    - 先向服务端请求探测令牌，探测报文附上令牌服务端才回显，见answer_probe
+    - 按pmtu_links中常见链路的MTU构造探测报文一次全部发出，超过本机网卡MTU的报文发送时报错，直接跳过
+    - 服务端hostport原样回显探测报文，收到回显说明该大小的报文双向都能不分片通过
+    - 第一个回显到达后再等待pmtu_probe_wait收其余回显，取最大的大小；没有回显时重发，pmtu_probe_rounds轮都没有回显（丢包或旧服务端）时使用pmtu_base
+    - MSS为通过的UDP数据大小减去报文头
+    """
+
+    sizes = sorted({min(link - ip_overhead, udp_max) for link in pmtu_links}, reverse=True)
+    udpsocket = socket(AF_INET, SOCK_DGRAM)
+    dont_fragment(udpsocket)
+    best = None
+    token = request_token(udpsocket, destaddr)
+    for _ in range(pmtu_probe_rounds if token is not None else 0):
+        for size in sizes:
+            try:
+                udpsocket.sendto(probe_packet(size, token), destaddr)
+            except OSError:
+                continue
+        deadline = time.monotonic() + pmtu_probe_timeout
+        try:
+            while best != sizes[0]:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    break
+                udpsocket.settimeout(remain)
+                raw, addr = udpsocket.recvfrom(udp_max)
+                size = probe_size(raw)
+                if addr != destaddr or size is None:
+                    continue
+                if best is None:
+                    deadline = min(deadline, time.monotonic() + pmtu_probe_wait)
+                best = max(best or 0, size)
+        except timeout:
+            pass
+        if best is not None:
+            break
+    udpsocket.close()
+    if best is None:
+        log.warning(f"No echo of path MTU probes from {destaddr}, using {pmtu_base} bytes datagrams.")
+        best = pmtu_base
+    else:
+        log.info(f"Path MTU to {destaddr}: {best + ip_overhead} bytes")
+    return best - pmtu_header
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from config.util import check_fileinfo
+from config.util import O_BINARY, fdatasync, md5_cache, md5_file, md5sum, pack_sack, pread, pwrite, unpack_sack
+import math
 from genericpath import exists
 from threading import *
 from socket import AF_INET, SOCK_DGRAM, socket, timeout
@@ -11,16 +12,28 @@ import numpy as np
 import os
 from .config import *
 from .Logger import *
+from .Transport import make_io, size_buffers
+from .Package import Package
+from .Fec import FecDecoder
+from .Compress import StreamDecoder
 
 
 class Receiver(object):
     """接收类
     - 用于接收文件
     - 一个进程负责接收数据，取出数据端放入缓冲区，并发送ACK报文
-    - 一个进程负责从缓冲区取出数据，写入文件
+    - 一个进程负责从缓冲区取出数据，合并成write_coalesce大小的块后用pwrite写到文件的相应位置
+    - 写入的同时计算md5码，接收完毕后检查文件不需要再读一遍
+    - 压缩传输时写文件进程先解压再写入
+    - 有Merkle树时写入的同时逐块检查，收到结束报文后请求发送方重发检查失败的分块，全部修复后才确认结束报文
+    - 接收窗口自动调整：缓冲区从default_rwnd个报文开始，按写文件的速度和RTT扩大，不超过内存预算
+    - 延迟确认：每ack_every个按序报文回复一个累计确认的ACK，其余的最多延迟ack_delay秒，乱序或结束时立即确认
     """
 
-    def __init__(self, destaddr, sign, file, offset, udpsocket, num, data, log, MSS, filesize, filemd5):
+    # IO层的实现，见config.Transport.make_io
+    io_backend = io_backend
+
+    def __init__(self, destaddr, sign, file, offset, udpsocket, num, data, log, MSS, filesize, filemd5, version=1, total=None, tree=None, codec=None, streamsize=None):
         """初始化函数
         - destaddr 发送方(ip, port)
         - sign 传输的报文签名
@@ -33,43 +46,152 @@ class Receiver(object):
         - MSS 发送的数据报文的数据段的最大长度
         - filesize 要接收的文件大小
         - filemd5 接收文件的md5码
+        - version 握手协商的报文版本
+        - total 分段接收时整个文件的大小，此时只接收文件的[offset, filesize)区间，写到文件的相应位置，filemd5为区间的md5码
+        - tree 已收齐叶子的Merkle树，None表示不逐块检查
+        - codec 压缩算法，None表示不压缩
+        - streamsize 压缩后的数据大小，压缩传输时按它计算报文数量
         """
 
         self.destaddr = destaddr
         self.sign = sign
         self.udpsocket = udpsocket
-        self.udpsocket.settimeout(time_limit)
         self.file = file
         self.offset = offset
         # 要发送的报文使用的编号
         self.seq = num
         self.data = data
+        # 缓冲区的空位，缓冲区的大小（报文数量）
         self.rwnd = default_rwnd
+        self.capacity = default_rwnd
+        # 估计的RTT；测量RTT的窗口边界：(通告窗口时窗口右边界的序号, 通告的时间)
+        self.rtt = None
+        self.mark = None
+        # 写文件进程已写出的数据量和所用的时间，用于估计写文件的速度
+        self.drained = 0
+        self.busy = 0.0
         self.log = log
         # buffer用双端队列实现，python文档说是进程安全的，内部已经实现了锁
         self.buffer = deque()
+        # 乱序到达的报文，序号 -> (窗口字段, 数据段)，等缺失的报文到达后再按序交付
+        self.ooo = {}
+        # 是否已按序收到结束报文
+        self.finished = False
+        # 最近一次发送的ACK报文，超时或收到重复报文时重发
+        self.pkg = None
+        # 连续收到重复报文的次数
+        self.dups = 0
+        # 连续超时次数
+        self.timeouts = 0
+        # 还没确认的按序报文数量，延迟的ACK最晚的发送时间，逐个确认到该序号为止
+        self.unacked = 0
+        self.deadline = None
+        self.quick = num + ack_quick
         self.status = status.CLOSE
+        # 接收或写文件进程出错中止，另一个进程不再等待它
+        self.failed = False
         # 锁，因为有两个进程会更新rwnd,防止写冲突
         self.lock = Lock()
+        # 条件变量，缓冲区有数据、缓冲区有空位、接收结束时唤醒等待的进程
+        self.cond = Condition(self.lock)
         self.MSS = int(MSS)
         # 数据报文结构
-        self.package = Struct(f"!HHI{self.MSS}s")
+        self.package = Package(self.MSS, version)
         self.MSS_size = self.package.size
+        # 收发报文的IO层，支持时批量收发
+        self.io = make_io(udpsocket, self.MSS_size, self.io_backend)
+        self.io.settimeout(time_limit)
+        # 系统限制了socket接收缓冲区的上限时，缓冲区放不下的报文会在内核中丢弃，通告的窗口不超过实际能容纳的报文数量
+        self.capacity = self.rwnd = self.granted(default_rwnd)
         self.file_size = int(filesize)
-        self.total_package = int(np.ceil((self.file_size - self.offset) / self.MSS) + self.seq)
+        self.total_package = int(np.ceil((self.file_size - self.offset if streamsize is None else int(streamsize)) / self.MSS) + self.seq)
         self.filemd5 = filemd5
+        self.total = total
+        # 接收到的文件是否完整，check之后有效
+        self.correct = False
+        # 文件描述符，下一次写入的文件位置，还未写入的连续数据
+        self.fd = None
+        self.position = self.offset
+        self.pending = bytearray()
+        # 已写入数据的md5，续传时先计算offset之前已有的内容
+        self.hasher = md5sum()
+        # Merkle树，当前分块已写入数据的md5
+        self.tree = tree
+        self.chunk_hasher = md5sum()
+        # 检查失败的分块，修复时还没收到的报文编号（文件偏移除以MSS），最近一次请求修复的报文编号
+        self.bad = set()
+        self.missing = set()
+        self.requested = set()
+        # 写文件进程是否已写完并检查了所有分块，是否修复过分块
+        self.verified = False
+        self.repaired = False
+        # 结束报文的ACK，所有分块检查通过后才发送
+        self.final = None
+        # 前向纠错，收到第一个校验报文时创建
+        self.fec = None
+        # 一次往返握手时服务端在回复中签发的地址验证令牌，附在每个ACK前
+        self.token = None
+        # 压缩传输时的解压器，解压出错后丢弃之后的数据
+        self.decoder = StreamDecoder(codec) if codec is not None else None
+        self.corrupt = False
 
     def receive(self):
         """接收数据函数
         - 先处理上级（客户端或服务端）收到的第一份数据
-        - 然后接收数据
-        - 如果接收到的报文是结束报文，则接收完毕
-        - 如果接收到的报文序号不对，则重发上次ACK
-        - 如果接收到的报文序号正确，取出数据段放入缓冲区buffer，并发送ACK报文
-        - 如果接收到的报文序号正确且是请求rwnd报文，则正常回复ACK，不放入缓冲区buffer
+        - 然后接收数据，逐批交给handle_packages处理，直到收到结束报文
+        - 缓冲区buffer已满时等待写文件进程腾出空位，写文件进程出错时中止
+        - 出错时中止，唤醒等待数据的写文件进程
         """
 
+        try:
+            self.receive_packages()
+        except Exception as e:
+            self.log.err(f"Error occured while receiving: {e}, aborted.")
+            self.abort()
+
+    def receive_packages(self):
+        """接收数据的循环，见receive"""
+
         self.log.info("Receiving start")
+        self.handle_first()
+        limit = time_limit
+        while True:
+            if self.failed:
+                break
+            # 如果收到的是结束报文，修复检查失败的分块后结束接收
+            if self.finished:
+                if self.tree is not None:
+                    self.settle()
+                self.close()
+                break
+            # 如果自身buffer已满，暂停接收，直到写文件进程腾出空位
+            if self.rwnd <= 0:
+                self.flush_ack()
+                self.log.info(f"Buffer is full, waiting for writing......")
+                with self.cond:
+                    # 写文件慢时最多等待time_limit秒，之后回到循环，期间发送方会询问rwnd
+                    if not self.cond.wait_for(lambda: self.rwnd > 0 or self.failed, time_limit):
+                        self.log.warning(f"{time_limit} seconds writing no data, still waiting......")
+                continue
+            # 有延迟的ACK时，最多等到它的发送时间
+            wait = time_limit if self.deadline is None else max(self.deadline - time.monotonic(), 0.001)
+            if wait != limit:
+                self.io.settimeout(wait)
+                limit = wait
+            try:
+                packages = self.io.recv(self.MSS_size)
+            except timeout:
+                if self.deadline is not None:
+                    self.flush_ack()
+                    continue
+                if not self.handle_timeout():
+                    break
+                continue
+            self.handle_packages(packages)
+
+    def handle_first(self):
+        """处理上级（客户端或服务端）收到的第一份数据，并回复ACK"""
+
         self.log.info(f"Expect package {self.seq}")
         rwnd = 0
         data = []
@@ -82,130 +204,561 @@ class Receiver(object):
                 f"Unable to unpack received package due to the error : {e}, droped."
             )
         # 判断是否是终止报文，由特殊的rwnd标识，因为发送方的rwnd是无用的
-        if rwnd != DONE:
-            self.buffer.append(data[:rwnd])
-        # 防止与write函数里的rwnd修改产生写冲突造成数据不对
-        self.lock.acquire()
-        self.rwnd -= 1
-        self.lock.release()
+        self.deliver(rwnd, data)
         # 发送数据段为空的ACK报文
-        pkg = self.package.pack(sign, self.rwnd, seq, "".encode())
-        self.udpsocket.sendto(pkg, self.destaddr)
+        self.pkg = self.ack(seq)
+        self.io.sendto(self.pkg, self.destaddr)
         self.log.info(f"Receive package {self.seq}/{self.total_package}")
         self.seq += 1
-        cnt = 0
-        # 是否因为三次不正确报文而重发
-        ok = 0
-        while True:
-            # 如果收到的是结束报文，结束接收
-            if rwnd == DONE:
-                self.status = status.CLOSE
+
+    def handle_packages(self, packages):
+        """处理一批数据报文
+        - packages [(报文, 地址), ...]，批量接收时一次可能收到多个报文，结束报文之后的报文不再处理，修复分块时除外
+        - 处理完后把排队的ACK发出去
+        """
+
+        for raw, dstaddr in packages:
+            if self.finished and not self.missing:
                 break
-            # 如果自身buffer已满，暂停接收
-            while self.rwnd == 0:
-                self.log.info(f"Buffer is full, sleeping for 0.05s......")
-                time.sleep(0.05)
+            self.handle(raw)
+        # 把处理这批报文时排队的ACK发出去，延迟的ACK到期时一并发出
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.send_ack(self.seq - 1)
+        self.io.flush()
+        self.timeouts = 0
+
+    def handle(self, raw):
+        """处理一个数据报文
+        - 如果接收到的报文是结束报文，则接收完毕
+        - 如果接收到的报文序号超前，放入乱序缓冲区，并回复带SACK信息的ACK
+        - 如果接收到的报文序号正确，交付数据段，并把乱序缓冲区中与之连续的报文一并交付，然后发送ACK报文
+        - 如果接收到的报文序号正确且是请求rwnd报文，则正常回复ACK，不交付数据
+        - 如果接收到的是修复报文，写回文件的相应位置
+        - 如果接收到的是前向纠错的校验报文，还原组内缺失的报文
+        """
+
+        sign = 0
+        seq = 0
+        rwnd = 0
+        try:
+            sign, rwnd, seq, data = self.package.unpack(raw)
+        except Exception as e:
+            self.log.warning(
+                f"Unable to unpack received package due to the error : {e}, droped."
+            )
+        # 防止无关报文影响
+        if sign != self.sign:
+            self.log.warning(f"Receive an unknown sign package, droped.")
+        # 收到修复报文
+        elif seq & repair_flag:
+            self.repair_piece(seq ^ repair_flag, data[:rwnd])
+        # 收到校验报文
+        elif seq & fec_flag:
+            if self.fec is None:
+                self.log.info(f"Receive parity package, enable forward error correction")
+                self.fec = FecDecoder(self.MSS)
+            self.recover(self.fec.parity(seq, rwnd, data, self.seq))
+        elif self.fec is not None:
+            rebuilt = self.fec.record(seq, rwnd, data, self.seq)
+            self.accept(seq, rwnd, data)
+            self.recover(rebuilt)
+        else:
+            self.accept(seq, rwnd, data)
+
+    def recover(self, packets):
+        """处理由校验报文还原的报文"""
+
+        for seq, rwnd, data in packets:
+            self.log.info(f"Recover package {seq} by parity")
+            self.accept(seq, rwnd, data)
+
+    def accept(self, seq, rwnd, data):
+        """按序号处理一个数据报文"""
+
+        # 收到乱序数据包，放入乱序缓冲区，回复带SACK的ACK
+        if seq > self.seq:
+            if seq not in self.ooo and len(self.ooo) < max(max_ooo_package, self.capacity):
+                self.ooo[seq] = (rwnd, data)
+            self.log.warning(
+                f"Receive an out-of-order package: Expect {self.seq}, but got {seq}, buffered {len(self.ooo)} package{'s' if len(self.ooo) > 1 else ''}"
+            )
+            self.send_ack(self.seq - 1)
+        # 收到正确数据包
+        elif seq == self.seq:
+            self.log.info(f"Receive package {self.seq}/{self.total_package}")
+            # 填补了空洞、请求rwnd、慢启动初期立即确认
+            urgent = len(self.ooo) > 0 or rwnd == GetWindowsSize or self.seq < self.quick
+            self.deliver(rwnd, data)
+            # 把乱序缓冲区中紧接着的报文一并交付
+            while not self.finished and self.seq + 1 in self.ooo:
+                self.seq += 1
+                self.deliver(*self.ooo.pop(self.seq))
+            self.unacked += 1
+            if urgent or self.finished or self.unacked >= ack_every:
+                self.send_ack(self.seq)
+            elif self.deadline is None:
+                self.deadline = time.monotonic() + ack_delay
+            self.seq += 1
+            self.dups = 0
+            self.autotune()
+        # 收到重复数据包，重发ACK，避免对同一批重复报文回复太多ACK
+        elif seq < self.seq:
+            self.dups += 1
+            self.log.warning(
+                f"Receive an duplicated package {seq}, expect {self.seq}, resending {self.seq - 1} ACK"
+            )
+            if self.deadline is not None:
+                self.send_ack(self.seq - 1)
+            elif self.dups <= 1:
+                self.io.queue([self.pkg], self.destaddr)
+        # 逻辑上不会到这里
+        else:
+            self.log.warning(f"Here shouldn't reach!")
+
+    def send_ack(self, seq):
+        """回复累计确认到seq的ACK，代替所有延迟的ACK
+        - 逐块检查时，先不确认结束报文，等所有分块检查通过
+        """
+
+        self.pkg = self.ack(seq)
+        if self.finished and self.tree is not None:
+            self.final = self.pkg
+            self.pkg = self.ack(seq - 1)
+        self.io.queue([self.pkg], self.destaddr)
+        self.log.info(
+            f"Sending {'Final ' if self.finished else ''}ACK {seq}/{self.total_package}"
+        )
+        self.unacked = 0
+        self.deadline = None
+
+    def flush_ack(self):
+        """立即发出延迟的ACK"""
+
+        if self.deadline is not None:
+            self.send_ack(self.seq - 1)
+            self.io.flush()
+
+    def handle_timeout(self):
+        """接收数据超时
+        - 预留了较长接收时间，如果无数据接收，尝试重发一遍ACK报文
+        - 连续超时5次，认为出现问题，停止接收，返回False
+        """
+
+        self.io.sendto(self.pkg, self.destaddr)
+        self.timeouts += 1
+        if self.timeouts == 5:
+            self.log.warning(
+                f"{time_limit} seconds not receive package, there may be something wrong. Aborted."
+            )
+            self.close()
+            return False
+        self.log.warning(
+            f"{time_limit} seconds not receive package, Resending ACK."
+        )
+        return True
+
+    def settle(self):
+        """收到结束报文后，等待写文件进程写完并检查所有分块，修复检查失败的分块"""
+
+        with self.cond:
+            self.cond.notify_all()
+            while not self.cond.wait_for(lambda: self.verified or self.failed, time_limit):
+                self.log.warning(f"{time_limit} seconds not finish writing, still waiting......")
+        if self.failed or self.begin_repair():
+            return
+        self.io.settimeout(repair_timeout)
+        while self.missing:
             try:
-                raw, dstaddr = self.udpsocket.recvfrom(self.MSS_size)
+                packages = self.io.recv(self.MSS_size)
             except timeout:
-                # 预留了较长接收时间，如果无数据接收，尝试重发一遍ACK报文
-                self.udpsocket.sendto(pkg, self.destaddr)
-                cnt += 1
-                if cnt == 5:
-                    self.log.warning(
-                        f"{time_limit} seconds not receive package, there may be something wrong. Aborted."
-                    )
-                    self.status = status.CLOSE
+                if not self.retry_repair():
                     break
-                self.log.warning(
-                    f"{time_limit} seconds not receive package, Resending ACK."
-                )
                 continue
-            try:
-                sign, rwnd, seq, data = self.package.unpack(raw)
-            except Exception as e:
-                self.log.warning(
-                    f"Unable to unpack received package due to the error : {e}, droped."
-                )
-            # 防止无关报文影响
-            if sign != self.sign:
-                self.log.warning(f"Receive an unknown sign package, droped.")
-            # 收到乱序数据包，重发ACK
-            elif seq > self.seq:
-                ok += 1
-                self.log.warning(
-                    f"Receive an uncorrect seq package: Expect {self.seq}, but got {seq}, {'resend ACK' if ok <= 3 else 'droped'}"
-                )
-                # 如果已经重发了，没必要再重发，不然导致发送端重发很多次
-                if ok <= 3:
-                    pkg = self.package.pack(self.sign, self.rwnd, self.seq - 1, "".encode())
-                    self.udpsocket.sendto(pkg, self.destaddr)
-                rwnd = 0
-            # 收到正确数据包
-            elif seq == self.seq:
-                self.log.info(f"Receive package {self.seq}/{self.total_package}")
-                if rwnd != DONE and rwnd != GetWindowsSize:
-                    self.buffer.append(data[:rwnd])
-                    self.lock.acquire()
-                    self.rwnd -= 1
-                    self.lock.release()
-                elif rwnd == GetWindowsSize:
-                    self.total_package += 1
-                pkg = self.package.pack(self.sign, self.rwnd, self.seq, "".encode())
-                self.udpsocket.sendto(pkg, self.destaddr)
-                self.log.info(
-                    f"Sending {'Final ' if rwnd == DONE else ''}ACK {self.seq}/{self.total_package}"
-                )
-                self.seq += 1
-                ok = 0
-            # 收到重复数据包，重发ACK
-            elif seq < self.seq:
-                ok += 1
-                self.log.warning(
-                    f"Receive an duplicated package {seq}, expect {self.seq}, resending {self.seq - 1} ACK"
-                    # f"Receive an duplicated package {seq}, expect {self.seq}, droped"
-                )
-                if ok <= 1:
-                    self.udpsocket.sendto(pkg, self.destaddr)
-            # 逻辑上不会到这里
+            self.handle_packages(packages)
+        self.io.settimeout(time_limit)
+
+    def begin_repair(self):
+        """所有分块检查完毕，没有检查失败的分块时确认结束报文并返回True，否则请求发送方重发"""
+
+        if not self.bad:
+            self.confirm()
+            return True
+        self.repaired = True
+        self.log.warning(f"{len(self.bad)} chunk{'s' if len(self.bad) > 1 else ''} UNCORRECT, request repair")
+        for index in self.bad:
+            self.missing.update(self.chunk_pieces(index))
+        self.request_repair()
+        return False
+
+    def chunk_pieces(self, index):
+        """第index块包含的报文编号"""
+
+        start, end = self.tree.span(index, self.file_size)
+        return range(start // self.MSS, math.ceil(end / self.MSS))
+
+    def request_repair(self):
+        """请求发送方重发还没收到的报文，每次最多repair_window个"""
+
+        data = pack_sack(sorted(self.missing)[:repair_window])
+        # 区间数量有限，以实际打包的区间为准
+        self.requested = {piece for start, end in unpack_sack(data) for piece in range(start, end + 1)}
+        self.io.sendto(self.package.pack(self.sign, REPAIR, self.seq - 1, data), self.destaddr)
+        self.log.info(f"Request repair of {len(self.requested)} package{'s' if len(self.requested) > 1 else ''}")
+
+    def retry_repair(self):
+        """修复报文超时，重新请求，连续超时5次放弃并返回False"""
+
+        self.timeouts += 1
+        if self.timeouts == 5:
+            self.log.warning(f"Unable to repair {len(self.bad)} chunk{'s' if len(self.bad) > 1 else ''}. Aborted.")
+            return False
+        self.log.warning(f"{repair_timeout} seconds not receive repair package, request again.")
+        self.request_repair()
+        return True
+
+    def repair_piece(self, piece, data):
+        """收到修复报文，写回文件，所在分块的报文收齐后从文件重新检查"""
+
+        if piece not in self.missing:
+            return
+        self.write_piece(piece, data)
+        self.piece_written(piece)
+
+    def write_piece(self, piece, data):
+        """把修复报文的数据写回文件的相应位置"""
+
+        pwrite(self.fd, data, piece * self.MSS)
+
+    def piece_written(self, piece):
+        """修复报文已写回，所在分块的报文收齐后从文件重新检查，全部修复后确认结束报文，否则继续请求"""
+
+        self.missing.discard(piece)
+        self.requested.discard(piece)
+        index = piece * self.MSS // self.tree.chunk
+        pieces = self.chunk_pieces(index)
+        if not any(p in self.missing for p in pieces):
+            if self.chunk_digest(index) == self.tree.leaves[index]:
+                self.bad.discard(index)
+                self.log.info(f"Chunk {index} repaired")
             else:
-                self.log.warning(f"Here shouldn't reach!")
-            cnt = 0
-        # 保存最后一个结束报文的ACK
-        self.pkg = pkg
+                self.missing.update(pieces)
+                self.log.warning(f"Chunk {index} still UNCORRECT, request again")
+        if not self.missing:
+            self.confirm()
+        elif not self.requested:
+            self.request_repair()
+
+    def chunk_digest(self, index):
+        """从文件读出第index块计算md5码"""
+
+        start, end = self.tree.span(index, self.file_size)
+        hasher = md5sum()
+        while start < end:
+            data = pread(self.fd, min(hash_chunk, end - start), start)
+            if not data:
+                break
+            hasher.update(data)
+            start += len(data)
+        return hasher.digest()
+
+    def check_chunks(self, data):
+        """把写入的数据计入所在分块，分块写完时与叶子比对，不一致的记入bad"""
+
+        position = self.position
+        while len(data) > 0:
+            index = position // self.tree.chunk
+            end = self.tree.span(index, self.file_size)[1]
+            n = min(len(data), end - position)
+            self.chunk_hasher.update(data[:n])
+            data = data[n:]
+            position += n
+            if position == end:
+                if self.chunk_hasher.digest() != self.tree.leaves[index]:
+                    self.bad.add(index)
+                    self.log.warning(f"Chunk {index} UNCORRECT")
+                self.chunk_hasher = md5sum()
+
+    def confirm(self):
+        """所有分块检查通过，确认结束报文"""
+
+        if self.final is None:
+            return
+        self.pkg = self.final
+        self.io.sendto(self.pkg, self.destaddr)
+        self.log.info(f"All chunks CORRECT, sending Final ACK {self.seq - 1}/{self.total_package}")
+
+    def deliver(self, rwnd, data):
+        """交付按序到达的报文
+        - rwnd 报文的窗口字段，数据报文为数据段长度，或为结束、请求rwnd的特殊标识
+        - data 报文数据段
+        """
+
+        if rwnd == DONE:
+            self.finished = True
+        elif rwnd == GetWindowsSize:
+            self.total_package += 1
+        else:
+            self.store(data[:rwnd])
+
+    def store(self, data):
+        """把按序到达的数据放入缓冲区，由写文件进程写入文件"""
+
+        # 防止与write函数里的rwnd修改产生写冲突造成数据不对，并唤醒写文件进程
+        with self.cond:
+            self.buffer.append(data)
+            self.rwnd -= 1
+            self.cond.notify_all()
+
+    def close(self):
+        """接收结束，唤醒等待数据的写文件进程"""
+
+        with self.cond:
+            self.status = status.CLOSE
+            self.cond.notify_all()
+
+    def abort(self):
+        """接收或写文件进程出错，中止接收，唤醒等待的另一个进程"""
+
+        with self.cond:
+            self.failed = True
+            self.status = status.CLOSE
+            self.cond.notify_all()
+
+    def ack(self, seq):
+        """制作ACK报文
+        - seq 已按序收到的最后一个报文序号
+        - 数据段携带乱序缓冲区中已收到报文的SACK信息，开启前向纠错时还有累计还原的报文数量
+        - 一次往返握手时数据段前附上地址验证令牌，服务端据此解除发送限制，ACK丢失时之后的ACK仍能验证
+        """
+
+        data = pack_sack(sorted(self.ooo))
+        if self.token is not None:
+            data = self.token + data
+        # 开启前向纠错时附上累计还原的报文数量，发送方据此估计丢包率
+        if self.fec is not None:
+            data += fec_report.pack(self.fec.recovered)
+        window = self.package.window(max(self.rwnd, 0))
+        # 记下这次通告的窗口右边界，收到边界上的报文时大约经过了一个RTT
+        if self.mark is None:
+            self.mark = (seq + window, time.monotonic())
+        return self.package.pack(self.sign, window, seq, data)
+
+    def drain(self, size, elapsed):
+        """写文件进程写出了size字节数据，用时elapsed秒"""
+
+        self.drained += size
+        self.busy += elapsed
+
+    def autotune(self):
+        """接收窗口自动调整（DRS）
+        - 按序收到通告窗口右边界上的报文时得到一个RTT的样本，取最小值，排除写文件慢时的排队时间
+        - 缓冲区扩大到写文件速度乘RTT的rcv_autotune_gain倍，写文件快于网络时由内存预算rcv_memory_budget限制
+        - 只扩大不缩小，已通告的窗口不会收回；同时扩大socket的接收缓冲区
+        """
+
+        if self.mark is None or self.seq <= self.mark[0]:
+            return
+        sample = time.monotonic() - self.mark[1]
+        self.mark = None
+        self.rtt = sample if self.rtt is None else min(self.rtt, sample)
+        if not rcv_autotune or self.busy <= 0:
+            return
+        rate = self.drained / self.busy
+        target = min(math.ceil(rcv_autotune_gain * rate * self.rtt / self.MSS), rcv_memory_budget // self.MSS_size)
+        if target <= self.capacity:
+            return
+        # 同时扩大socket的接收缓冲区，受系统上限限制时窗口只扩大到缓冲区实际能容纳的报文数量
+        target = self.granted(target)
+        if target <= self.capacity:
+            return
+        with self.cond:
+            self.rwnd += target - self.capacity
+            self.capacity = target
+            self.cond.notify_all()
+        self.log.info(f"Receive window grows to {target} packages, RTT {self.rtt * 1000:.2f}ms, writing {rate / 1024 / 1024:.2f}MB/s")
+
+    def granted(self, window):
+        """把socket的接收缓冲区扩大到能容纳window个报文，返回实际能容纳的报文数量，不超过window，不小于rcvbuf_min_window"""
+
+        fits = size_buffers(self.udpsocket, self.MSS_size * window) // self.MSS_size
+        if fits < window:
+            self.log.warning(f"Socket receive buffer holds only {fits} packages, limiting the window.")
+        return min(window, max(fits, rcvbuf_min_window))
 
     def write(self):
         """写文件
-        - 从缓冲区buffer中取出数据写入文件
+        - 等待接收进程交付数据，每次取出缓冲区buffer中的全部数据，合并到待写入的数据中
+        - 取出后归还rwnd并唤醒因缓冲区已满而等待的接收进程，待写入的数据最多积攒write_coalesce字节
+        - 逐块检查时，收到结束报文后写入剩余数据，检查完最后的分块后通知接收进程
+        - 出错时中止，唤醒接收进程，不再检查文件
+        """
+
+        try:
+            self.open_file()
+            self.write_packages()
+        except Exception as e:
+            self.log.err(f"Error occured while writing {self.file}: {e}, aborted.")
+            self.abort()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            return
+        self.check()
+
+    def writable(self):
+        """缓冲区有数据、接收结束，或逐块检查时已收到结束报文但还没检查完所有分块"""
+
+        return (
+            len(self.buffer) != 0
+            or self.status == status.CLOSE
+            or (self.tree is not None and self.finished and not self.verified)
+        )
+
+    def write_packages(self):
+        """写文件的循环，见write"""
+
+        while True:
+            with self.cond:
+                # 最多等待time_limit秒后重新检查，接收进程出错中止时不再写入
+                if not self.cond.wait_for(self.writable, time_limit):
+                    continue
+                if self.failed:
+                    break
+                if len(self.buffer) == 0:
+                    if self.status == status.CLOSE:
+                        break
+                    self.flush_pending()
+                    self.verified = True
+                    self.cond.notify_all()
+                    continue
+                chunks = list(self.buffer)
+                self.buffer.clear()
+                self.rwnd += len(chunks)
+                self.cond.notify_all()
+            start = time.monotonic()
+            for data in chunks:
+                self.consume(data)
+            self.drain(sum(len(data) for data in chunks), time.monotonic() - start)
+        self.close_file()
+
+    def consume(self, data):
+        """把按序到达的数据交给写入，压缩传输时先解压"""
+
+        if self.decoder is None:
+            self.coalesce(data)
+            return
+        if self.corrupt:
+            return
+        try:
+            blocks = self.decoder.feed(data)
+        except Exception as e:
+            self.log.err(f"Unable to decompress received data due to the error : {e}, discard the rest.")
+            self.corrupt = True
+            return
+        for block in blocks:
+            self.coalesce(block)
+
+    def coalesce(self, data):
+        """把按序到达的数据合并到待写入的数据中，积攒到write_coalesce字节后写入对齐的部分"""
+
+        self.pending += data
+        if len(self.pending) >= write_coalesce:
+            # 写到write_coalesce对齐的位置，剩下的不足一块的数据留到下次
+            end = (self.position + len(self.pending)) // write_coalesce * write_coalesce
+            self.flush_pending(end - self.position)
+
+    def flush_pending(self, size=None):
+        """用pwrite把待写入数据的前size字节写到文件的相应位置，size为None时全部写入"""
+
+        if size is None:
+            size = len(self.pending)
+        view = memoryview(self.pending)
+        done = 0
+        while done < size:
+            done += pwrite(self.fd, view[done:size], self.position + done)
+        self.hasher.update(view[:size])
+        if self.tree is not None:
+            self.check_chunks(view[:size])
+        view.release()
+        del self.pending[:size]
+        self.position += size
+        if write_flush == "chunk" and size > 0:
+            fdatasync(self.fd)
+
+    def open_file(self):
+        """打开要写入的文件，文件所在文件夹不存在时先创建文件夹
+        - 从头接收时清空文件，续传时保留offset之前的内容，所有数据都用pwrite写到指定位置
+        - 分段接收时多个接收者同时写一个文件，不截断已写入的内容，文件大小调整为整个文件的大小
+        - 按要接收的大小预先分配磁盘空间，不支持时忽略
+        - 续传时计算已有内容的md5码，之后随写入继续计算
+        - 逐块检查时以读写方式打开，修复时要读回分块重新检查
         """
 
-        # 文件所在文件夹不存在，先创建文件夹
         if not os.path.exists(self.file):
             self.log.info(f"{self.file} not exist, create")
             if "/" in self.file:
                 os.makedirs("/".join(self.file.split("/")[0:-1]), exist_ok=True)
         # 判断是断电续传还是重传
-        f = open(self.file, "wb") if self.offset == 0 else open(self.file, "ab")
+        flags = (os.O_RDWR if self.tree is not None else os.O_WRONLY) | os.O_CREAT | O_BINARY
+        if self.total is None and self.offset == 0:
+            flags |= os.O_TRUNC
+        self.fd = os.open(self.file, flags, 0o644)
+        if self.total is None and self.offset > 0:
+            md5_file(self.file, self.offset, self.hasher)
+        # 续传的起点不在分块边界时，先计算所在分块已有的内容
+        if self.tree is not None and self.offset % self.tree.chunk:
+            start = self.offset // self.tree.chunk * self.tree.chunk
+            md5_file(self.file, self.offset - start, self.chunk_hasher, start=start)
+        if self.total is not None and os.fstat(self.fd).st_size != self.total:
+            os.ftruncate(self.fd, self.total)
+        if write_preallocate and hasattr(os, "posix_fallocate") and self.file_size > self.offset:
+            try:
+                os.posix_fallocate(self.fd, self.offset, self.file_size - self.offset)
+            except OSError as e:
+                self.log.warning(f"Unable to preallocate {self.file} due to the error : {e}, ignore.")
         self.log.info(f"Open file {self.file}")
+        return self.fd
 
-        while self.status != status.CLOSE or len(self.buffer) != 0:
-            if len(self.buffer) == 0:
-                continue
-            data = self.buffer.popleft()
-            f.write(data)
-            self.lock.acquire()
-            self.rwnd += 1
-            self.lock.release()
-        f.close()
+    def close_file(self):
+        """写入剩余的数据并关闭文件
+        - 非分段接收时文件大小截断到实际写入的位置，异常中断时不保留预分配的空间，之后可以续传
+        """
+
+        self.flush_pending()
+        if self.total is None:
+            os.ftruncate(self.fd, self.position)
+        if write_flush != "none":
+            fdatasync(self.fd)
+        os.close(self.fd)
+        self.fd = None
         self.log.info(f"Close file {self.file}")
+
+    def check(self):
+        """检查接收到的文件的md5码，使用写入时计算的结果
+        - 修复过分块时写入时计算的md5码已失效，以所有分块检查通过为准
+        - 分段接收时只检查区间的md5码，旧客户端没有附上时不检查，由客户端最后请求检查整个文件
+        """
+
+        if self.total is not None:
+            self.log.info(f"Receive range [{self.offset}, {self.file_size}) of {self.file}")
+            if self.filemd5 is not None:
+                self.correct = self.position == self.file_size and self.hasher.hexdigest() == str(self.filemd5)
+                self.log.info(f"Range {'CORRECT' if self.correct else 'UNCORRECT'}!")
+            return
         self.log.info(f"check md5 {self.file}")
-        ans = check_fileinfo(self.file, [self.file_size, self.filemd5])
-        if ans == cosend:
+        if self.tree is not None and self.repaired:
+            correct = self.position == self.file_size and not self.bad
+        else:
+            correct = self.position == self.file_size and self.hasher.hexdigest() == str(self.filemd5)
+        if correct:
+            self.correct = True
             self.log.info(f"File CORRECT!")
+            # 记录收到的文件的md5码，之后的握手不需要重新计算
+            if md5_cache is not None:
+                md5_cache.put(self.file, str(self.filemd5))
         else:
             self.log.warning(f"File UNCORRECT!")
 
-
     def start(self):
         """启动函数
         - 创建一个进程负责接收数据包
@@ -224,4 +777,4 @@ class Receiver(object):
         t2.join()
         if self.total_package != self.seq - 1:
             self.log.warning(f"Stop unnormally!")
-        self.udpsocket.sendto(self.pkg, self.destaddr)
+        self.io.sendto(self.pkg, self.destaddr)
@@ -4,21 +4,35 @@
 from threading import *
 from socket import AF_INET, SOCK_DGRAM, socket, timeout
 from collections import deque
+from hmac import compare_digest
+from itertools import cycle, islice
+import mmap
+import math
 import time
-import numpy as np
 from .config import *
 from .Logger import *
+from .util import unpack_sack
+from .Transport import make_io
+from .Package import Package
+from .Congestion import make_congestion
+from .Pacer import Pacer
+from .Fec import FecEncoder, parity_group
 
 
 class Sender(object):
     """发送类
     - 用于发送文件
-    - 实现了流量控制、阻塞控制、动态调整RTT(RTO)，超时重传，回退N步的快速重传
+    - 实现了流量控制、可选算法的阻塞控制（Reno、CUBIC、BBR）、动态调整RTT(RTO)，超时重传，基于SACK的选择性快速重传
     - 一个进程负责发送数据
     - 一个进程负责接收ACK并作出相应反应（如重传）
+    - 接收方逐块检查时，按请求重发检查失败的分块
+    - 开启前向纠错时每组新报文之后发送一个校验报文
     """
 
-    def __init__(self, destaddr, sign, file, rwnd, offset, udpsocket, num, log, MSS, filesize):
+    # IO层的实现，见config.Transport.make_io
+    io_backend = io_backend
+
+    def __init__(self, destaddr, sign, file, rwnd, offset, udpsocket, num, log, MSS, filesize, version=1, congestion=congestion_control, pacing=pacing, fec=fec):
         """初始化函数
         - destaddr 接收方(ip, port)
         - sign 传输的报文签名
@@ -30,6 +44,10 @@ class Sender(object):
         - log 复用服务/客户端的log
         - MSS 发送的数据报文的数据段的最大长度
         - filesize 要发送的文件大小
+        - version 握手协商的报文版本
+        - congestion 阻塞控制算法的名称，见config.Congestion
+        - pacing 是否按令牌桶控制发送节奏，把窗口内的报文分散到一个RTT内发送
+        - fec 是否发送前向纠错的校验报文
         """
 
         self.destaddr = destaddr
@@ -41,191 +59,412 @@ class Sender(object):
         self.unackseq = num
         # 要发送的报文使用的编号
         self.nextseq = num
+        # 下一个要发送的数据在文件中的偏移
+        self.sendoffset = offset
+        # 是否已经发出结束报文
+        self.fin = False
         self.rwnd = rwnd
-        # 拥塞窗口长度初始为1,慢启动
-        self.cwnd = 1
-        self.windowsize = np.ceil(np.min([self.rwnd, self.cwnd]))
+        # 阻塞控制算法，维护拥塞窗口cwnd
+        self.cc = make_congestion(congestion, log)
+        self.windowsize = math.ceil(min(self.rwnd, self.cwnd))
         # buffer用双端队列实现，python文档说是进程安全的，内部已经实现了锁
+        # 只保存未确认报文的(序号, 文件偏移, 长度)，重传时再从文件映射中切片
         self.buffer = deque()
+        # 接收方通过SACK确认已收到的乱序报文序号，重传时跳过
+        self.sacked = set()
+        # 快速重传过的报文序号 -> 重传时间，一个RTO内不再重复重传，超过RTO认为重传的报文也丢了
+        self.resent = {}
         self.dupack = 0
-        self.ssthresh = 32
         self.status = status.CLOSE
+        # 条件变量，接收ACK的进程处理完一批ACK后唤醒等待窗口的发送进程
+        self.cond = Condition()
         self.log = log
-        # 估计RTO的参数
-        self.SRTT = 0
-        self.DevRTT = 1
-        self.RTO = 0.1
-        self.udpsocket.settimeout(self.RTO)
+        # 估计RTO的参数，收到第一个RTT样本时初始化
+        self.SRTT = None
+        self.DevRTT = None
+        self.RTO = Initial_RTO
+        # 报文序号 -> 第一次发送的时间，用于测量RTT，重传过的报文不再测量（Karn算法）
+        self.sendtime = {}
         # 记录ACK接收超时次数
         self.totaltimeout = 0
+        # 连续超时次数，收到ACK时清零
+        self.timeouts = 0
         # 记录超过3次冗余ACK触发的快速重传的次数
         self.totalfastresend = 0
         # 记录rwnd,cwnd,rto在发送过程中的数据，用于后续汇总
         self.rtodata = []
         self.rwnddata = []
         self.cwnddata = []
+        # 保存这些数据的文件
+        self.datalog = f"{self.file}_data.log"
+        # 一次往返握手时不等确认就开始发送，收到第一个ACK前握手回复可能丢失，超时时与数据一起重发
+        self.preamble = None
+        # 一次往返握手时接收方的地址未经验证，还能发送的字节数，收到附上令牌的报文后为None，不再限制
+        self.budget = None
+        # 一次往返握手时握手回复中签发的地址验证令牌，接收方在之后的ACK前附上
+        self.token = None
         self.MSS = int(MSS)
         # 数据报文结构
-        self.package = Struct(f"!HHI{self.MSS}s")
+        self.package = Package(self.MSS, version)
         self.MSS_size = self.package.size
+        # 收发报文的IO层，支持时批量收发
+        self.io = make_io(udpsocket, self.MSS_size, self.io_backend)
+        self.io.settimeout(self.RTO)
+        # 报文头与数据段分开制作，发送时不需要把数据拷贝进报文
+        # 发送线程和重传使用的报文头缓冲区，批量发送时报文排队等待发送，因此各用一组轮流使用
+        self.headers = cycle([bytearray(self.package.header.size) for _ in range(io_batch)])
+        self.resend_headers = cycle([bytearray(self.package.header.size) for _ in range(io_batch)])
+        # version 1的报文需要补齐数据段到MSS长度的零字节
+        self.padding = memoryview(bytes(self.MSS))
+        # 发送节奏控制，新发送和重传的报文都要先取令牌
+        self.pacer = Pacer() if pacing else None
+        # 开启pacing时排队等待令牌的重传、修复和校验报文[(序号, 文件偏移, 长度或窗口字段, 校验数据), ...]，
+        # 由发送的一方在有令牌时发出，数据来自文件的报文校验数据为None
+        self.retransmits = deque()
+        # 前向纠错，校验报文不占用序号，不进入发送缓冲区
+        self.fec = FecEncoder(self.MSS) if fec else None
         self.file_size = int(filesize)
-        self.total_package = int(np.ceil((self.file_size - self.offset) / self.MSS) + self.unackseq)
+        self.total_package = math.ceil((self.file_size - self.offset) / self.MSS) + self.unackseq
 
 
     def send(self):
         """发送数据函数
-        - 每次从文件中读取MSS长度的数据
-        - 若读取到的数据为空，说明已经发送完毕，则再发送一个结束报文标志传输完成
-        - 若当前窗口长度为0,则发送空报文询问接收方当前rwnd
-        - 制作数据报文并发送，将发送的报文放进缓冲区里面，直到收到相应的ACK时才从缓冲区里去掉
+        - 在窗口允许的范围内发送报文，窗口已满时等待接收ACK的进程唤醒
+        - 若受rwnd限制等待超时，则发送空报文询问接收方当前rwnd
+        - 结束报文发出后发送完毕
         """
 
-        self.log.info(f"Open file {self.file}")
-        f = open(self.file, "rb")
-        f.seek(self.offset)
         self.log.info("----------------Sending start----------------")
         self.log.info(f"change status from **Close** to **Slow_Start**")
         while True:
-            # 读取MSS长度的数据
-            data = f.read(self.MSS)
-            # 如果data为空，说明读取完毕，发送结束报文，结束标志用发送方报文的rwnd的特殊数字表示
-            size = DONE if data == b"" else len(data)
-            self.windowsize = np.ceil(np.min([self.rwnd, self.cwnd]))
-
-            while (
-                self.nextseq - self.unackseq >= self.windowsize
-                and self.status != status.CLOSE
-            ):
-                self.log.info(
-                    f"WindowSize is 0, flushing window size and sleeping for 0.2s......"
-                )
-                time.sleep(0.2)
-                # 如果发送过快，则暂停发送数据，发送空报文获取接收方最新rwnd
-                if self.nextseq - self.unackseq >= self.rwnd:
-                # 空数据报文
-                    pkg = self.package.pack(
-                    self.sign, GetWindowsSize, self.nextseq, "".encode()
-                )
-                    self.buffer.append(pkg)
-                    self.nextseq += 1
-                    self.udpsocket.sendto(pkg, self.destaddr)
-                    # 不属于文件数据的报文
-                    self.total_package += 1
-                self.windowsize = np.ceil(np.min([self.rwnd, self.cwnd]))
-
-            if self.status == status.CLOSE:
+            try:
+                self.fill()
+            except timeout:
+                # socket发送缓冲区一直是满的，排队的报文已丢弃，由超时重传补发
+                self.log.warning(f"Sending timed out, the queued packages will be resent.")
+            if self.fin or self.status == status.CLOSE:
                 break
-            pkg = self.package.pack(self.sign, size, self.nextseq, data)
-            self.buffer.append(pkg)
-            self.udpsocket.sendto(pkg, self.destaddr)
+            # 窗口有空位但令牌不足时，等到令牌产生的时刻再继续发送，传输中止时提前唤醒
+            delay = self.pacing_delay()
+            if delay > 0:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.status == status.CLOSE, delay)
+                continue
+            # 等待ACK打开窗口，受rwnd限制时最多等待0.2s,然后询问接收方，只受cwnd限制时由超时重传保证ACK到达
+            wait = 0.2 if self.nextseq - self.unackseq >= self.rwnd else self.RTO
+            self.log.info(f"WindowSize is 0, waiting for ACK at most {wait}s......")
+            with self.cond:
+                self.cond.wait_for(self.window_open, wait)
+            # 如果发送过快，则暂停发送数据，发送空报文获取接收方最新rwnd
+            if self.nextseq - self.unackseq >= self.rwnd:
+                self.probe()
+        self.status = status.CLOSE
+        self.log.info(f"change status to **Close**")
+        # 结束报文发出后仍会超时重传、修复，开启pacing时继续按令牌发出排队的报文，直到所有报文都已确认
+        if self.pacer is not None:
+            self.send_retransmits()
+
+        self.log.info("----------------Sending complete----------------")
+
+    def fill(self, limit=None):
+        """在窗口允许的范围内发送报文
+        - limit 最多发送的报文数量，None表示不限制
+        - 每次从映射的文件中取MSS长度的数据切片，不拷贝数据
+        - 若已经取到文件末尾，说明已经发送完毕，则再发送一个结束报文标志传输完成
+        - 发送报文，并把(序号, 偏移, 长度)放进缓冲区里面，直到收到相应的ACK时才从缓冲区里去掉
+        - 开启pacing时先按令牌发出排队的重传、修复和校验报文，之后才发送新报文
+        - 窗口已满、令牌不足或结束报文已发出时返回，并把排队的报文发出去
+        """
+
+        self.release()
+        while not self.fin and self.status != status.CLOSE and limit != 0 and not self.retransmits:
+            self.windowsize = math.ceil(min(self.rwnd, self.cwnd))
+            if self.window_full():
+                break
+            if self.pacer is not None and self.pacer.delay() > 0:
+                break
+            if limit is not None:
+                limit -= 1
+            # 读取MSS长度的数据
+            size = min(self.MSS, self.file_size - self.sendoffset)
+            # 如果已经读取完毕，发送结束报文，结束标志用发送方报文的rwnd的特殊数字表示
+            if size <= 0:
+                size = DONE
+            self.buffer.append((self.nextseq, self.sendoffset, size))
+            self.sendtime[self.nextseq] = time.monotonic()
+            self.transmit(self.nextseq, self.sendoffset, size, self.headers)
             self.log.info(
                 f"Sending {'FIN ' if size == DONE else ''}package {self.nextseq}/{self.total_package}"
             )
+            self.protect(self.nextseq, self.sendoffset, size)
             self.nextseq += 1
             if size == DONE:
+                self.fin = True
                 break
-        self.status = status.CLOSE
-        self.log.info(f"change status to **Close**")
+            self.sendoffset += size
+            self.release()
+        self.io.flush()
 
-        self.log.info("----------------Sending complete----------------")
+    def release(self):
+        """开启pacing时，按令牌发出排队的重传、修复和校验报文，令牌不足时留到下次
+        - 排队期间已被确认（累计确认或SACK）的报文不再发送
+        """
 
-        f.close()
-        self.log.info(f"Close file {self.file}")
+        while self.retransmits and self.pacer.delay() <= 0:
+            seq, offset, size, data = self.retransmits.popleft()
+            if data is not None:
+                self.send_parity(seq, size, data)
+            elif seq >= self.unackseq and seq not in self.sacked:
+                self.transmit(seq, offset, size, self.headers)
+
+    def retransmit(self, seq, offset, size):
+        """重传或修复一个报文，开启pacing时排队，由发送的一方在有令牌时发出"""
+
+        if self.pacer is not None:
+            self.retransmits.append((seq, offset, size, None))
+        else:
+            self.transmit(seq, offset, size, self.resend_headers)
+
+    def send_retransmits(self):
+        """结束报文发出后，按令牌发出排队的重传、修复报文，直到所有报文都已确认或传输中止"""
+
+        while not self.complete():
+            with self.cond:
+                self.cond.wait_for(lambda: self.retransmits or self.complete(), self.RTO)
+            delay = self.pacer.delay()
+            if delay > 0:
+                with self.cond:
+                    self.cond.wait_for(self.complete, delay)
+                continue
+            try:
+                self.release()
+                self.io.flush()
+            except timeout:
+                self.log.warning(f"Sending timed out, the queued packages will be resent.")
+
+    def probe(self):
+        """发送空数据报文，询问接收方最新rwnd"""
+
+        self.buffer.append((self.nextseq, self.sendoffset, GetWindowsSize))
+        self.sendtime[self.nextseq] = time.monotonic()
+        self.transmit(self.nextseq, self.sendoffset, GetWindowsSize, self.headers)
+        self.protect(self.nextseq, self.sendoffset, GetWindowsSize)
+        self.io.flush()
+        self.nextseq += 1
+        # 不属于文件数据的报文
+        self.total_package += 1
+
+    def window_full(self):
+        """窗口是否已满
+        - 未确认的报文数量达到rwnd，或者加上在途的校验报文（数据量折算成报文数量）达到cwnd
+        - 校验报文不占用接收方的缓冲区，只计入cwnd
+        - 接收方的地址未经验证时，剩余的发送额度不够一个报文也算满
+        """
+
+        flight = self.nextseq - self.unackseq
+        parity = self.fec.inflight() / self.MSS if self.fec is not None else 0
+        if self.budget is not None and self.budget < self.MSS_size:
+            return True
+        return flight >= self.rwnd or flight + parity >= self.cwnd
+
+    def spend(self, size):
+        """接收方的地址未经验证时从发送额度中扣除size字节，额度不足时返回False，报文不发送"""
+
+        if self.budget is None:
+            return True
+        if size > self.budget:
+            return False
+        self.budget -= size
+        return True
+
+    def window_open(self):
+        """窗口是否有空位，有排队的重传报文，或者传输已经结束"""
+
+        return not self.window_full() or len(self.retransmits) > 0 or self.status == status.CLOSE
+
+    def pacing_delay(self):
+        """开启pacing时，有排队的重传报文或窗口有空位，但令牌不足，返回令牌产生还要等待的秒数，否则返回0"""
+
+        if self.pacer is None:
+            return 0
+        if self.retransmits:
+            return self.pacer.delay()
+        if self.fin or self.status == status.CLOSE:
+            return 0
+        if self.window_full():
+            return 0
+        return self.pacer.delay()
+
+    def transmit(self, seq, offset, size, headers):
+        """发送一个数据报文
+        - seq 报文序号
+        - offset 数据段在文件中的偏移
+        - size 数据段长度，或结束、请求rwnd报文的特殊标识
+        - headers 用于制作报文头的预分配缓冲区，发送线程与接收线程（重传）各用一组，避免冲突
+        - 报文头、文件映射的切片（version 1还有补齐用的零字节切片）交给IO层一起发送，数据不经过拷贝
+        - 批量发送时报文只是排队，需要调用self.io.flush()发出
+        - 开启pacing时取一个令牌，这里不等待：新报文由fill、排队的重传和修复报文由release在有令牌时才发送
+        - 接收方的地址未经验证且发送额度不足时不发送，验证后由超时重传补发
+        """
 
-    def resend(self, cnt):
+        if self.pacer is not None:
+            self.pacer.take()
+        header = next(headers)
+        length = size if size <= self.MSS else 0
+        self.package.pack_header_into(header, self.sign, size, seq, length)
+        iov = [header, self.view[offset : offset + length]]
+        if self.package.padded:
+            iov.append(self.padding[: self.MSS - length])
+        if self.spend(sum(len(part) for part in iov)):
+            self.io.queue(iov, self.destaddr)
+
+    def protect(self, seq, offset, size):
+        """把新发送的报文计入前向纠错的当前组，凑满一组时发送校验报文"""
+
+        if self.fec is None:
+            return
+        length = size if size <= self.MSS else 0
+        parity = self.fec.add(seq, size, self.view[offset : offset + length])
+        if parity is None:
+            return
+        seq, rwnd, data = parity
+        # 开启pacing时与重传报文一起排队，由release在有令牌时发出
+        if self.pacer is not None:
+            self.retransmits.append((seq, None, rwnd, data))
+        else:
+            self.send_parity(seq, rwnd, data)
+
+    def send_parity(self, seq, rwnd, data):
+        """发送一个校验报文"""
+
+        if self.pacer is not None:
+            self.pacer.take()
+        header = next(self.headers)
+        self.package.pack_header_into(header, self.sign, rwnd, seq, len(data))
+        iov = [header, data]
+        if self.package.padded:
+            iov.append(self.padding[: self.MSS - len(data)])
+        if not self.spend(sum(len(part) for part in iov)):
+            return
+        self.io.queue(iov, self.destaddr)
+        first, count = parity_group(seq, self.nextseq)
+        self.log.info(f"Sending parity of package {first}-{first + count - 1}")
+
+    def resend(self, cnt, holes_only=False):
         """重传函数
-        - 由三个冗余ACK触发的快速重传
-        - 或者超时重传
-        - 重传缓冲区buffer里的所有数据包
+        - cnt 最多重传的报文数量
+        - holes_only 为真时是由三个冗余ACK触发的快速重传，只重传SACK信息表明已丢失的报文（低于最大SACK序号的空洞），否则是超时重传
+        - 跳过接收方已经通过SACK确认的报文
         """
 
         try:
             cnt = int(cnt)
-            for pkg in self.buffer:
-                cnt -= 1
-                self.udpsocket.sendto(pkg, self.destaddr)
-                if cnt == 0:
+            now = time.monotonic()
+            # 拷贝一份，防止发送线程同时修改缓冲区
+            buffer = list(self.buffer)
+            highest = max(self.sacked) if self.sacked else self.unackseq
+            for seq, offset, size in buffer:
+                if cnt <= 0 or (holes_only and seq > highest):
                     break
+                if seq in self.sacked or (holes_only and now - self.resent.get(seq, -self.RTO) < self.RTO):
+                    continue
+                cnt -= 1
+                if self.fec is not None:
+                    self.fec.on_loss()
+                self.resent[seq] = now
+                # Karn算法：重传过的报文的ACK无法区分对应哪一次发送，不用于测量RTT
+                self.sendtime.pop(seq, None)
+                self.retransmit(seq, offset, size)
         except Exception as e:
             self.log.err(f"Error occurred while handling resend: {e}, ignore.")
 
-    def update_cwnd(self, ack):
+    def repair(self, data):
+        """重发接收方请求修复的报文
+        - data 请求的报文编号（文件偏移除以MSS），与SACK信息的格式相同
+        - 修复报文的序号为repair_flag加上报文编号，不进入发送缓冲区，丢失时由接收方重新请求
+        """
+
+        pieces = [piece for start, end in unpack_sack(data) for piece in range(start, end + 1)]
+        self.log.warning(f"Receive repair request, resending {len(pieces)} package{'s' if len(pieces) > 1 else ''}")
+        for piece in pieces:
+            offset = piece * self.MSS
+            if offset >= self.file_size:
+                continue
+            self.retransmit(repair_flag | piece, offset, min(self.MSS, self.file_size - offset))
+
+    @property
+    def cwnd(self):
+        """拥塞窗口，由阻塞控制算法维护"""
+
+        return self.cc.cwnd
+
+    def update_cwnd(self, ack, acked=1):
         """阻塞控制函数
         - ack 收到的ACK报文序号或特殊标识
-        - 根据TCP的阻塞控制的逻辑，根据当前ACK接收情况从慢启动，阻塞避免，快速恢复状态之间切换
-        - 更新cwnd
+        - acked 这个ACK累计确认的新数据量，以MSS为单位，可以是小数
+        - 把超时、快速重传、冗余ACK、新ACK事件交给阻塞控制算法self.cc，由算法更新cwnd
         """
 
         # 当传输完毕时，不需要更新cwnd
         if self.status == status.CLOSE:
             return
 
-        # 超时，ssthresh变为cwnd的一半，cwnd置为1,变为慢启动状态
+        now = time.monotonic()
         if ack == TIMEOUT_ACK:
-            self.log.warning(f"change status to **Slow_Start** due to Timeout")
-            self.status = status.SLOW_START
-            self.ssthresh = np.max([self.cwnd // 2, 1])
-            self.cwnd = 1
-            self.log.warning(f"change cwnd to {self.cwnd}")
-
-        # 快速恢复，ssthresh变为cwnd的一半，cwnd置为ssthresh + 3,变为快速恢复状态
+            self.cc.on_timeout(now)
         elif ack == DUP_ACK:
-            self.log.warning(
-                f"change status to **Faster_Recover** due to duplicated ack"
-            )
-            self.status = status.FASTRE_RECOVERY
-            self.ssthresh = np.max([self.cwnd // 2, 1])
-            self.cwnd = self.ssthresh
-            self.log.warning(f"change cwnd to {self.cwnd}")
-
-        # 当前为慢启动状态，更新cwnd,每收到一个报文就增加一个MSS,这样在一个RTT时间，窗口内的报文全收到，cwnd就会翻倍
-        elif self.status == status.SLOW_START:
-            if ack == self.unackseq:
-                if self.cwnd + 1 < self.ssthresh:
-                    self.cwnd += 1
-                    self.log.info(f"change cwnd to {self.cwnd}")
-                else:
-                    self.cwnd = self.ssthresh
-                    self.log.info(f"change cwnd to {self.cwnd}")
-                    self.status = status.AVOID
-                    self.log.info(
-                        f"change status from **Slow_Start** to **Congestion_Avoid**"
-                    )
-
-        # 当前为阻塞避免状态，经过一个RTT才会cwnd才会增加1个MSS
-        elif self.status == status.AVOID:
-            self.cwnd += 1.0 / self.cwnd
-            self.log.info(f"change cwnd to {self.cwnd}")
-
-        # 当前为快速恢复状态，每收到一个冗余ACK,cwnd就增加1,直到收到正确ACK,cwnd变为ssthresh, 切换到阻塞避免状态
-        elif self.status == status.FASTRE_RECOVERY:
-            if ack == self.unackseq:
-                self.cwnd += 1
-                self.log.info(f"change cwnd to {self.cwnd}")
-                self.status = status.AVOID
-                self.log.info(
-                    f"change status from **Faster_Recovery** to **Congestion_Avoid**"
-                )
-            else:
-                self.cwnd += 1
-                self.log.info(f"change cwnd to {self.cwnd}")
-
+            self.cc.on_fast_retransmit(now)
+        elif ack < self.unackseq:
+            self.cc.on_dupack(now)
+        else:
+            self.cc.on_ack(acked, now)
         self.cwnddata.append(self.cwnd)
+        self.update_pacing()
+
+    def update_pacing(self):
+        """更新发送速率
+        - 阻塞控制算法给出pacing_rate（如BBR的带宽估计）时直接使用
+        - 否则为窗口/SRTT乘以增益，慢启动时增益较大，保证窗口仍能按指数增长
+        - 还没有RTT样本时不限制
+        """
+
+        if self.pacer is None:
+            return
+        if self.cc.pacing_rate is not None:
+            rate = self.cc.pacing_rate
+        elif self.SRTT:
+            gain = pacing_ss_gain if self.cc.status == status.SLOW_START else pacing_ca_gain
+            rate = gain * min(self.rwnd, self.cwnd) / self.SRTT
+        else:
+            rate = None
+        self.pacer.set_rate(rate)
 
     def update_RTO(self, RTT):
         """更新RTO
-        - RTT 数据包来回时间
-        - 实现自Jacobson/Karels算法
+        - RTT 数据包来回时间，由发送时间表测得，只来自没有重传过的报文
+        - 实现自Jacobson/Karels算法，第一个样本按RFC 6298初始化
         - 参数定义在config.config中
         """
 
-        self.SRTT = self.SRTT + alpha * (RTT - self.SRTT)
-        self.DevRTT = (1 - beta) * self.DevRTT + beta * (np.abs(RTT - self.SRTT))
-        self.RTO = np.max([mu * self.SRTT + rao * self.DevRTT, Minimum_RTO])
-        self.udpsocket.settimeout(self.RTO)
+        if self.SRTT is None:
+            self.SRTT = RTT
+            self.DevRTT = RTT / 2
+        else:
+            self.DevRTT = (1 - beta) * self.DevRTT + beta * abs(RTT - self.SRTT)
+            self.SRTT = self.SRTT + alpha * (RTT - self.SRTT)
+        self.RTO = min(max(mu * self.SRTT + rao * self.DevRTT, Minimum_RTO), Maximum_RTO)
+        self.io.settimeout(self.RTO)
         self.log.info(f"RTO is updated to {self.RTO}")
         self.rtodata.append(self.RTO)
 
+    def backoff_RTO(self):
+        """超时后RTO加倍（指数退避），超时不是RTT样本，不参与SRTT的计算"""
+
+        self.RTO = min(self.RTO * 2, Maximum_RTO)
+        self.io.settimeout(self.RTO)
+        self.log.warning(f"RTO is backed off to {self.RTO}")
+        self.rtodata.append(self.RTO)
+
     def receive(self):
         """接收ACK
         - 接收到的ACK小于unacked - 1，忽略
@@ -234,95 +473,171 @@ class Sender(object):
         - **注意**，此处ACK与TCP中ACK的定义**不同**，此处ACK定义为接收到的最后一个数据包编号，即等于TCP中定义的ACK-1
         """
 
-        # 记录连续超时次数
-        cnt = 0
-        while self.status != status.CLOSE or len(self.buffer) != 0:
+        while not self.complete():
             try:
-                # 记录RTT
-                rec_st = time.time()
-                raw, dstaddr = self.udpsocket.recvfrom(self.MSS_size)
-                rec_en = time.time()
-                # 更新RTO
-                self.update_RTO(rec_en - rec_st)
-                sign = 0
-                seq = 0
-                rwnd = 0
-                try:
-                    sign, rwnd, seq, data = self.package.unpack(raw)
-                except Exception as e:
-                    self.log.warning(
-                        f"Unable to unpack received package due to the error : {e}, droped."
-                    )
-                if sign != self.sign:
-                    self.log.warning(f"Receive an unknown sign package, droped.")
-                elif seq == self.unackseq - 1:
-                    self.dupack += 1
-                    self.update_cwnd(seq)
-                    # 三次冗余ACK,快速重传
-                    if self.dupack == 3:
-                        time.sleep(0.5)
-                        self.totalfastresend += 1
-                        cnt = np.ceil(np.min([self.rwnd, self.cwnd]))
-                        self.log.warning(
-                            f"Receive uncorrect ACK {self.unackseq} three times, Resending package from {self.unackseq} to {self.unackseq + cnt - 1}"
-                        )
-                        # Thread(target = self.resend).start()
-                        self.resend(cnt)
-                        self.update_cwnd(DUP_ACK)
-                        self.dupack = 0
-                    # 大于等于当前unackseq,更新unackseq,并删除相应数据包
-                elif seq >= self.unackseq:
-                    self.log.info(f"Receive ACK {seq}/{self.total_package}")
-                    for _ in range(seq - self.unackseq + 1):
-                        self.update_cwnd(self.unackseq)
-                        self.unackseq += 1
-                        self.buffer.popleft()
-                    self.rwnd = rwnd
-                    self.rwnddata.append(rwnd)
-                    self.dupack = 0
-                else:
-                    # 小于unackseq - 1,忽略
-                    self.log.info(f"Receive smaller ACK {seq}, droped.")
-                    self.dupack = 0
-                # 接收到数据包，超时次数清零
-                cnt = 0
-
+                packages = self.io.recv(self.MSS_size)
             except timeout:
-                # 如果当前未发送包，自然也不会收到ACK,此处防止出现罕见bug
-                if self.unackseq == self.nextseq:  # windows size is zero
-                    continue
-                self.totaltimeout += 1
-                cnt += 1
-                if cnt == timeout_count:
-                    # 连续超时timeout_count(定义在config.config)次，认为网络出现问题，停止传输
-                    self.log.warning(
-                        f"Timeout for receiving ACK for {timeout_count} times!!! Aborted."
-                    )
-                    self.status = status.CLOSE
+                if not self.handle_timeout():
                     return
-                self.update_RTO(self.RTO)
-                cnt = np.ceil(np.min([self.rwnd, self.cwnd]))
-                self.log.warning(
-                    f"Receive ACK {self.unackseq} Timeout, Resending package from {self.unackseq} to {self.unackseq + cnt - 1}"
-                )
-                self.update_cwnd(TIMEOUT_ACK)
-                # 超时重传
-                self.resend(cnt)
-                # Thread(target = self.resend).start()
                 continue
-
             except Exception as e:
                 self.log.err(f"Error occured when handling receive ACK: {e}, ignore.")
                 continue
+            self.handle_acks(packages, time.monotonic())
         self.log.info("----------------Receiving complete----------------")
 
+    def complete(self):
+        """结束报文已发出且所有报文都已确认，或者传输已中止"""
+
+        return self.status == status.CLOSE and len(self.buffer) == 0
+
+    def handle_acks(self, packages, now):
+        """处理一批ACK报文
+        - packages [(报文, 地址), ...]
+        - now 收到这批报文的时间，用于测量RTT
+        """
+
+        for raw, dstaddr in packages:
+            sign = 0
+            seq = 0
+            rwnd = 0
+            try:
+                sign, rwnd, seq, data = self.package.unpack(raw)
+            except Exception as e:
+                self.log.warning(
+                    f"Unable to unpack received package due to the error : {e}, droped."
+                )
+            if sign != self.sign:
+                self.log.warning(f"Receive an unknown sign package, droped.")
+                continue
+            # ACK前附上握手回复中签发的令牌，接收方收到了回复，地址得到验证；伪造源地址的报文附不上令牌
+            if self.token is not None and compare_digest(data[:token_size], self.token):
+                data = data[token_size:]
+                self.budget = None
+            try:
+                self.handle_ack(seq, rwnd, data, now)
+            except Exception as e:
+                self.log.err(f"Error occured when handling receive ACK: {e}, ignore.")
+        # 发出处理ACK时排队的重传报文
+        try:
+            self.io.flush()
+        except timeout:
+            self.log.warning(f"Sending timed out, the queued packages will be resent.")
+        # 唤醒等待窗口的发送进程
+        with self.cond:
+            self.cond.notify_all()
+        # 接收到数据包，超时次数清零
+        self.timeouts = 0
+
+    def handle_ack(self, seq, rwnd, data, now):
+        """处理一个ACK报文
+        - seq ACK的序号，即接收方按序收到的最后一个报文
+        - rwnd 接收方的窗口
+        - data 数据段，携带SACK信息
+        - 窗口字段为REPAIR时是请求修复分块的报文
+        """
+
+        if rwnd == REPAIR:
+            self.repair(data)
+            return
+
+        # 测量RTT：取这个ACK第一次确认（累计确认或SACK）的最大序号，
+        # 已经被SACK过的报文在累计确认时会晚到，不能作为样本
+        fresh = seq if seq >= self.unackseq and seq not in self.sacked else -1
+        # 记录SACK信息
+        for start, end in unpack_sack(data):
+            if end >= self.unackseq and end not in self.sacked:
+                fresh = max(fresh, end)
+            self.sacked.update(range(max(start, self.unackseq), end + 1))
+        if self.fec is not None:
+            self.fec.report(data)
+        # 重传过的报文已从发送时间表中删除
+        sent = self.sendtime.get(fresh)
+        if sent is not None:
+            self.update_RTO(now - sent)
+            self.cc.on_rtt(now - sent, now)
+        if seq == self.unackseq - 1:
+            self.dupack += 1
+            self.update_cwnd(seq)
+            # 三次冗余ACK,快速重传
+            if self.dupack == 3:
+                self.totalfastresend += 1
+                window = math.ceil(min(self.rwnd, self.cwnd))
+                self.log.warning(
+                    f"Receive uncorrect ACK {self.unackseq} three times, Resending lost package from {self.unackseq}, {len(self.sacked)} package{'s' if len(self.sacked) > 1 else ''} sacked"
+                )
+                self.resend(max(window, 1), holes_only=True)
+                self.update_cwnd(DUP_ACK)
+                self.dupack = 0
+        # 大于等于当前unackseq,更新unackseq,并删除相应数据包
+        elif seq >= self.unackseq:
+            self.log.info(f"Receive ACK {seq}/{self.total_package}")
+            self.preamble = None
+            # 按确认的数据量而不是ACK的数量增长cwnd，接收方延迟确认时一个ACK确认多个报文
+            acked = sum(size for _, _, size in islice(self.buffer, seq - self.unackseq + 1) if size <= self.MSS)
+            self.update_cwnd(seq, acked / self.MSS)
+            for _ in range(seq - self.unackseq + 1):
+                self.sendtime.pop(self.unackseq, None)
+                self.sacked.discard(self.unackseq)
+                self.resent.pop(self.unackseq, None)
+                self.unackseq += 1
+                self.buffer.popleft()
+            if self.fec is not None:
+                self.fec.release(self.unackseq)
+            self.rwnd = rwnd
+            self.rwnddata.append(rwnd)
+            self.dupack = 0
+        else:
+            # 小于unackseq - 1,忽略
+            self.log.info(f"Receive smaller ACK {seq}, droped.")
+            self.dupack = 0
+
+    def handle_timeout(self):
+        """接收ACK超时
+        - RTO指数退避，按窗口大小重传未被SACK的报文
+        - 连续超时timeout_count(定义在config.config)次，认为网络出现问题，停止传输，返回False
+        """
+
+        # 如果当前未发送包，自然也不会收到ACK,此处防止出现罕见bug
+        if self.unackseq == self.nextseq:  # windows size is zero
+            return True
+        self.totaltimeout += 1
+        self.timeouts += 1
+        if self.timeouts == timeout_count:
+            self.log.warning(
+                f"Timeout for receiving ACK for {timeout_count} times!!! Aborted."
+            )
+            with self.cond:
+                self.status = status.CLOSE
+                self.buffer.clear()
+                self.retransmits.clear()
+                self.cond.notify_all()
+            return False
+        self.backoff_RTO()
+        window = math.ceil(min(self.rwnd, self.cwnd))
+        self.log.warning(
+            f"Receive ACK {self.unackseq} Timeout, Resending unsacked package from {self.unackseq} to {self.unackseq + window - 1}"
+        )
+        self.resent.clear()
+        self.update_cwnd(TIMEOUT_ACK)
+        if self.preamble is not None and self.spend(len(self.preamble)):
+            self.io.sendto(self.preamble, self.destaddr)
+        # 超时重传，开启pacing时之前排队的报文一并按新的窗口重新排队，按超时后的速率发出，不会一次发出整个窗口
+        self.retransmits.clear()
+        self.resend(window)
+        self.io.flush()
+        # 唤醒等待窗口的发送进程发出排队的重传报文
+        with self.cond:
+            self.cond.notify_all()
+        return True
+
     def summary(self):
         """总结
         - 将rwnd，cwnd, rto输出到文件中，用于主进程中汇总制表
         - 因为plot库不能在非主进程运行
         """
 
-        with open(f"{self.file}_data.log", "w") as f:
+        with open(self.datalog, "w") as f:
             f.write(" ".join([str(i) for i in self.rwnddata]))
             f.write("\n")
             f.write(" ".join([str(i) for i in self.cwnddata]))
@@ -335,6 +650,26 @@ class Sender(object):
         print(f"Total lost times is {self.totaltimeout}")
         print(f"Total duplicate times is {self.totalfastresend}")
 
+    def open_file(self):
+        """打开并映射要发送的文件"""
+
+        self.log.info(f"Open file {self.file}")
+        self.f = open(self.file, "rb")
+        # 空文件无法映射，用空的字节串代替
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if self.file_size > 0 else b""
+        self.view = memoryview(self.map)
+
+    def close_file(self):
+        """释放文件映射并关闭文件，检查是否正常结束"""
+
+        self.view.release()
+        if self.file_size > 0:
+            self.map.close()
+        self.f.close()
+        self.log.info(f"Close file {self.file}")
+        if self.total_package != self.unackseq - 1:
+            self.log.warning(f"Stop unnormally!")
+
     def start(self):
         """启动函数
         - 切换状态为慢启动
@@ -344,6 +679,7 @@ class Sender(object):
         - 执行summary函数，保存数据
         """
 
+        self.open_file()
         self.status = status.SLOW_START
         t1 = Thread(target=self.send)
         self.log.info(f"start send data thread")
@@ -353,6 +689,6 @@ class Sender(object):
         t2.start()
         t1.join()
         t2.join()
-        if self.total_package != self.unackseq - 1:
-            self.log.warning(f"Stop unnormally!")
+        # 重传可能用到文件内容，两个进程都结束后才能关闭文件
+        self.close_file()
         self.summary()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+from collections import deque
+from socket import timeout
+
+
+class Recv(object):
+    """握手步骤：接收一个报文，limit秒内没有收到时抛出timeout，None表示使用驱动者的默认超时"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+
+
+class Call(object):
+    """握手步骤：执行耗时的函数（计算md5码、压缩、计算Merkle树等）"""
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+
+def recv(limit=None):
+    """在握手生成器中接收一个报文，返回(报文, 地址)，用法：raw, addr = yield from recv()"""
+
+    return (yield Recv(limit))
+
+
+def call(fn, *args):
+    """在握手生成器中执行耗时的函数，返回函数的返回值，用法：result = yield from call(fn, *args)"""
+
+    return (yield Call(fn, args))
+
+
+def run(steps, udpsocket, size):
+    """线程版本：阻塞地驱动握手生成器
+    - steps 握手生成器
+    - udpsocket 接收报文的socket，size为报文的最大长度
+    - 步骤出错（包括接收超时）时把异常抛回生成器，由握手流程自己处理
+    - 返回生成器的返回值
+    """
+
+    value, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as e:
+            return e.value
+        value, error = None, None
+        try:
+            if isinstance(step, Recv):
+                saved = udpsocket.gettimeout()
+                if step.limit is not None:
+                    udpsocket.settimeout(step.limit)
+                try:
+                    value = udpsocket.recvfrom(size)
+                finally:
+                    udpsocket.settimeout(saved)
+            else:
+                value = step.fn(*step.args)
+        except Exception as e:
+            error = e
+
+
+class StepProtocol(asyncio.DatagramProtocol):
+    """asyncio版本的握手协议
+    - 收到的报文排队，由握手生成器的Recv步骤取出
+    - 握手结束后把transport交给发送类或接收类，还没取出的报文由它们继续处理
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = deque()
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.pending.append((data, addr))
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def error_received(self, exc):
+        pass
+
+    async def recv(self, limit):
+        """取出一个报文，limit秒内没有报文时抛出timeout"""
+
+        if not self.pending:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self.waiter, limit)
+            except asyncio.TimeoutError:
+                raise timeout("timed out")
+            finally:
+                self.waiter = None
+        return self.pending.popleft()
+
+
+async def run_async(steps, protocol, limit, executor=None):
+    """asyncio版本：在事件循环中驱动握手生成器
+    - steps 握手生成器
+    - protocol 接收报文的StepProtocol，limit为默认的接收超时
+    - executor 执行耗时函数的线程池，不阻塞事件循环
+    - 返回生成器的返回值
+    """
+
+    loop = asyncio.get_running_loop()
+    value, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as e:
+            return e.value
+        value, error = None, None
+        try:
+            if isinstance(step, Recv):
+                value = await protocol.recv(limit if step.limit is None else step.limit)
+            else:
+                value = await loop.run_in_executor(executor, step.fn, *step.args)
+        except Exception as e:
+            error = e
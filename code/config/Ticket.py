@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import base64
+import hmac
+import time
+from hashlib import sha256
+from .config import *
+from .Compress import codec_names
+
+
+def codec_mask(codecs):
+    """压缩算法列表编码为位图"""
+
+    return sum(1 << i for i, name in enumerate(codec_names) if name in codecs)
+
+
+def mask_codecs(mask):
+    """位图解码为压缩算法列表"""
+
+    return [name for i, name in enumerate(codec_names) if mask >> i & 1]
+
+
+def issue_ticket(key, MSS, version, codecs, host):
+    """签发会话票据
+    - key 服务端的密钥
+    - MSS/version/codecs 获取端口时协商的参数
+    - host 客户端的ip，票据只能从这个ip使用
+    - 票据为[MSS, 报文版本, 压缩算法位图, 过期时间]和用key计算的HMAC的前ticket_mac字节，HMAC还包括客户端的ip
+    - 返回值：base64编码的票据，放在获取端口或hello握手的回复中
+    """
+
+    body = ticket_body.pack(int(MSS), int(version), codec_mask(codecs), int(time.time()) + ticket_lifetime)
+    mac = hmac.new(key, body + host.encode(), sha256).digest()[:ticket_mac]
+    return encode_ticket(body + mac)
+
+
+def encode_ticket(raw):
+    """票据或令牌编码为放在回复中的文本"""
+
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_ticket(text):
+    """客户端把回复中的票据或令牌解码为字节串，附在之后的握手请求或报文前"""
+
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def open_ticket(key, raw, host):
+    """服务端检查票据
+    - key 服务端的密钥，服务端重启后之前签发的票据失效
+    - raw 握手请求前的ticket_size字节
+    - host 发来请求的ip，与签发时的ip不同的票据视为伪造
+    - 返回值：票据中的(MSS, 报文版本, 压缩算法列表, 是否过期)，票据不完整或伪造时返回None
+    - 伪造的票据与过期的票据要区分处理：伪造的不回复，过期的回复RESET
+    """
+
+    if len(raw) < ticket_size:
+        return None
+    body = raw[: ticket_body.size]
+    mac = raw[ticket_body.size : ticket_size]
+    if not hmac.compare_digest(mac, hmac.new(key, body + host.encode(), sha256).digest()[:ticket_mac]):
+        return None
+    MSS, version, mask, expire = ticket_body.unpack(body)
+    return MSS, version, mask_codecs(mask), expire < time.time()
+
+
+def issue_token(key, host):
+    """签发探测令牌
+    - key 服务端的密钥
+    - host 客户端的ip，令牌只能从这个ip使用
+    - 返回值：token_size字节的令牌，附在之后的探测报文中
+    """
+
+    body = token_body.pack(int(time.time()) + token_lifetime)
+    return body + hmac.new(key, b"probe" + body + host.encode(), sha256).digest()[:ticket_mac]
+
+
+def check_token(key, raw, host):
+    """检查探测报文附上的令牌，令牌伪造、过期或者来自其他ip时返回False"""
+
+    if len(raw) < token_size:
+        return False
+    body = raw[: token_body.size]
+    mac = raw[token_body.size : token_size]
+    if not hmac.compare_digest(mac, hmac.new(key, b"probe" + body + host.encode(), sha256).digest()[:ticket_mac]):
+        return False
+    (expire,) = token_body.unpack(body)
+    return expire >= time.time()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ctypes
+import errno
+import os
+import select
+import socket as pysocket
+import sys
+import time
+from socket import AF_INET, SO_RCVBUF, SO_SNDBUF, SOL_SOCKET, inet_aton, inet_ntoa, timeout
+from struct import Struct
+from threading import RLock
+import numpy as np
+from . import config
+
+# UDP相关的socket选项，python的socket模块里没有定义
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_GRO = 104
+# 一个GSO报文最多包含的分段数量和总长度，由内核限制
+UDP_MAX_SEGMENTS = 64
+UDP_MAX_PAYLOAD = 65000
+# recvmmsg/sendmmsg的flag
+MSG_DONTWAIT = 0x40
+# 批量发送时一个报文最多由几个缓冲区组成（报文头、数据段、补齐的零字节）
+MAX_IOV = 4
+# 不超过该长度的缓冲区（报文头）排队时拷贝，调用者会复用它们；更长的缓冲区直接引用，不拷贝
+COPY_LIMIT = 64
+
+# sockaddr_in结构，sin_family为本机字节序，端口和地址为网络字节序
+sockaddr_family = Struct("=H")
+sockaddr_in = Struct("!H4s8x")
+# cmsghdr结构：cmsg_len, cmsg_level, cmsg_type
+cmsghdr = Struct("@Nii")
+gso_size = Struct("=H")
+gro_size = Struct("=i")
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def cmsg_space(length):
+    """cmsg占用的空间，按size_t对齐"""
+
+    align = ctypes.sizeof(ctypes.c_size_t)
+    return (cmsghdr.size + length + align - 1) // align * align
+
+
+class SocketIO(object):
+    """逐个报文收发的IO层
+    - 每个报文一次sendto/sendmsg，每次recvfrom接收一个报文
+    - 作为批量IO不可用时的后备实现
+    """
+
+    name = "socket"
+
+    def __init__(self, udpsocket):
+        self.udpsocket = udpsocket
+
+    def settimeout(self, value):
+        self.udpsocket.settimeout(value)
+
+    def queue(self, iov, destaddr):
+        """发送一个报文，iov为组成报文的若干缓冲区"""
+
+        if hasattr(self.udpsocket, "sendmsg"):
+            self.udpsocket.sendmsg(iov, [], 0, destaddr)
+        else:
+            # Windows下没有sendmsg，拼接后发送
+            self.udpsocket.sendto(b"".join(iov), destaddr)
+
+    def sendto(self, data, destaddr):
+        """立即发送一个报文"""
+
+        self.queue([data], destaddr)
+        self.flush()
+
+    def flush(self):
+        """把排队的报文发出去，逐个发送时报文不会排队"""
+
+    def recv(self, bufsize):
+        """接收报文，返回[(报文, 地址), ...]，超时抛出timeout"""
+
+        return [self.udpsocket.recvfrom(bufsize)]
+
+
+class BatchIO(SocketIO):
+    """批量收发的IO层
+    - 通过ctypes调用sendmmsg/recvmmsg，一次系统调用收发多个报文
+    - 如果内核支持，发送时把等长的连续报文合并成一个UDP_SEGMENT(GSO)报文，由内核分段
+    - 如果内核支持，接收时开启UDP_GRO，由内核把同一来源的报文合并后一起交给用户态，再按分段长度拆开
+    - 排队时iovec直接指向调用者的缓冲区（文件映射的切片），保留引用直到发出，数据不经过拷贝；只有会被复用的报文头拷贝进发送槽
+    - 排满io_batch个或调用flush时才真正发送，socket发送缓冲区一直满时最多等待socket的超时时间，然后丢弃排队的报文并抛出timeout
+    - mmsghdr/iovec数组用numpy视图整批填写，避免逐个报文操作ctypes结构体
+    - 发送和接收ACK的两个进程可能同时排队，用锁保护发送队列
+    """
+
+    name = "batch"
+
+    def __init__(self, udpsocket, libc, size, batch=config.io_batch, gso=config.udp_gso, gro=config.udp_gro):
+        """初始化函数
+        - udpsocket 收发报文的套接字
+        - libc 提供sendmmsg/recvmmsg的libc
+        - size 报文的最大长度，决定每个发送槽和接收槽的大小
+        - batch 一次系统调用最多收发的报文数量
+        - gso/gro 是否尝试开启UDP_SEGMENT/UDP_GRO
+        """
+
+        super().__init__(udpsocket)
+        self.libc = libc
+        self.fd = udpsocket.fileno()
+        self.size = size
+        self.batch = batch
+        self.lock = RLock()
+        self.sockaddr = {}
+        self.gso = gso and self.enable(UDP_SEGMENT, 0)
+        self.gro = gro and self.enable(UDP_GRO, 1)
+        self.index = np.arange(batch, dtype=np.uint64)
+
+        # 发送槽：每个缓冲区占一个iovec，第k个iovec的缓冲区较短时拷贝到out[k * COPY_LIMIT:]
+        self.out = (ctypes.c_char * (COPY_LIMIT * MAX_IOV * batch))()
+        self.out_view = memoryview(self.out).cast("B")
+        self.out_iovs = (iovec * (MAX_IOV * batch))()
+        self.out_iov_words = np.frombuffer(self.out_iovs, dtype=np.uint64).reshape(MAX_IOV * batch, 2)
+        self.out_msgs = (mmsghdr * batch)()
+        self.out_msg_words = np.frombuffer(self.out_msgs, dtype=np.uint64).reshape(batch, 8)
+        for i in range(batch):
+            self.out_msgs[i].msg_hdr.msg_namelen = 16
+        # 每个GSO消息的控制信息，只有分段长度需要每次填写
+        self.space = cmsg_space(gso_size.size)
+        self.out_control = ctypes.create_string_buffer(self.space * batch)
+        for i in range(batch):
+            cmsghdr.pack_into(self.out_control, i * self.space, cmsghdr.size + gso_size.size, SOL_UDP, UDP_SEGMENT)
+        self.out_gso = np.frombuffer(self.out_control, dtype=np.uint16)[cmsghdr.size // 2 :: self.space // 2]
+        # 排队报文的长度、目的地址、第一个iovec的位置和组成报文的缓冲区（保留引用直到发出）
+        self.lengths = []
+        self.addrs = []
+        self.firsts = []
+        self.refs = []
+
+        # 接收槽：开启GRO后一次可能收到合并的多个报文，需要最大的缓冲区
+        self.slot_size = 65535 if self.gro else size
+        self.slots = (ctypes.c_char * (self.slot_size * batch))()
+        self.slots_view = memoryview(self.slots).cast("B")
+        self.names = ctypes.create_string_buffer(16 * batch)
+        gro_space = cmsg_space(gro_size.size)
+        self.controls = ctypes.create_string_buffer(gro_space * batch)
+        self.iovs = (iovec * batch)()
+        iov_words = np.frombuffer(self.iovs, dtype=np.uint64).reshape(batch, 2)
+        iov_words[:, 0] = ctypes.addressof(self.slots) + self.index * self.slot_size
+        iov_words[:, 1] = self.slot_size
+        self.msgs = (mmsghdr * batch)()
+        self.msg_words = np.frombuffer(self.msgs, dtype=np.uint64).reshape(batch, 8)
+        self.msg_u32 = np.frombuffer(self.msgs, dtype=np.uint32).reshape(batch, 16)
+        self.msg_words[:, 0] = ctypes.addressof(self.names) + self.index * 16
+        self.msg_u32[:, 2] = 16
+        self.msg_words[:, 2] = ctypes.addressof(self.iovs) + self.index * ctypes.sizeof(iovec)
+        self.msg_words[:, 3] = 1
+        if self.gro:
+            self.msg_words[:, 4] = ctypes.addressof(self.controls) + self.index * gro_space
+            self.msg_words[:, 5] = gro_space
+        self.gro_size = np.frombuffer(self.controls, dtype=np.int32)[cmsghdr.size // 4 :: gro_space // 4]
+        self.gro_level = np.frombuffer(self.controls, dtype=np.int32)[ctypes.sizeof(ctypes.c_size_t) // 4 :: gro_space // 4]
+        # 源地址缓存，避免每个报文都解析一次
+        self.srcaddr = {}
+
+    def enable(self, option, value):
+        """尝试打开UDP选项，内核不支持时返回False"""
+
+        try:
+            self.udpsocket.setsockopt(SOL_UDP, option, value)
+            return True
+        except OSError:
+            return False
+
+    def name_of(self, destaddr):
+        """把(ip, port)转换为sockaddr_in，并缓存"""
+
+        if destaddr not in self.sockaddr:
+            ip, port = destaddr
+            self.sockaddr[destaddr] = ctypes.create_string_buffer(
+                sockaddr_family.pack(AF_INET) + sockaddr_in.pack(port, inet_aton(pysocket.gethostbyname(ip))),
+                16,
+            )
+        return ctypes.addressof(self.sockaddr[destaddr])
+
+    def queue(self, iov, destaddr):
+        with self.lock:
+            if len(iov) > MAX_IOV:
+                # 缓冲区太多的报文，直接发送
+                self.send_pending()
+                super().queue(iov, destaddr)
+                return
+            # 报文的iovec紧接着上一个报文的，GSO的一组报文的iovec连续
+            first = self.firsts[-1][1] if self.firsts else 0
+            k = first
+            total = 0
+            refs = []
+            for buf in iov:
+                n = len(buf)
+                if n == 0:
+                    continue
+                if n <= COPY_LIMIT:
+                    pos = k * COPY_LIMIT
+                    self.out_view[pos : pos + n] = buf
+                    self.out_iov_words[k] = (ctypes.addressof(self.out) + pos, n)
+                else:
+                    array = np.frombuffer(buf, dtype=np.uint8)
+                    self.out_iov_words[k] = (array.ctypes.data, n)
+                    refs.append(array)
+                k += 1
+                total += n
+            self.lengths.append(total)
+            self.addrs.append(destaddr)
+            self.firsts.append((first, k))
+            self.refs.append(refs)
+            if len(self.lengths) >= self.batch:
+                self.send_pending()
+
+    def groups(self, lengths):
+        """把排队的报文分组，每组作为sendmmsg中的一个消息，返回(起始槽数组, 报文数量数组, 分段长度数组)
+        - 不开启GSO或目的地址不同时每个报文一组
+        - 开启GSO时，长度相同的连续报文为一组，每组不超过内核限制的分段数量和总长度
+        """
+
+        total = len(lengths)
+        if not self.gso or self.addrs.count(self.addrs[0]) != total:
+            return self.index[:total], np.ones(total, dtype=np.uint64), lengths
+        # 长度相同的连续报文
+        bounds = np.flatnonzero(np.diff(lengths)) + 1
+        starts, counts, sizes = [], [], []
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, total]):
+            size = int(lengths[start])
+            step = max(1, min(UDP_MAX_SEGMENTS, UDP_MAX_PAYLOAD // size))
+            for first in range(start, end, step):
+                starts.append(first)
+                counts.append(min(step, end - first))
+                sizes.append(size)
+        return np.array(starts, dtype=np.uint64), np.array(counts, dtype=np.uint64), np.array(sizes, dtype=np.uint64)
+
+    def flush(self):
+        with self.lock:
+            self.send_pending()
+
+    def send_pending(self):
+        """用sendmmsg发送排队的报文
+        - 一个消息的iovec为组内各报文的iovec，它们在数组中是连续的
+        - socket发送缓冲区已满时等待可写，ENOBUFS时退避重试，最多等待socket的超时时间，超过后丢弃排队的报文并抛出timeout
+        """
+
+        total = len(self.lengths)
+        if not total:
+            return
+        try:
+            lengths = np.array(self.lengths, dtype=np.uint64)
+            starts, counts, sizes = self.groups(lengths)
+            count = len(starts)
+            firsts = np.array(self.firsts, dtype=np.uint64)
+            words = self.out_msg_words[:count]
+            if self.addrs.count(self.addrs[0]) == total:
+                words[:, 0] = self.name_of(self.addrs[0])
+            else:
+                words[:, 0] = [self.name_of(self.addrs[int(i)]) for i in starts]
+            words[:, 2] = ctypes.addressof(self.out_iovs) + firsts[starts.astype(np.intp), 0] * ctypes.sizeof(iovec)
+            words[:, 3] = firsts[(starts + counts - 1).astype(np.intp), 1] - firsts[starts.astype(np.intp), 0]
+            segmented = counts > 1
+            self.out_gso[:count] = sizes
+            words[:, 4] = np.where(segmented, ctypes.addressof(self.out_control) + self.index[:count] * self.space, 0)
+            words[:, 5] = np.where(segmented, self.space, 0)
+            sent = 0
+            deadline = None
+            backoff = 0.001
+            while sent < count:
+                ret = self.libc.sendmmsg(
+                    self.fd, ctypes.byref(self.out_msgs, sent * ctypes.sizeof(mmsghdr)), count - sent, 0
+                )
+                if ret >= 0:
+                    sent += ret
+                    deadline = None
+                    continue
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    # socket发送缓冲区已满，等待可写，网卡队列已满（ENOBUFS）时select会立即返回，退避后重试
+                    now = time.monotonic()
+                    if deadline is None:
+                        limit = self.udpsocket.gettimeout()
+                        deadline = now + (config.time_limit if limit is None else limit)
+                    if now >= deadline:
+                        raise timeout("send timed out")
+                    if err == errno.ENOBUFS:
+                        time.sleep(min(backoff, deadline - now))
+                        backoff = min(backoff * 2, 0.1)
+                    else:
+                        select.select([], [self.fd], [], deadline - now)
+                    continue
+                if self.gso and err in (errno.EINVAL, errno.EIO, errno.EMSGSIZE):
+                    # 网卡或路径不支持GSO（例如分段长度超过MTU），关闭GSO后逐个重新发送剩下的报文
+                    self.gso = False
+                    for j in range(int(starts[sent]), total):
+                        first, end = self.firsts[j]
+                        super().queue([
+                            ctypes.string_at(int(base), int(n)) for base, n in self.out_iov_words[first:end]
+                        ], self.addrs[j])
+                    break
+                raise OSError(err, os.strerror(err))
+        finally:
+            self.lengths = []
+            self.addrs = []
+            self.firsts = []
+            self.refs = []
+
+    def recv(self, bufsize):
+        # 套接字设置了超时，python内部把它设为非阻塞，因此先等待可读
+        ready, _, _ = select.select([self.fd], [], [], self.udpsocket.gettimeout())
+        if not ready:
+            raise timeout("timed out")
+        if self.gro:
+            # 控制信息长度会被内核改写，接收前恢复
+            self.msg_words[:, 5] = cmsg_space(gro_size.size)
+        ret = self.libc.recvmmsg(self.fd, self.msgs, self.batch, MSG_DONTWAIT, None)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise timeout("timed out")
+            raise OSError(err, os.strerror(err))
+        lengths = self.msg_u32[:ret, 14].tolist()
+        if self.gro:
+            has_segment = (self.msg_words[:ret, 5] >= cmsghdr.size + gro_size.size) & (self.gro_level[:ret] == SOL_UDP)
+            segments = np.where(has_segment, self.gro_size[:ret], 0).tolist()
+        else:
+            segments = [0] * ret
+        packages = []
+        names = self.names.raw
+        for i in range(ret):
+            pos = i * self.slot_size
+            data = bytes(self.slots_view[pos : pos + lengths[i]])
+            name = names[i * 16 : i * 16 + 8]
+            srcaddr = self.srcaddr.get(name)
+            if srcaddr is None:
+                port, ip = sockaddr_in.unpack_from(names, i * 16 + sockaddr_family.size)
+                srcaddr = self.srcaddr[name] = (inet_ntoa(ip), port)
+            segment = segments[i]
+            if segment and segment < lengths[i]:
+                # GRO合并的报文，按分段长度拆开
+                for start in range(0, lengths[i], segment):
+                    packages.append((data[start : start + segment], srcaddr))
+            else:
+                packages.append((data[:bufsize], srcaddr))
+        return packages
+
+
+class LoopIO(object):
+    """asyncio事件循环使用的IO层
+    - socket由事件循环管理（非阻塞），通过DatagramTransport发送
+    - 只负责发送，没有recv：接收由协议的datagram_received完成，不会调用阻塞的接收循环
+    - 排队的报文在flush时发出，报文头缓冲区会被复用，排队时先拼接成bytes
+    - 超时由事件循环的定时器实现，settimeout不修改socket
+    """
+
+    name = "loop"
+
+    def __init__(self, udpsocket):
+        self.udpsocket = udpsocket
+        # 创建endpoint后由调用者设置
+        self.transport = None
+        self.pending = []
+
+    def settimeout(self, value):
+        pass
+
+    def queue(self, iov, destaddr):
+        self.pending.append((b"".join(iov), destaddr))
+
+    def sendto(self, data, destaddr):
+        self.flush()
+        self.transport.sendto(data, destaddr)
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for data, destaddr in pending:
+            self.transport.sendto(data, destaddr)
+
+
+def load_libc():
+    """加载libc，只有Linux提供sendmmsg/recvmmsg，其他系统返回None，逐个报文收发"""
+
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.sendmmsg.restype = ctypes.c_int
+        libc.recvmmsg.restype = ctypes.c_int
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+libc = load_libc()
+
+
+def size_buffers(udpsocket, size):
+    """把socket的收发缓冲区扩大到至少size字节，超过系统上限（Linux的rmem_max/wmem_max）时由内核截断，不支持时忽略
+    - 返回值：读回SO_RCVBUF得到的接收缓冲区实际能容纳的数据量，字节，读不到时返回size
+    - Linux读回的是设置值的两倍，其中一半留给内核的簿记开销，只算一半
+    """
+
+    for option in (SO_RCVBUF, SO_SNDBUF):
+        try:
+            if udpsocket.getsockopt(SOL_SOCKET, option) < size:
+                udpsocket.setsockopt(SOL_SOCKET, option, size)
+        except OSError:
+            pass
+    try:
+        granted = udpsocket.getsockopt(SOL_SOCKET, SO_RCVBUF)
+    except OSError:
+        return size
+    return granted // 2 if sys.platform.startswith("linux") else granted
+
+
+def make_io(udpsocket, size, backend=config.io_backend):
+    """创建IO层
+    - size 报文的最大长度
+    - backend 为"socket"时逐个报文收发，为"batch"或"auto"时在支持的系统上批量收发，为"loop"时由asyncio事件循环收发
+    - 不支持批量收发时退回到逐个报文收发
+    """
+
+    # 路径MTU大时报文大，系统默认的缓冲区只能容纳几个报文，扩大到能容纳一个窗口的报文
+    size_buffers(udpsocket, size * config.default_rwnd)
+    if backend == "loop":
+        return LoopIO(udpsocket)
+
+    # 批量收发按64位的结构体布局填写mmsghdr
+    if (
+        backend != "socket"
+        and libc is not None
+        and udpsocket.family == AF_INET
+        and ctypes.sizeof(ctypes.c_void_p) == 8
+    ):
+        return BatchIO(udpsocket, libc, size)
+    return SocketIO(udpsocket)
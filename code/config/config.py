@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 from enum import Enum
 from struct import Struct, pack
 
@@ -15,11 +16,15 @@ class status(Enum):
     WORK = 4
 
 
-# 数据报文中数据段最大长度
+# 数据报文中数据段最大长度，开启路径MTU探测时由探测结果决定，探测不可用时使用
 MSS = 1024 * 5
 # 起始报文序号
 startnum = 0
 
+# 本程序支持的最高报文版本，握手时与对方协商取较小值
+# version 1 数据段补零到MSS长度，version 2 数据段只携带实际数据，version 3 特殊标识使用单独的标志字节，窗口可以缩放
+wire_version = 3
+
 # 请求报文数据段最大长度
 reMSS = 64
 # 请求报文结构
@@ -34,11 +39,31 @@ DUP_ACK = -2
 
 # 最小RTO防止RTO过小易触发超时
 Minimum_RTO = 0.5
+# 最大RTO，超时退避时RTO不超过该值
+Maximum_RTO = 10
+# 还没有RTT样本时使用的RTO
+Initial_RTO = 1
 
 # 发送指令的数据段报文内容
 send_command = "s"
 # 接收指令的数据段报文内容
 receive_command = "r"
+# 分段发送指令的数据段报文内容，发送文件的一个区间
+stripe_command = "p"
+# 检查文件指令的数据段报文内容，分段发送完毕后检查整个文件
+verify_command = "v"
+# 增量发送时请求接收方已有文件签名的指令
+signature_command = "g"
+# 增量发送时发送增量数据的指令
+delta_command = "d"
+# 增量发送时请求接收方用增量数据合成文件的指令
+patch_command = "t"
+# 压缩发送指令，发送压缩后的数据
+compress_command = "z"
+# 打包发送指令，把文件夹里的小文件打包成一个会话发送
+bundle_command = "b"
+# 打包数据发送完毕后请求接收方解开打包数据的指令，接收方回复是否解开成功
+unpack_command = "u"
 # 重传指令的数据段报文内容
 resend = "0"
 # 续传指令的数据段报文内容
@@ -62,13 +87,254 @@ gapport = 1
 # 数据段不同内容的分隔符，用于起初的握手报文
 spliter = "$^!&"
 
-# 默认的滑动窗口大小
+# 默认的滑动窗口大小，接收方缓冲区的初始大小（报文数量）
 default_rwnd = 128
+# 接收窗口自动调整：每收到一个窗口的数据，按写文件的速度和估计的RTT扩大接收方的缓冲区，只增不减
+rcv_autotune = True
+# 缓冲区为写文件速度乘RTT的倍数
+rcv_autotune_gain = 2
+# 接收方缓冲区的内存预算，字节，缓冲区不超过这么多个报文
+rcv_memory_budget = 64 * 1024 * 1024
+# 系统限制了socket接收缓冲区的上限时，通告的窗口不超过缓冲区实际能容纳的报文数量，但不小于rcvbuf_min_window，
+# 客户端确定MSS时也保证缓冲区至少能容纳这么多个报文
+rcvbuf_min_window = 8
+# 延迟确认：每按序收到ack_every个报文回复一个累计确认的ACK，不足ack_every个时最多延迟ack_delay秒
+# 乱序、填补空洞、结束报文、请求rwnd报文立即确认，开始的ack_quick个报文也逐个确认，不拖慢慢启动
+ack_every = 2
+ack_delay = 0.01
+ack_quick = 16
 
 # 结束报文的窗口大小标识
 DONE = 65532
 # 获取接收方窗口大小的报文的窗口大小标识
 GetWindowsSize = 65534
+# 发送Merkle树叶子分页的报文及其确认的窗口大小标识
+TREE_PAGE = 65530
+# 请求修复分块的ACK报文的窗口大小标识
+REPAIR = 65528
+# version 3中以上标识由单独的标志字节表示，窗口字段只表示窗口：标识 -> 标志位
+package_flags = {DONE: 0x01, GetWindowsSize: 0x02, TREE_PAGE: 0x04, REPAIR: 0x08}
+# 标志字节的低4位为标志位，高4位为窗口的缩放位数，窗口超过16位时右移后放入窗口字段
+flag_mask = 0x0F
+scale_shift = 4
+# 修复报文的序号标识，序号的其余位为报文在文件中的编号（文件偏移除以MSS）
+repair_flag = 1 << 31
+# 前向纠错校验报文的序号标识，序号为fec_flag | (组大小 << fec_shift) | 组内第一个报文序号的低fec_shift位，
+# 接收方取离期望序号最近的值还原，窗口小于2^(fec_shift-1)个报文即可
+fec_flag = 1 << 30
+fec_shift = 24
+
+# SACK块结构，(起始序号, 结束序号)，均为闭区间
+sack_block = Struct("!II")
+# ACK报文中SACK块的数量
+sack_count = Struct("!B")
+# 一个ACK报文最多携带的SACK块数量
+max_sack_blocks = 32
+# 接收方乱序缓冲区最多保存的报文数量
+max_ooo_package = 256
+
+# 接收方把连续的数据合并到多大（字节）再写入文件，写入的结束位置按这个大小对齐
+write_coalesce = 1024 * 1024
+# 是否按文件大小预先分配磁盘空间，减少大文件的碎片
+write_preallocate = True
+# 写入的数据何时同步到磁盘："none"交给操作系统，"chunk"每次写入后同步，"close"关闭文件前同步一次
+write_flush = "none"
+# 计算文件md5码时每次读取的字节数
+hash_chunk = 1024 * 1024
+
+# 是否按Merkle树逐块检查接收的数据，检查失败时只重发出错的分块
+merkle = True
+# 分块大小，向上取整到MSS的整数倍
+merkle_chunk = 1024 * 1024
+# 最多分多少块，超过时分块大小加倍
+merkle_max_leaves = 1024
+# 一次请求修复的报文数量，修复报文不经过流量控制和阻塞控制，一次太多会溢出socket接收缓冲区
+repair_window = 32
+# 修复时等待修复报文的超时时间，超时后重新请求
+repair_timeout = Minimum_RTO
+# 是否缓存文件的md5码，文件未改变时握手不再重新计算
+hash_cache = True
+# md5码缓存文件，放在用户的缓存目录（XDG_CACHE_HOME或~/.cache）下，不随工作目录变化
+hash_cache_file = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "UDPFileTransmission", "hash_cache.json")
+# 缓存改变后最多等待多少秒再写入缓存文件，多次改变合并为一次写入，进程退出时写入剩余的改变
+hash_cache_flush = 5
+# 最多缓存多少个文件的md5码
+hash_cache_size = 1024
+# 每个文件最多缓存多少个前缀的md5码
+hash_cache_prefixes = 16
+
+# 收发报文的IO层："auto"/"batch"在Linux上用sendmmsg/recvmmsg批量收发，"socket"逐个报文收发
+io_backend = "auto"
+# 批量收发时一次系统调用最多处理的报文数量
+io_batch = 64
+# 是否尝试用UDP_SEGMENT(GSO)让内核分段发送
+udp_gso = True
+# 是否尝试用UDP_GRO让内核合并接收
+udp_gro = True
+
+# 默认的阻塞控制算法："reno"、"cubic"、"bbr"，每次传输可以单独指定
+congestion_control = "reno"
+# 初始拥塞窗口
+initial_cwnd = 1
+# 初始慢启动阈值
+initial_ssthresh = 32
+# CUBIC三次函数的系数
+cubic_C = 0.4
+# CUBIC丢包时cwnd的缩小比例
+cubic_beta = 0.7
+# BBR启动阶段的增益
+bbr_high_gain = 2.885
+# BBR的cwnd为BDP的倍数
+bbr_cwnd_gain = 2
+# BBR估计带宽时取最近多少轮交付速率的最大值
+bbr_bw_rounds = 10
+# BBR最小RTT的有效时间（秒）
+bbr_min_rtt_window = 10
+# BBR的最小cwnd
+bbr_min_cwnd = 4
+# BBR带宽探测阶段每轮的pacing增益
+bbr_pacing_gains = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+
+# 是否开启发送节奏控制（pacing），把窗口内的报文分散到一个RTT内发送，避免突发
+pacing = False
+# 令牌桶容量，允许连续发送的报文数量
+pacing_burst = 4
+# 没有带宽估计时，发送速率为窗口/SRTT乘以增益：慢启动阶段和其他阶段的增益
+pacing_ss_gain = 2
+pacing_ca_gain = 1.2
+
+# 是否开启前向纠错，每组报文额外发送一个XOR校验报文，接收方丢了组内一个报文时直接还原，适合高丢包高延迟的链路
+fec = False
+# 每组报文数量的范围，随丢包率调整
+fec_group_min = 4
+fec_group_max = 32
+# 调整组大小的目标：平均每组丢失的报文数量
+fec_loss_target = 0.5
+# 丢包率估计的平滑系数
+fec_alpha = 0.125
+# ACK报文中SACK信息之后的接收方累计还原报文数量
+fec_report = Struct("!I")
+
+# 发送大文件时并行发送的分段数量，1表示不分段
+stripes = 1
+# 文件至少多大时才分段发送
+stripe_min_size = 64 * 1024 * 1024
+# 等待服务端检查文件的最多重试次数，大文件的检查需要较长时间
+verify_retry = 60
+
+# 是否使用增量发送：服务端已有旧版本的文件时，只发送与旧文件不同的数据
+delta = False
+# 文件至少多大时才使用增量发送
+delta_min_size = 1024 * 1024
+# 分块大小的范围，实际大小约为文件大小的平方根
+delta_block = 4 * 1024
+delta_max_block = 1024 * 1024
+# 一次向量化计算多少个起点的滚动校验和
+delta_window = 4 * 1024 * 1024
+# 筛选候选起点的位图大小，必须是2的幂
+delta_bitmap = 1 << 22
+# 一条字面数据指令最多携带的字节数
+delta_literal = 1024 * 1024
+# 增量数据超过文件大小的这个比例时，直接发送整个文件
+delta_ratio = 0.9
+# 签名结构：分块大小、分块数量，每个分块的弱校验和与md5码
+signature_header = Struct("!IQ")
+signature_block = Struct("!I16s")
+# 增量数据结构：分块大小、新文件大小，之后是复制指令（起始分块、分块数量）或字面数据指令（长度、数据）
+delta_header = Struct("!IQ")
+delta_copy_op = b"C"
+delta_copy = Struct("!QI")
+delta_literal_op = b"L"
+delta_length = Struct("!I")
+
+# 发送时使用的压缩算法，可选zlib、lzma、bz2，可以用"算法:级别"指定压缩级别，None表示不压缩
+# 双方在获取端口时协商都支持的算法，作为接收方时在请求中告诉服务端
+compression = None
+# 没有指定级别时的压缩级别
+compress_level = 6
+# 按块压缩，每块独立压缩，接收方收到一块解压一块
+compress_block = 1024 * 1024
+# 压缩前从文件中均匀取样的块数和每块大小，取样压缩后超过原大小的compress_ratio时认为数据不可压缩，不压缩
+compress_samples = 8
+compress_sample_size = 64 * 1024
+# 压缩率阈值，单个块压缩后超过原大小的这个比例时按原样发送
+compress_ratio = 0.9
+# 压缩数据块结构：是否压缩、原始长度、块数据长度，之后是块数据
+compress_frame = Struct("!BII")
+
+# 发送文件夹时是否把小文件打包成一个会话发送，不打包时每个文件单独获取端口、握手、发送
+bundle = False
+# 小于该大小的文件打包发送，其余文件单独发送
+bundle_max_file = 4 * 1024 * 1024
+# 打包数据结构：开头为清单（文件数量，每个文件的路径长度、文件大小和路径），之后是按清单顺序连续存放的文件内容
+bundle_header = Struct("!I")
+bundle_entry = Struct("!HQ")
+
+# 发送文件夹时同时进行传输的线程数量
+scan_workers = 8
+# 同一服务端同时进行的会话数量上限
+server_sessions = 8
+# 发送顺序："largest"从大到小，"interleave"大小交替，其他值按扫描顺序
+scan_order = "largest"
+
+# 客户端是否使用会话票据：获取端口时服务端签发票据，记录协商的参数，之后的传输把握手请求附上票据直接发往hostport，
+# 省去获取端口的往返和等待服务端创建进程的时间
+session_ticket = True
+# 客户端没有票据时是否把端口请求合并到握手请求中（hello），附上自己的参数直接发往hostport，服务端在握手回复中签发票据
+# 直接发往hostport的握手只需一次往返：不需要续传时客户端不发送确认，发送方收到请求或回复后直接开始发送数据
+direct_request = True
+# 直接发往hostport的握手请求前缀：类型，之后是会话票据，或hello的MSS、报文版本、压缩算法位图
+opening_kind = Struct("!B")
+opening_ticket = 1
+opening_hello = 2
+hello_body = Struct("!HBB")
+
+# 路径MTU探测（DPLPMTUD）：获取端口前向服务端hostport发送不同大小、DF置位的探测报文，服务端原样回显，
+# 按双向都能通过的最大报文确定本次会话的MSS，避免IP分片（丢失任何一片即丢失整个报文），回环和巨帧链路使用更大的报文
+pmtu_discovery = True
+# 探测的常见链路MTU：回环、巨帧、以太网、PPPoE、隧道、IPv6最小MTU
+pmtu_links = (65536, 9000, 1500, 1492, 1400, 1280)
+# IPv4头和UDP头的长度，UDP数据的最大长度
+ip_overhead = 28
+udp_max = 65507
+# 报文头的最大长度（version 3），MSS为通过的UDP数据大小减去报文头
+pmtu_header = 12
+# 没有回显时使用的UDP数据大小，IPv6最小MTU下也不会分片
+pmtu_base = 1280 - ip_overhead
+# 探测报文：类型为opening_probe，之后是报文大小和探测令牌，补零到该大小
+opening_probe = 3
+probe_body = Struct("!H")
+# 等待回显的超时，第一个回显到达后再等待的时间，没有回显时重发的轮数
+pmtu_probe_timeout = 0.5
+pmtu_probe_wait = 0.05
+pmtu_probe_rounds = 2
+# 探测结果的有效时间，秒，过期后重新探测，路径变化时调整MSS
+pmtu_lifetime = 600
+# 票据的有效时间，秒
+ticket_lifetime = 3600
+# 票据结构：MSS、报文版本、压缩算法位图、过期时间，之后是HMAC的前ticket_mac字节
+ticket_body = Struct("!HBBI")
+ticket_mac = 8
+ticket_size = ticket_body.size + ticket_mac
+# 探测令牌：hostport只回显附上有效令牌的探测报文，避免向伪造的源地址回显大报文；大小为0的探测报文请求令牌，回复比请求短
+# 令牌为过期时间和HMAC的前ticket_mac字节，HMAC包括客户端的ip
+token_body = Struct("!I")
+token_size = token_body.size + ticket_mac
+token_lifetime = 60
+# hostport的接收缓冲区大小，附上票据的握手请求比端口请求长
+request_size = 65536
+# 一次往返握手时，服务端收到附上回复中地址验证令牌的报文（客户端的地址得到验证）之前，
+# 最多发送直接发往hostport的请求的amplification_limit倍的数据，避免被用来向伪造的源地址放大流量
+# 地址验证令牌与探测令牌结构相同，HMAC包括客户端的ip和会话签名，只有收到回复的客户端才能附上
+amplification_limit = 3
+
+# 服务端的服务方式："thread"每个传输使用独立的线程，"asyncio"所有传输在一个事件循环中完成
+server_engine = "thread"
+# asyncio服务方式下执行握手的线程数量
+handshake_workers = 64
+
+# 服务端工作进程数量，0表示使用CPU核数
+server_workers = 0
 
 # 接收数据的超时时间
 time_limit = 10
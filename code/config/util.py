@@ -3,7 +3,18 @@
 
 import os
 from hashlib import md5 as md5sum
+from threading import Lock
 from . import config
+from .HashCache import HashCache
+
+# md5码缓存，所有握手共用
+md5_cache = HashCache() if config.hash_cache else None
+
+# 没有pread/pwrite的平台（Windows）用lseek+read/write代替，文件位置是共享的，需要加锁
+seek_lock = Lock()
+
+# 以二进制方式打开文件的标志，只有Windows需要，否则写入时会转换换行符
+O_BINARY = getattr(os, "O_BINARY", 0)
 
 
 def check_fileinfo(file, info):
@@ -17,9 +28,7 @@ def check_fileinfo(file, info):
     md5 = str(info[1])
     if not os.path.exists(file):
         return config.FILENOTFOUND
-    with open(file, "rb") as f:
-        data = f.read(size)
-    file_md5 = str(md5sum(data).hexdigest())
+    file_md5 = cached_md5(file, size)
     if file_md5 != md5:
         return config.resend
     # md5码一致，可以续传
@@ -37,7 +46,115 @@ def get_fileinfo(file):
         return ["0", "0"]
     # 获取已有的文件大小
     size = str(os.path.getsize(file))
-    with open(file, "rb") as f:
-        data = f.read()
-    md5 = str(md5sum(data).hexdigest())
+    md5 = cached_md5(file)
     return [size, md5]
+
+
+def cached_md5(file, size=None):
+    """计算文件（或前size字节）的md5码，优先使用缓存，计算后写入缓存
+    - 返回值：md5码的十六进制字符串
+    """
+
+    if md5_cache is None:
+        return md5_file(file, size).hexdigest()
+    st = os.stat(file)
+    md5 = md5_cache.get(file, size)
+    if md5 is None:
+        md5 = md5_file(file, size).hexdigest()
+        md5_cache.put(file, md5, size, st)
+    return md5
+
+
+def md5_file(file, size=None, hasher=None, start=0):
+    """流式计算文件的md5码
+    - file 要计算的文件
+    - size 只计算文件前多少字节，None表示整个文件
+    - hasher 在已有的md5对象上继续计算，None表示新建
+    - start 从文件的哪个位置开始计算
+    - 每次读取config.hash_chunk字节到复用的缓冲区，不把整个文件读入内存
+    - 返回值：md5对象
+    """
+
+    hasher = md5sum() if hasher is None else hasher
+    buf = memoryview(bytearray(config.hash_chunk))
+    with open(file, "rb", buffering=0) as f:
+        f.seek(start)
+        while size is None or size > 0:
+            n = f.readinto(buf if size is None or size >= len(buf) else buf[:size])
+            if not n:
+                break
+            hasher.update(buf[:n])
+            if size is not None:
+                size -= n
+    return hasher
+
+
+def pwrite(fd, data, offset):
+    """把data写到文件的offset处，不改变文件位置，返回写入的字节数
+    - 没有os.pwrite的平台（Windows）用lseek+write代替
+    """
+
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    with seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+def pread(fd, size, offset):
+    """从文件的offset处读出最多size字节，不改变文件位置
+    - 没有os.pread的平台（Windows）用lseek+read代替
+    """
+
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    with seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def fdatasync(fd):
+    """把文件数据刷到磁盘，没有os.fdatasync的平台（Windows、macOS）用os.fsync代替"""
+
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def pack_sack(seqs):
+    """打包SACK信息
+    - seqs 接收方已收到的乱序报文序号，升序排列
+    - 将连续的序号合并为区间，最多保留config.max_sack_blocks个区间
+    - 返回值：放在ACK报文数据段中的字节串
+    """
+
+    blocks = []
+    for seq in seqs:
+        if blocks and blocks[-1][1] + 1 == seq:
+            blocks[-1][1] = seq
+        else:
+            if len(blocks) == config.max_sack_blocks:
+                break
+            blocks.append([seq, seq])
+    return config.sack_count.pack(len(blocks)) + b"".join(
+        config.sack_block.pack(start, end) for start, end in blocks
+    )
+
+
+def unpack_sack(data):
+    """解析SACK信息
+    - data ACK报文的数据段
+    - 返回值：[(起始序号, 结束序号), ...]，数据段为空时返回空列表
+    """
+
+    if len(data) < config.sack_count.size:
+        return []
+    (count,) = config.sack_count.unpack_from(data)
+    blocks = []
+    for i in range(count):
+        offset = config.sack_count.size + i * config.sack_block.size
+        if offset + config.sack_block.size > len(data):
+            break
+        blocks.append(config.sack_block.unpack_from(data, offset))
+    return blocks
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""测试的公共设置
+- 把code加入sys.path，测试直接导入config下的模块
+- log 不输出也不写文件的日志，代替发送类、接收类和阻塞控制算法使用的Logger
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "code")))
+
+
+class QuietLog(object):
+    """与config.Logger.Logger接口相同，只记下警告和错误"""
+
+    def __init__(self):
+        self.warnings = []
+        self.errors = []
+
+    def info(self, info):
+        pass
+
+    def warning(self, warning):
+        self.warnings.append(warning)
+
+    def err(self, err):
+        self.errors.append(err)
+
+
+@pytest.fixture
+def log():
+    return QuietLog()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""一次往返握手的地址验证测试：发送方收到附上令牌的ACK前限制发送的数据量"""
+
+import os
+from socket import AF_INET, SOCK_DGRAM, socket
+
+import pytest
+
+from config.config import status
+from config.Sender import Sender
+from config.Ticket import decode_ticket, encode_ticket, issue_token
+from config.util import pack_sack
+
+MSS = 1000
+TOKEN = issue_token(os.urandom(32), "10.0.0.1:1")
+
+
+@pytest.fixture
+def sender(tmp_path, log):
+    file = tmp_path / "file"
+    file.write_bytes(bytes(100 * MSS))
+    s = socket(AF_INET, SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    sender = Sender(("127.0.0.1", 9), 1, str(file), 1000, 0, s, 0, log, MSS, 100 * MSS, 2, "reno", False, False)
+    sender.open_file()
+    sender.status = status.SLOW_START
+    sender.budget = 219
+    sender.token = TOKEN
+    yield sender
+    sender.close_file()
+    s.close()
+
+
+def test_token_text_round_trip():
+    assert decode_ticket(encode_ticket(TOKEN)) == TOKEN
+
+
+def test_ack_without_token(sender):
+    # 伪造源地址的报文签名正确也附不上令牌
+    sender.handle_acks([(sender.package.pack(1, 8, 0, b""), ("127.0.0.1", 9))], 0)
+    assert sender.budget == 219
+    sender.handle_acks([(sender.package.pack(1, 8, 0, os.urandom(len(TOKEN))), ("127.0.0.1", 9))], 0)
+    assert sender.budget == 219
+
+
+def test_ack_with_token(sender):
+    sender.cc.cwnd = 4
+    sender.fill()
+    # 令牌之后的SACK信息照常处理
+    sender.handle_acks([(sender.package.pack(1, 8, 0, TOKEN + pack_sack([2])), ("127.0.0.1", 9))], 0)
+    assert sender.budget is None
+    assert 2 in sender.sacked
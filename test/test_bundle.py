@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""文件夹打包的测试：遍历、打包与解包、越界路径"""
+
+import io
+import os
+
+import pytest
+
+from config.Bundle import list_tree, make_bundle, read_manifest, unpack_bundle
+from config.config import bundle_entry, bundle_header
+
+
+def test_round_trip(tmp_path):
+    root = tmp_path / "src"
+    (root / "sub" / "deep").mkdir(parents=True)
+    files = {"a.txt": b"hello", "sub/b.bin": os.urandom(3000), "sub/deep/empty": b"", "large": os.urandom(5000)}
+    for path, data in files.items():
+        (root / path).write_bytes(data)
+    small, large = list_tree(root, 4096)
+    assert small == ["a.txt", "sub/b.bin", "sub/deep/empty"]
+    assert large == [os.path.join(root, "large")]
+    size, md5 = make_bundle(root, small, tmp_path / "bundle")
+    assert int(size) == os.path.getsize(tmp_path / "bundle")
+    assert unpack_bundle(tmp_path / "bundle", tmp_path / "dst") == 3
+    for path in small:
+        assert (tmp_path / "dst" / path).read_bytes() == files[path]
+
+
+def manifest(path):
+    return io.BytesIO(bundle_header.pack(1) + bundle_entry.pack(len(path), 0) + path)
+
+
+@pytest.mark.parametrize("path", [b"../evil", b"/etc/passwd", b"a//b", b"a/./b", b"a/.."])
+def test_reject_escaping_paths(path):
+    with pytest.raises(ValueError):
+        read_manifest(manifest(path))
+
+
+def test_truncated_bundle(tmp_path):
+    bundle = tmp_path / "bundle"
+    bundle.write_bytes(bundle_header.pack(1) + bundle_entry.pack(1, 10) + b"a" + b"short")
+    with pytest.raises(ValueError):
+        unpack_bundle(bundle, tmp_path / "dst")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""压缩传输的测试：压缩设置的解析、分块压缩与流式解压"""
+
+import os
+
+import pytest
+
+from config.Compress import codecs, compress_file, compressible, parse_codec, StreamDecoder
+from config.config import compress_block, compress_frame, compress_level
+
+
+def test_parse_codec():
+    assert parse_codec("zlib") == ("zlib", compress_level)
+    assert parse_codec("lzma:1") == ("lzma", 1)
+    with pytest.raises(ValueError):
+        parse_codec("bz2:fast")
+
+
+@pytest.mark.parametrize("name", sorted(codecs))
+def test_round_trip(tmp_path, name):
+    file, out = tmp_path / "file", tmp_path / "out"
+    data = b"0123456789abcdef" * (compress_block // 8) + os.urandom(compress_block) + b"tail"
+    file.write_bytes(data)
+    size = compress_file(file, out, name, 1)
+    packed = out.read_bytes()
+    assert size == len(packed) < len(data)
+    decoder = StreamDecoder(name)
+    blocks = []
+    # 按任意长度分段交付
+    for i in range(0, len(packed), 1000):
+        blocks += decoder.feed(packed[i : i + 1000])
+    assert b"".join(blocks) == data
+    assert len(decoder.pending) == 0
+
+
+def test_incompressible_block_stored(tmp_path):
+    file, out = tmp_path / "file", tmp_path / "out"
+    data = os.urandom(1000)
+    file.write_bytes(data)
+    assert not compressible(file, "zlib", compress_level)
+    compress_file(file, out, "zlib", compress_level)
+    assert out.read_bytes() == compress_frame.pack(0, len(data), len(data)) + data
+
+
+def test_compressible(tmp_path):
+    file = tmp_path / "file"
+    file.write_bytes(b"a" * 100000)
+    assert compressible(file, "zlib", compress_level)
+    file.write_bytes(b"")
+    assert not compressible(file, "zlib", compress_level)
+
+
+def test_corrupt_block():
+    decoder = StreamDecoder("zlib")
+    body = codecs["zlib"].compress(b"x" * 100)
+    with pytest.raises(ValueError):
+        decoder.feed(compress_frame.pack(1, 99, len(body)) + body)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""阻塞控制算法、按确认的数据量增长cwnd和延迟确认的测试"""
+
+from socket import AF_INET, SOCK_DGRAM, socket
+
+import pytest
+
+from config.config import ack_every, ack_quick, default_rwnd, initial_cwnd, initial_ssthresh, status
+from config.Congestion import congestion_algorithms, make_congestion
+from config.Receiver import Receiver
+from config.Sender import Sender
+
+MSS = 1000
+
+
+@pytest.fixture
+def udpsocket():
+    s = socket(AF_INET, SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    yield s
+    s.close()
+
+
+def test_make_congestion(log):
+    assert sorted(congestion_algorithms) == ["bbr", "cubic", "reno"]
+    assert make_congestion("cubic", log).name == "cubic"
+    make_congestion("unknown", log)
+    assert log.warnings
+
+
+def test_reno_loss(log):
+    cc = make_congestion("reno", log)
+    cc.cwnd = 20
+    cc.on_fast_retransmit(0)
+    assert (cc.ssthresh, cc.cwnd, cc.status) == (10, 10, status.FASTRE_RECOVERY)
+    cc.on_timeout(0)
+    assert (cc.ssthresh, cc.cwnd, cc.status) == (5, 1, status.SLOW_START)
+
+
+def test_reno_slow_start_counts_bytes(log):
+    cc = make_congestion("reno", log)
+    # 一个ACK确认3个MSS，与3个ACK各确认一个MSS增长相同
+    cc.on_ack(3, 0)
+    assert cc.cwnd == initial_cwnd + 3
+    cc.on_ack(0.5, 0)
+    assert cc.cwnd == initial_cwnd + 3.5
+    assert cc.status == status.SLOW_START
+
+
+def test_reno_leftover_into_avoid(log):
+    cc = make_congestion("reno", log)
+    cc.on_ack(initial_ssthresh - initial_cwnd + initial_ssthresh, 0)
+    # 到达ssthresh之后剩下的数据量按阻塞避免增长
+    assert cc.status == status.AVOID
+    assert cc.cwnd == pytest.approx(initial_ssthresh + 1)
+
+
+class QueueIO(object):
+    """记下接收方排队发送的ACK"""
+
+    def __init__(self, package):
+        self.package = package
+        self.acks = []
+
+    def queue(self, packages, destaddr):
+        self.acks += [self.package.unpack(pkg)[2] for pkg in packages]
+
+    def flush(self):
+        pass
+
+    def sendto(self, pkg, destaddr):
+        self.queue([pkg], destaddr)
+
+
+def test_sender_delayed_ack(tmp_path, udpsocket, log):
+    sender = Sender(("127.0.0.1", 9), 1, str(tmp_path / "file"), default_rwnd, 0, udpsocket, 0, log, MSS, 10 * MSS + 500, 2, "reno", False, False)
+    sender.status = status.SLOW_START
+    sender.buffer.extend((seq, seq * MSS, MSS if seq < 10 else 500) for seq in range(11))
+    sender.nextseq = 11
+    # 一个ACK累计确认两个完整的报文
+    sender.handle_ack(1, default_rwnd, b"", 0.0)
+    assert sender.cwnd == initial_cwnd + 2
+    assert sender.unackseq == 2
+    # 最后一个不满MSS的报文按数据量计入
+    sender.handle_ack(10, default_rwnd, b"", 0.0)
+    assert sender.cwnd == pytest.approx(initial_cwnd + 10.5)
+    assert len(sender.buffer) == 0
+
+
+def test_receiver_delayed_ack(tmp_path, udpsocket, log):
+    count = ack_quick + 4 * ack_every + 1
+    receiver = Receiver(("127.0.0.1", 9), 1, str(tmp_path / "file"), 0, udpsocket, 0, None, log, MSS, count * MSS, "", 2)
+    receiver.io = QueueIO(receiver.package)
+    receiver.status = status.SLOW_START
+    data = bytes(MSS)
+    for seq in range(ack_quick):
+        receiver.accept(seq, MSS, data)
+    # 开始的ack_quick个报文逐个确认
+    assert receiver.io.acks == list(range(ack_quick))
+    receiver.io.acks.clear()
+    for seq in range(ack_quick, ack_quick + 4 * ack_every):
+        receiver.accept(seq, MSS, data)
+    # 之后每ack_every个报文确认一次
+    assert receiver.io.acks == list(range(ack_quick + ack_every - 1, ack_quick + 4 * ack_every, ack_every))
+    receiver.io.acks.clear()
+    receiver.accept(count - 1, MSS, data)
+    assert receiver.io.acks == [] and receiver.deadline is not None
+    receiver.flush_ack()
+    assert receiver.io.acks == [count - 1]
+
+
+def test_receiver_out_of_order_acks_immediately(tmp_path, udpsocket, log):
+    receiver = Receiver(("127.0.0.1", 9), 1, str(tmp_path / "file"), 0, udpsocket, 0, None, log, MSS, 100 * MSS, "", 2)
+    receiver.io = QueueIO(receiver.package)
+    receiver.quick = 0
+    data = bytes(MSS)
+    receiver.accept(0, MSS, data)
+    assert receiver.io.acks == []
+    receiver.accept(2, MSS, data)
+    assert receiver.io.acks == [0]
+    # 填补空洞立即确认，一并交付乱序缓冲区中的报文
+    receiver.accept(1, MSS, data)
+    assert receiver.io.acks == [0, 2]
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""增量传输的测试：滚动校验和、签名、增量数据的生成与合成"""
+
+import os
+
+import numpy as np
+import pytest
+
+from config.config import delta_block, delta_max_block
+from config.Delta import apply_delta, delta_block_size, make_delta, make_signature, read_signature, weak_checksums
+
+L = 1024
+
+
+def weak(block):
+    """按定义逐个计算一个分块的弱校验和"""
+
+    a = sum(block)
+    b = sum((len(block) - i) * x for i, x in enumerate(block))
+    return (a & 0xFFFF) | ((b & 0xFFFF) << 16)
+
+
+def test_block_size_bounds():
+    assert delta_block_size(0) == delta_block
+    assert delta_block_size(1 << 50) == delta_max_block
+    assert delta_block_size(1 << 30) % 1024 == 0
+
+
+def test_weak_checksums_match_definition():
+    data = np.random.default_rng(1).integers(0, 256, 300, dtype=np.uint8)
+    result = weak_checksums(data, 64)
+    assert len(result) == len(data) - 64 + 1
+    for k in (0, 1, 100, len(result) - 1):
+        assert result[k] == weak(data[k : k + 64].tolist())
+
+
+def test_signature(tmp_path):
+    old = tmp_path / "old"
+    old.write_bytes(os.urandom(3 * L + 10))
+    make_signature(old, tmp_path / "sig", L)
+    size, blocks = read_signature(tmp_path / "sig")
+    assert size == L
+    # 不足一块的结尾不参与匹配
+    assert sorted(i for entries in blocks.values() for i, _ in entries) == [0, 1, 2]
+
+
+def delta(tmp_path, old_data, new_data):
+    """生成增量数据并合成新文件，返回(增量数据大小, 合成的新文件)"""
+
+    old, new, sig, patch, out = (tmp_path / name for name in ("old", "new", "sig", "patch", "out"))
+    old.write_bytes(old_data)
+    new.write_bytes(new_data)
+    make_signature(old, sig, L)
+    size, md5 = make_delta(new, sig, patch)
+    assert int(size) == os.path.getsize(patch)
+    apply_delta(old, patch, out)
+    return int(size), out.read_bytes()
+
+
+def test_round_trip_with_edits(tmp_path):
+    old_data = os.urandom(64 * L)
+    # 中间插入、删除、修改，以及非对齐的偏移
+    new_data = old_data[:10 * L] + b"inserted" + old_data[10 * L : 30 * L] + old_data[31 * L : 50 * L] + os.urandom(100)
+    size, out = delta(tmp_path, old_data, new_data)
+    assert out == new_data
+    assert size < len(new_data) // 10
+
+
+def test_unrelated_files(tmp_path):
+    new_data = os.urandom(8 * L)
+    size, out = delta(tmp_path, os.urandom(8 * L), new_data)
+    assert out == new_data
+    assert size > len(new_data)
+
+
+@pytest.mark.parametrize("old_size,new_size", [(0, 5 * L), (5 * L, 0), (L - 1, 3 * L)])
+def test_empty_and_short_files(tmp_path, old_size, new_size):
+    new_data = os.urandom(new_size)
+    assert delta(tmp_path, os.urandom(old_size), new_data)[1] == new_data
+
+
+def test_corrupt_delta(tmp_path):
+    old_data = os.urandom(4 * L)
+    delta(tmp_path, old_data, old_data + b"tail")
+    patch = tmp_path / "patch"
+    patch.write_bytes(patch.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        apply_delta(tmp_path / "old", patch, tmp_path / "out")
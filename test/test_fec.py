@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""前向纠错的测试：校验报文序号、组内缺一个报文时的还原、组大小的调整"""
+
+import os
+
+import pytest
+
+from config.config import DONE, fec_flag, fec_group_max, fec_group_min, fec_report, fec_shift, sack_count
+from config.Fec import FecDecoder, FecEncoder, parity_group, parity_seq
+
+MSS = 512
+
+
+def encode(packets):
+    """把一组报文交给编码器，返回校验报文"""
+
+    encoder = FecEncoder(MSS)
+    for seq, rwnd, data in packets:
+        parity = encoder.add(seq, rwnd, data)
+    return parity if parity is not None else encoder.flush()
+
+
+def test_parity_seq():
+    seq = parity_seq(100, 8)
+    assert seq & fec_flag
+    assert parity_group(seq, 100) == (100, 8)
+    # 序号超过fec_shift位时，取离期望序号最近的值
+    first = (1 << fec_shift) + 5
+    assert parity_group(parity_seq(first, 4), first - 3) == (first, 4)
+
+
+@pytest.mark.parametrize("lost", [0, 3, 7])
+def test_recover_one_lost(lost):
+    packets = [(10 + i, len(data), data) for i, data in enumerate(os.urandom(n) for n in (512, 100, 512, 7, 512, 300, 512, 1))]
+    seq, rwnd, data = encode(packets)
+    assert parity_group(seq, 10) == (10, len(packets))
+    decoder = FecDecoder(MSS)
+    for p in packets:
+        if p[0] != packets[lost][0]:
+            assert decoder.record(*p, 10) == []
+    [(rebuilt, rebuilt_rwnd, rebuilt_data)] = decoder.parity(seq, rwnd, data, 10)
+    # 还原的数据段补零到MSS长度，由窗口字段得到实际长度
+    assert (rebuilt, rebuilt_rwnd) == packets[lost][:2]
+    assert rebuilt_data[:rebuilt_rwnd] == packets[lost][2]
+    assert decoder.recovered == 1
+
+
+def test_parity_before_packets():
+    packets = [(i, 4, bytes([i]) * 4) for i in range(4)]
+    parity = encode(packets)
+    decoder = FecDecoder(MSS)
+    assert decoder.parity(*parity, 0) == []
+    assert decoder.record(*packets[0], 0) == []
+    assert decoder.record(*packets[1], 0) == []
+    [(seq, rwnd, data)] = decoder.record(*packets[3], 0)
+    assert (seq, rwnd, data[:rwnd]) == packets[2]
+
+
+def test_two_lost_not_recovered():
+    packets = [(i, 4, bytes([i]) * 4) for i in range(4)]
+    parity = encode(packets)
+    decoder = FecDecoder(MSS)
+    decoder.record(*packets[0], 0)
+    decoder.record(*packets[1], 0)
+    assert decoder.parity(*parity, 0) == []
+
+
+def test_done_closes_group():
+    encoder = FecEncoder(MSS)
+    assert encoder.add(0, 3, b"abc") is None
+    seq, rwnd, data = encoder.add(1, DONE, b"")
+    assert parity_group(seq, 0) == (0, 2)
+    assert rwnd == 3 ^ DONE and data == b"abc"
+    assert encoder.inflight() == 3
+    encoder.release(2)
+    assert encoder.inflight() == 0
+
+
+def test_adapt_group_size():
+    encoder = FecEncoder(MSS)
+    assert encoder.group == fec_group_max
+    for _ in range(20):
+        for i in range(encoder.group):
+            encoder.add(i, 1, b"x")
+        encoder.on_loss(encoder.group // 2)
+    assert encoder.group == fec_group_min
+    # 接收方报告的累计还原数量，只有新增的部分计入丢包
+    lost = encoder.lost
+    encoder.report(sack_count.pack(0) + fec_report.pack(5))
+    encoder.report(sack_count.pack(0) + fec_report.pack(5))
+    assert encoder.recovered == 5 and encoder.lost == lost + 5
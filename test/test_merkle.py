@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Merkle树的测试：分块大小、根的计算、叶子分页"""
+
+import math
+import os
+from hashlib import md5 as md5sum
+
+import pytest
+
+from config import Merkle
+from config.config import merkle_chunk, merkle_max_leaves
+from config.Merkle import MerkleTree, merkle_chunk_size
+
+MSS = 1000
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    """不读写用户的md5码缓存"""
+
+    monkeypatch.setattr(Merkle, "md5_cache", None)
+
+
+def test_chunk_size():
+    chunk = merkle_chunk_size(0, MSS)
+    assert chunk % MSS == 0 and chunk >= merkle_chunk
+    big = merkle_chunk_size(merkle_chunk * merkle_max_leaves * 5, MSS)
+    assert big % MSS == 0
+    assert math.ceil(merkle_chunk * merkle_max_leaves * 5 / big) <= merkle_max_leaves
+
+
+def test_root():
+    a, b, c = (md5sum(x).digest() for x in (b"a", b"b", b"c"))
+    assert MerkleTree(1, 0).root == md5sum(b"").hexdigest()
+    assert MerkleTree(1, 1, leaves=[a]).root == a.hex()
+    # 落单的节点直接升到上一层
+    assert MerkleTree(1, 3, leaves=[a, b, c]).root == md5sum(md5sum(a + b).digest() + c).hexdigest()
+
+
+def test_build(tmp_path):
+    file = tmp_path / "file"
+    data = os.urandom(2 * merkle_chunk_size(0, MSS) + 123)
+    file.write_bytes(data)
+    tree = MerkleTree.build(file, MSS)
+    assert tree.count == 3
+    for i, leaf in enumerate(tree.leaves):
+        start, end = tree.span(i, len(data))
+        assert leaf == md5sum(data[start:end]).digest()
+    assert tree.span(2, len(data))[1] == len(data)
+
+
+def test_pages_round_trip():
+    leaves = [md5sum(bytes([i])).digest() for i in range(150)]
+    sender = MerkleTree(MSS, len(leaves), leaves=leaves)
+    receiver = MerkleTree.from_info(sender.info())
+    assert receiver.root == sender.root and not receiver.verified()
+    assert sender.pages(MSS) == math.ceil(150 / (MSS // 16))
+    for index in reversed(range(sender.pages(MSS))):
+        receiver.accept(index, sender.page(index, MSS), MSS)
+    assert receiver.leaves == leaves
+    assert receiver.verified()
+
+
+def test_tampered_leaf():
+    leaves = [md5sum(bytes([i])).digest() for i in range(10)]
+    receiver = MerkleTree.from_info(MerkleTree(MSS, 10, leaves=leaves).info())
+    page = bytearray(b"".join(leaves))
+    page[0] ^= 1
+    receiver.accept(0, bytes(page), MSS)
+    assert not receiver.verified()
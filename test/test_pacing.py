@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""发送节奏控制的测试：超时重传的报文排队，按令牌发出"""
+
+import time
+from socket import AF_INET, SOCK_DGRAM, socket
+
+import pytest
+
+from config.config import status
+from config.Pacer import Pacer
+from config.Sender import Sender
+
+MSS = 1000
+
+
+class CountIO(object):
+    """记下发出的报文序号"""
+
+    def __init__(self, package):
+        self.package = package
+        self.sent = []
+
+    def queue(self, iov, destaddr):
+        self.sent.append(self.package.unpack(b"".join(bytes(part) for part in iov))[2])
+
+    def flush(self):
+        pass
+
+    def sendto(self, pkg, destaddr):
+        pass
+
+    def settimeout(self, value):
+        pass
+
+
+@pytest.fixture
+def sender(tmp_path, log):
+    file = tmp_path / "file"
+    file.write_bytes(bytes(100 * MSS))
+    s = socket(AF_INET, SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    sender = Sender(("127.0.0.1", 9), 1, str(file), 1000, 0, s, 0, log, MSS, 100 * MSS, 2, "reno", True, False)
+    sender.io = CountIO(sender.package)
+    sender.open_file()
+    sender.status = status.SLOW_START
+    yield sender
+    sender.close_file()
+    s.close()
+
+
+def test_pacer_tokens():
+    pacer = Pacer(burst=2)
+    pacer.set_rate(10)
+    assert pacer.take() == 0 and pacer.take() == 0
+    # 预支令牌，等待时间随欠下的令牌增加
+    assert pacer.take() == pytest.approx(0.1, abs=0.01)
+    assert pacer.delay() > 0.1
+
+
+def test_timeout_resend_is_paced(sender):
+    sender.cc.cwnd = 16
+    sender.fill()
+    assert sender.io.sent == list(range(16))
+    sender.io.sent.clear()
+    # 超时后cwnd为1，速率为2个报文每SRTT
+    sender.SRTT = 0.1
+    sender.handle_timeout()
+    assert sender.io.sent == []
+    assert len(sender.retransmits) == 16
+    sender.fill()
+    # 只发出令牌桶中积攒的报文，其余的等待令牌
+    assert sender.io.sent == list(range(len(sender.io.sent)))
+    assert 0 < len(sender.io.sent) <= sender.pacer.burst
+    assert sender.pacing_delay() > 0
+
+
+def test_acked_retransmits_skipped(sender):
+    sender.cc.cwnd = 8
+    sender.fill()
+    sender.io.sent.clear()
+    sender.SRTT = 0.1
+    sender.handle_timeout()
+    # 排队期间确认了前5个报文，SACK了第6个
+    sender.handle_ack(4, 1000, b"", time.monotonic())
+    sender.sacked.add(6)
+    sender.pacer.set_rate(None)
+    sender.fill()
+    assert sender.io.sent[:2] == [5, 7]
+    assert not sender.retransmits
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""报文结构的测试：version 1/2/3的编码与解码、特殊标识、窗口缩放"""
+
+from struct import error
+
+import pytest
+
+from config.config import DONE, GetWindowsSize, REPAIR, TREE_PAGE, package_flags
+from config.Package import Package
+
+MSS = 1024
+
+
+@pytest.mark.parametrize("version", [1, 2, 3])
+def test_round_trip(version):
+    package = Package(MSS, version)
+    raw = package.pack(1234, 56, 789, b"hello")
+    sign, rwnd, seq, data = package.unpack(raw)
+    assert (sign, rwnd, seq) == (1234, 56, 789)
+    # version 1的数据段补零到MSS长度
+    assert data.rstrip(b"\x00") == b"hello"
+
+
+def test_version1_pads_to_mss():
+    package = Package(MSS, 1)
+    assert package.padded
+    assert len(package.pack(1, 2, 3, b"x")) == package.size
+
+
+@pytest.mark.parametrize("version", [2, 3])
+def test_unpadded_length(version):
+    package = Package(MSS, version)
+    assert not package.padded
+    assert len(package.pack(1, 2, 3, b"abc")) == package.header.size + 3
+    assert package.unpack(package.pack(1, 2, 3, b""))[3] == b""
+
+
+@pytest.mark.parametrize("version", [2, 3])
+def test_data_longer_than_mss(version):
+    with pytest.raises(error):
+        Package(MSS, version).pack(1, 2, 3, bytes(MSS + 1))
+
+
+@pytest.mark.parametrize("version", [2, 3])
+def test_truncated_package(version):
+    package = Package(MSS, version)
+    raw = package.pack(1, 2, 3, b"abcdef")
+    with pytest.raises(error):
+        package.unpack(raw[:-1])
+
+
+def test_version_mismatch():
+    raw = Package(MSS, 2).pack(1, 2, 3, b"abc")
+    with pytest.raises(error):
+        Package(MSS, 3).unpack(raw)
+
+
+@pytest.mark.parametrize("flag", [DONE, GetWindowsSize, TREE_PAGE, REPAIR])
+def test_version3_flags(flag):
+    package = Package(MSS, 3)
+    flags, window = package.encode(flag)
+    assert (flags, window) == (package_flags[flag], 0)
+    assert package.unpack(package.pack(1, flag, 3, b""))[1] == flag
+
+
+def test_version3_unknown_flag():
+    package = Package(MSS, 3)
+    raw = bytearray(package.pack(1, 2, 3, b""))
+    raw[1] = 0x07
+    with pytest.raises(error):
+        package.unpack(bytes(raw))
+
+
+def test_version3_window_scale():
+    package = Package(MSS, 3)
+    rwnd = 3_000_000
+    flags, window = package.encode(rwnd)
+    assert window < 1 << 16
+    decoded = package.decode(flags, window)
+    # 缩放丢掉的低位只会让通告的窗口略小
+    assert decoded <= rwnd
+    assert rwnd - decoded < 1 << (rwnd.bit_length() - 16)
+
+
+def test_window_avoids_flags():
+    assert Package(MSS, 2).window(100000) == min(package_flags) - 1
+    assert Package(MSS, 3).window(DONE) == DONE - 1
+    assert Package(MSS, 3).window(100000) == 100000
+
+
+@pytest.mark.parametrize("version", [1, 2, 3])
+def test_pack_header_into(version):
+    package = Package(MSS, version)
+    buf = bytearray(package.header.size)
+    package.pack_header_into(buf, 7, 8, 9, 4)
+    raw = bytes(buf) + b"data"
+    if package.padded:
+        raw = raw.ljust(package.size, b"\x00")
+    sign, rwnd, seq, data = package.unpack(raw)
+    assert (sign, rwnd, seq) == (7, 8, 9)
+    assert data.rstrip(b"\x00") == b"data"
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""压缩传输时写文件较慢的测试
+- 在进程内驱动接收类：主线程按通告的窗口逐个交付压缩数据的报文，写文件进程的consume换成先等待再解压写入的版本
+- 写文件慢时缓冲区积压，通告的窗口变小，解压写入的数据和md5码仍然正确
+"""
+
+import time
+from hashlib import md5 as md5sum
+from socket import AF_INET, SOCK_DGRAM, socket
+from threading import Thread
+
+import pytest
+
+from config import Receiver as receiver_module
+from config.Compress import compress_file
+from config.config import DONE, status
+from config.Receiver import Receiver
+
+MSS = 1000
+
+# 写文件进程每取出一批数据后等待的秒数
+DELAY = 0.005
+
+
+class QuietIO(object):
+    """不发出ACK的IO层"""
+
+    def queue(self, packages, destaddr):
+        pass
+
+    def flush(self):
+        pass
+
+    def sendto(self, pkg, destaddr):
+        pass
+
+
+@pytest.fixture
+def udpsocket():
+    s = socket(AF_INET, SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    yield s
+    s.close()
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    """不读写用户的md5码缓存"""
+
+    monkeypatch.setattr(receiver_module, "md5_cache", None)
+
+
+def receive(tmp_path, udpsocket, log, data, corrupt=None):
+    """把data压缩后交给写文件较慢的接收类，返回(接收类, 交付时观察到的最小窗口)"""
+
+    source, spool, target = tmp_path / "source", tmp_path / "spool", tmp_path / "target"
+    source.write_bytes(data)
+    size = compress_file(source, spool, "zlib", 6)
+    stream = bytearray(spool.read_bytes())
+    if corrupt is not None:
+        stream[corrupt] ^= 0xFF
+    receiver = Receiver(("127.0.0.1", 9), 1, str(target), 0, udpsocket, 0, None, log, MSS, len(data), md5sum(data).hexdigest(), 2, codec="zlib", streamsize=size)
+    receiver.io = QuietIO()
+    receiver.status = status.WORK
+    consume = receiver.consume
+
+    def slow(chunk):
+        time.sleep(DELAY)
+        consume(chunk)
+
+    receiver.consume = slow
+    writer = Thread(target=receiver.write)
+    writer.start()
+    lowest = receiver.rwnd
+    packets = [bytes(stream[i : i + MSS]) for i in range(0, len(stream), MSS)]
+    for seq, chunk in enumerate(packets + [b""]):
+        # 发送方只在窗口有空位时发送
+        with receiver.cond:
+            assert receiver.cond.wait_for(lambda: receiver.rwnd > 0, 10)
+            lowest = min(lowest, receiver.rwnd)
+        receiver.accept(seq, len(chunk) if chunk else DONE, chunk)
+    receiver.close()
+    writer.join(10)
+    assert not writer.is_alive()
+    return receiver, lowest
+
+
+def test_slow_writer(tmp_path, udpsocket, log):
+    data = b"".join(b"line %d of a compressible file\n" % i for i in range(200000))
+    receiver, lowest = receive(tmp_path, udpsocket, log, data)
+    assert receiver.finished and receiver.correct
+    assert (tmp_path / "target").read_bytes() == data
+    # 写文件跟不上时通告的窗口变小
+    assert lowest < receiver.capacity
+
+
+def test_corrupt_stream(tmp_path, udpsocket, log):
+    data = b"".join(b"line %d of a compressible file\n" % i for i in range(50000))
+    receiver, _ = receive(tmp_path, udpsocket, log, data, corrupt=100)
+    assert receiver.corrupt and not receiver.correct
+    assert log.errors
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""会话票据和探测令牌的测试：签发与检查、伪造、过期、绑定客户端ip"""
+
+import os
+import time
+
+from config.config import ticket_lifetime, ticket_size, token_lifetime, token_size
+from config.Ticket import check_token, codec_mask, decode_ticket, issue_ticket, issue_token, mask_codecs, open_ticket
+
+KEY = os.urandom(32)
+HOST = "10.0.0.1"
+
+
+def test_codec_mask():
+    assert mask_codecs(codec_mask(["bz2", "zlib"])) == ["zlib", "bz2"]
+    assert mask_codecs(codec_mask([])) == []
+
+
+def test_ticket_round_trip():
+    raw = decode_ticket(issue_ticket(KEY, 1400, 3, ["zlib", "lzma"], HOST))
+    assert len(raw) == ticket_size
+    assert open_ticket(KEY, raw, HOST) == (1400, 3, ["zlib", "lzma"], False)
+
+
+def test_ticket_forged():
+    raw = bytearray(decode_ticket(issue_ticket(KEY, 1400, 3, [], HOST)))
+    assert open_ticket(os.urandom(32), bytes(raw), HOST) is None
+    assert open_ticket(KEY, bytes(raw[:-1]), HOST) is None
+    # 改大MSS
+    raw[0] ^= 0x80
+    assert open_ticket(KEY, bytes(raw), HOST) is None
+
+
+def test_ticket_bound_to_host():
+    raw = decode_ticket(issue_ticket(KEY, 1400, 3, [], HOST))
+    assert open_ticket(KEY, raw, "10.0.0.2") is None
+
+
+def test_ticket_expired(monkeypatch):
+    raw = decode_ticket(issue_ticket(KEY, 1400, 3, [], HOST))
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + ticket_lifetime + 1)
+    # 过期的票据仍能认出来，服务端回复RESET
+    assert open_ticket(KEY, raw, HOST) == (1400, 3, [], True)
+
+
+def test_token():
+    token = issue_token(KEY, HOST)
+    assert len(token) == token_size
+    assert check_token(KEY, token + b"padding", HOST)
+    assert not check_token(KEY, token, "10.0.0.2")
+    assert not check_token(os.urandom(32), token, HOST)
+    assert not check_token(KEY, token[:-1], HOST)
+
+
+def test_token_expired(monkeypatch):
+    token = issue_token(KEY, HOST)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + token_lifetime + 1)
+    assert not check_token(KEY, token, HOST)
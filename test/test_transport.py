@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""IO层的测试：不支持批量收发的系统退回到逐个报文收发"""
+
+from socket import AF_INET, SOCK_DGRAM, socket
+
+from config import Transport
+from config.Transport import SocketIO, load_libc, make_io
+
+
+def test_no_libc_off_linux(monkeypatch):
+    monkeypatch.setattr(Transport.sys, "platform", "win32")
+    assert load_libc() is None
+
+
+def test_socket_io_without_libc(monkeypatch):
+    monkeypatch.setattr(Transport, "libc", None)
+    s = socket(AF_INET, SOCK_DGRAM)
+    try:
+        assert isinstance(make_io(s, 1500, "batch"), SocketIO)
+    finally:
+        s.close()